@@ -0,0 +1,99 @@
+"""
+Benchmark of POST /cars/ under WSGI and ASGI, against a slow NHTSA stub
+
+Starts gunicorn twice on a throwaway database: with sync workers serving
+POST /cars/, then with uvicorn workers serving POST /async/cars/. Every
+request adds a car of a different make, so each one waits for NHTSA.
+Sync workers handle one request at a time, async workers keep handling
+requests while waiting. One worker by default, as concurrent writes
+from several processes fail on SQLite ("database is locked").
+
+Usage: python -m benchmarks.async_validation [--requests 200]
+           [--concurrency 50] [--workers 1] [--delay 0.2]
+"""
+
+import argparse
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.common import gunicorn, manage, server_env
+from carapi.tests.nhtsa_stub import NhtsaStub
+
+SERVERS = {
+    # name: (gunicorn arguments, path)
+    "wsgi": (["project.wsgi", "--worker-class", "sync"], "/cars/"),
+    "asgi": (
+        ["project.asgi", "--worker-class", "uvicorn.workers.UvicornWorker"],
+        "/async/cars/",
+    ),
+}
+
+
+def run(name: str, env: dict, args) -> dict:
+    """
+    Start the server, send the requests, stop the server
+    """
+    server_args, path = SERVERS[name]
+    with gunicorn(env, server_args, args.workers) as base:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+        session.mount("http://", adapter)
+
+        def post(i: int) -> int:
+            return session.post(
+                base + path,
+                json={"make": "%s%d" % (name, i), "model": "Model"},
+                timeout=120,
+            ).status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            statuses = Counter(pool.map(post, range(args.requests)))
+        elapsed = time.perf_counter() - start
+    return {
+        "statuses": dict(statuses),
+        "elapsed_s": round(elapsed, 2),
+        "req_per_s": round(args.requests / elapsed, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--delay", type=float, default=0.2, help="Stub response delay (s)"
+    )
+    args = parser.parse_args()
+
+    # Makes aren't shared by the runs, so every request misses the cache
+    catalog = {
+        "%s%d" % (name, i): ["Model"]
+        for name in SERVERS
+        for i in range(args.requests)
+    }
+    with NhtsaStub(
+        catalog, delay=args.delay
+    ) as stub, tempfile.TemporaryDirectory() as directory:
+        env = server_env(directory, stub.url)
+        manage(env, "migrate", "--run-syncdb", "-v", "0")
+
+        print(
+            "%d POST requests adding cars of distinct makes, %d concurrent,"
+            " %d workers, %.1fs NHTSA latency"
+            % (args.requests, args.concurrency, args.workers, args.delay)
+        )
+        for name in SERVERS:
+            stub.reset()
+            result = run(name, env, args)
+            result["nhtsa_requests"] = stub.requests
+            print("  %s: %s" % (name, result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Helpers shared by the benchmarks
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import django
+import requests
+
+
+def setup_django() -> None:
+    """
+    Configure Django like manage.py does
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    """
+    Create a throwaway database for the benchmark, the same way the test
+    runner does, so that benchmarks never touch real data.
+    SQLite test databases are kept in a temporary file rather than in
+    memory, so that every thread gets a connection of its own.
+    """
+    from django.db import connection
+
+    directory = None
+    if connection.vendor == "sqlite":
+        directory = tempfile.TemporaryDirectory()
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(
+            directory.name, "benchmark.sqlite3"
+        )
+        connection.settings_dict["OPTIONS"].setdefault("timeout", 30)
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if directory is not None:
+            directory.cleanup()
+
+
+def server_env(directory: str, nhtsa_api_url: str) -> dict:
+    """
+    Environment of servers & commands started by the benchmarks, using
+    a SQLite database and a file cache in the given directory
+    """
+    return dict(
+        os.environ,
+        DJANGO_SETTINGS_MODULE="benchmarks.settings",
+        BENCHMARK_DATABASE=os.path.join(directory, "db.sqlite3"),
+        CACHE_URL="file://" + os.path.join(directory, "cache"),
+        NHTSA_API_URL=nhtsa_api_url,
+    )
+
+
+def manage(env: dict, *args: str) -> None:
+    """
+    Run a management command in a new process
+    """
+    subprocess.run([sys.executable, "manage.py", *args], env=env, check=True)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(url, timeout=5)
+            return
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+@contextmanager
+def gunicorn(env: dict, args: list, workers: int):
+    """
+    Run gunicorn with the given arguments (application, worker class)
+    on a free local port, yields the base URL once it answers
+    """
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", *args]
+        + ["--bind", "127.0.0.1:%d" % port, "--workers", str(workers)]
+        + ["--log-level", "warning"],
+        env=env,
+    )
+    try:
+        base = "http://127.0.0.1:%d" % port
+        wait_until_up(base + "/cars/")
+        yield base
+    finally:
+        server.terminate()
+        server.wait()
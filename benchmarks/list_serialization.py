@@ -0,0 +1,104 @@
+"""
+Benchmark of the list endpoints with and without FAST_LIST
+
+Walks all the pages of GET /cars/, /rate/ and /popular/ through the
+Django test client, once through the serializers and once with FAST_LIST,
+checks that the responses are the same and reports rows per second.
+Runs against a throwaway database created from DATABASE_URL.
+
+Usage: python -m benchmarks.list_serialization [--cars 20000] [--page-size 1000]
+"""
+
+import argparse
+import random
+import time
+
+from benchmarks.common import setup_django, test_database
+
+setup_django()
+
+from django.test import Client, override_settings  # noqa: E402
+
+from carapi import renderers  # noqa: E402
+from carapi.models import Car, Rating  # noqa: E402
+
+
+def seed(cars: int) -> None:
+    """
+    Insert cars, each rated 1 to 5 times
+    """
+    Car.objects.bulk_create(
+        [
+            Car(make="Make %d" % (i // 100), model="Model %d" % i)
+            for i in range(cars)
+        ],
+        batch_size=1000,
+    )
+    ids = list(Car.objects.values_list("id", flat=True))
+    ratings = [
+        (car_id, random.randint(1, 5))
+        for car_id in ids
+        for _ in range(random.randint(1, 5))
+    ]
+    for i in range(0, len(ratings), 5000):
+        Rating.bulk_add(ratings[i : i + 5000])
+
+
+def walk(client: Client, url: str) -> tuple:
+    """
+    Fetch every page, returns (rows, seconds, contents)
+    """
+    rows, contents = 0, []
+    start = time.perf_counter()
+    while url:
+        response = client.get(url)
+        data = response.json()
+        rows += len(data["data"])
+        contents.append(response.content)
+        url = data["next"]
+    return rows, time.perf_counter() - start, contents
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cars", type=int, default=20000)
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    with test_database() as db, override_settings(
+        ALLOWED_HOSTS=["testserver"],
+        LEADERBOARD_SIZE=0,
+        MAX_PAGE_SIZE=args.page_size,
+    ):
+        seed(args.cars)
+        client = Client()
+        print(
+            "%s, %d cars, %d ratings, pages of %d, orjson %s"
+            % (
+                db.vendor,
+                Car.objects.count(),
+                Rating.objects.count(),
+                args.page_size,
+                "installed" if renderers.orjson else "not installed",
+            )
+        )
+        for endpoint in ["/cars/", "/rate/", "/popular/"]:
+            url = "%s?page_size=%d" % (endpoint, args.page_size)
+            results = {}
+            for fast in (0, 1):
+                with override_settings(FAST_LIST=fast):
+                    walk(client, url)  # warm up
+                    results[fast] = walk(client, url)
+            assert results[0][2] == results[1][2], "responses differ"
+            print(
+                "  %-10s serializers: %8.0f rows/s   FAST_LIST: %8.0f rows/s"
+                % (
+                    endpoint,
+                    results[0][0] / results[0][1],
+                    results[1][0] / results[1][1],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""
+Load test of the API endpoints on synthetic datasets of several sizes
+
+For every dataset size: seeds a throwaway SQLite database (see
+benchmarks.seed), starts gunicorn on it with NHTSA replaced by a local
+stub, and sends every scenario's requests at every concurrency level.
+Reports req/s and p50, p95 & p99 latency, and writes them to a JSON
+file. With --baseline the results are compared to an earlier file and
+the exit status is 1 when any scenario got slower than --tolerance.
+
+Scenarios:
+    list_cars:     GET /cars/, pages starting at random cars
+    popular:       GET /popular/, first page
+    rate:          POST /rate/, random cars and stars
+    create_car:    POST /cars/, new cars, 10 per make
+
+Usage: python -m benchmarks.loadtest [--sizes 10000 100000 ...]
+           [--concurrency 1 8 32] [--requests 1000] [--server wsgi|asgi]
+           [--output loadtest.json] [--baseline previous.json]
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from threading import local
+
+import requests
+
+from benchmarks.common import gunicorn, manage, server_env
+from carapi.tests.nhtsa_stub import NhtsaStub
+
+SERVERS = {
+    "wsgi": ["project.wsgi", "--worker-class", "sync"],
+    "asgi": [
+        "project.asgi",
+        "--worker-class",
+        "uvicorn.workers.UvicornWorker",
+    ],
+}
+SCENARIOS = ("list_cars", "popular", "rate", "create_car")
+PERCENTILES = (50, 95, 99)
+# Makes of the cars added by create_car, known to the stub,
+# with 10 models each
+NEW_MAKES = 10000
+
+
+def cursor(car_id: int) -> str:
+    """
+    Cursor of the page of GET /cars/ starting after the car,
+    see pagination.KeysetPagination
+    """
+    return base64.urlsafe_b64encode(json.dumps([car_id]).encode()).decode()
+
+
+class Scenario:
+    """
+    Builds the requests of the scenarios
+
+    Attributes:
+        cars (int):        Number of seeded cars, their IDs are 1..cars
+        prefix (str):      Prefix of the paths of the writes, "/async"
+                           for the async views under ASGI
+        new_cars (count):  Number of the next car of create_car
+    """
+
+    def __init__(self, cars: int, server: str) -> None:
+        self.cars = cars
+        self.prefix = "/async" if server == "asgi" else ""
+        self.new_cars = itertools.count()
+
+    def request(self, name: str, rng: random.Random) -> tuple:
+        """
+        Returns (method, path, JSON body) of a request of the scenario
+        """
+        if name == "list_cars":
+            car_id = rng.randrange(self.cars)
+            return "GET", "/cars/?cursor=" + cursor(car_id), None
+        if name == "popular":
+            return "GET", "/popular/", None
+        if name == "rate":
+            return (
+                "POST",
+                self.prefix + "/rate/",
+                {
+                    "car_id": rng.randint(1, self.cars),
+                    "rating": rng.randint(1, 5),
+                },
+            )
+        # Every car is new, every 10th car of a new make
+        i = next(self.new_cars)
+        return (
+            "POST",
+            self.prefix + "/cars/",
+            {"make": "New%d" % (i // 10 % NEW_MAKES), "model": "Model%d" % i},
+        )
+
+
+def percentile(latencies: list, p: int) -> float:
+    """
+    Nearest-rank percentile of sorted latencies, in milliseconds
+    """
+    rank = max(math.ceil(p / 100 * len(latencies)), 1)
+    return round(latencies[rank - 1] * 1000, 2)
+
+
+def load(base: str, scenario: Scenario, name: str, args, level: int) -> dict:
+    """
+    Sends args.requests requests of the scenario, level at a time
+    """
+    sessions = local()
+
+    def send(i: int) -> tuple:
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        method, path, body = scenario.request(name, random.Random(i))
+        start = time.perf_counter()
+        try:
+            status = sessions.session.request(
+                method, base + path, json=body, timeout=60
+            ).status_code
+        except requests.RequestException:
+            status = "error"
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=level) as pool:
+        results = list(pool.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    statuses = Counter(str(status) for status, _ in results)
+    result = {
+        "scenario": name,
+        "concurrency": level,
+        "requests": args.requests,
+        "errors": sum(
+            n for status, n in statuses.items() if not status.startswith("2")
+        ),
+        "statuses": dict(statuses),
+        "req_per_s": round(args.requests / elapsed, 1),
+    }
+    for p in PERCENTILES:
+        result["p%d_ms" % p] = percentile(latencies, p)
+    return result
+
+
+def run_size(ratings: int, args) -> list:
+    """
+    Seeds a dataset of the given size and load tests it
+    """
+    cars = max(ratings // args.ratings_per_car, 100)
+    catalog = {
+        "New%d" % make: ["Model%d" % (make * 10 + i) for i in range(10)]
+        for make in range(NEW_MAKES)
+    }
+    with NhtsaStub(
+        catalog, delay=args.nhtsa_delay
+    ) as stub, tempfile.TemporaryDirectory() as directory:
+        env = server_env(directory, stub.url)
+        manage(env, "migrate", "--run-syncdb", "-v", "0")
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.seed"]
+            + ["--ratings", str(ratings), "--cars", str(cars)],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        seed_seconds = round(time.perf_counter() - start, 1)
+
+        results = []
+        scenario = Scenario(cars, args.server)
+        with gunicorn(env, SERVERS[args.server], args.workers) as base:
+            for name in args.scenarios:
+                for level in args.concurrency:
+                    result = dict(
+                        load(base, scenario, name, args, level),
+                        ratings=ratings,
+                        cars=cars,
+                        seed_s=seed_seconds,
+                    )
+                    print(
+                        "  {ratings} ratings {scenario} x{concurrency}: "
+                        "{req_per_s} req/s, p50 {p50_ms} ms, p95 {p95_ms} ms,"
+                        " p99 {p99_ms} ms, {errors} errors".format(**result)
+                    )
+                    results.append(result)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """
+    Returns a message for every result slower than its counterpart
+    in the baseline: fewer req/s or a higher p95 latency
+    """
+    previous = {
+        (r["ratings"], r["scenario"], r["concurrency"]): r
+        for r in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        key = (result["ratings"], result["scenario"], result["concurrency"])
+        before = previous.get(key)
+        if before is None:
+            continue
+        if result["req_per_s"] < before["req_per_s"] * (1 - tolerance):
+            regressions.append(
+                "{} {} x{}: {} req/s, was {}".format(
+                    *key, result["req_per_s"], before["req_per_s"]
+                )
+            )
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                "{} {} x{}: p95 {} ms, was {}".format(
+                    *key, result["p95_ms"], before["p95_ms"]
+                )
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="Numbers of ratings to seed, e.g. 10000 ... 10000000",
+    )
+    parser.add_argument("--ratings-per-car", type=int, default=100)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 8, 32]
+    )
+    parser.add_argument(
+        "--requests", type=int, default=1000, help="Per scenario and level"
+    )
+    parser.add_argument("--server", choices=SERVERS, default="wsgi")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Server processes, SQLite fails writes of concurrent processes",
+    )
+    parser.add_argument(
+        "--nhtsa-delay",
+        type=float,
+        default=0.0,
+        help="Stub response delay (s)",
+    )
+    parser.add_argument("--output", default="loadtest.json")
+    parser.add_argument("--baseline", help="Results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Slowdown vs. the baseline reported as a regression",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for ratings in args.sizes:
+        print("Dataset of %d ratings" % ratings)
+        results.extend(run_size(ratings, args))
+
+    report = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print("Regression:", message)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of the NHTSA client against a local stub server
+
+Compares a bare requests.get() per validation (the old behaviour) with
+the pooled keep-alive session, and concurrent lookups of the same make
+with and without single-flight coalescing.
+
+Usage: python -m benchmarks.nhtsa_client [--requests 200] [--threads 32]
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+import requests  # noqa: E402
+from django.test import override_settings  # noqa: E402
+
+from carapi import nhtsa  # noqa: E402
+from carapi.tests.nhtsa_stub import NhtsaStub  # noqa: E402
+
+
+def bare_fetch(make: str) -> None:
+    """
+    The request check_nhtsa_api used to make: a new connection every time
+    """
+    from django.conf import settings
+
+    requests.get(
+        settings.NHTSA_API_URL + "GetModelsForMake/" + make + "?format=json",
+        timeout=5,
+    ).json()
+
+
+def sequential(stub: NhtsaStub, fetch, count: int) -> dict:
+    stub.reset()
+    start = time.perf_counter()
+    for _ in range(count):
+        fetch("toyota")
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": stub.requests,
+        "connections": stub.connections,
+        "req_per_s": round(count / elapsed, 1),
+    }
+
+
+def concurrent(stub: NhtsaStub, fetch, threads: int) -> dict:
+    stub.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda _: fetch("toyota"), range(threads)))
+    return {
+        "lookups": threads,
+        "upstream_requests": stub.requests,
+        "elapsed_s": round(time.perf_counter() - start, 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument(
+        "--delay", type=float, default=0.2, help="Stub response delay (s)"
+    )
+    args = parser.parse_args()
+
+    models = ["Model %d" % i for i in range(50)]
+    with NhtsaStub({"Toyota": models}) as stub, override_settings(
+        NHTSA_API_URL=stub.url
+    ):
+        print("Connection reuse, %d sequential lookups" % args.requests)
+        print(
+            "  bare requests.get:", sequential(stub, bare_fetch, args.requests)
+        )
+        print(
+            "  pooled session:   ",
+            sequential(stub, nhtsa.fetch_model_names, args.requests),
+        )
+
+        stub.delay = args.delay
+        flight = nhtsa.SingleFlight()
+        print(
+            "Coalescing, %d concurrent lookups of one make, %.1fs upstream"
+            % (args.threads, args.delay)
+        )
+        print(
+            "  without single-flight:",
+            concurrent(stub, nhtsa.fetch_model_names, args.threads),
+        )
+        print(
+            "  with single-flight:   ",
+            concurrent(
+                stub,
+                lambda make: flight.do(make, nhtsa.fetch_model_names, make),
+                args.threads,
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
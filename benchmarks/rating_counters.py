@@ -0,0 +1,82 @@
+"""
+Benchmark of concurrent ratings of a single (hot) car
+
+Compares updating the Car row directly with spreading the updates over
+RatingShard counters, then folds the shards and checks the totals.
+Runs against a throwaway database created from DATABASE_URL, the
+difference shows on Postgres, SQLite serializes all writers anyway.
+
+Usage: python -m benchmarks.rating_counters [--threads 16] [--shards 8]
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import setup_django, test_database
+
+setup_django()
+
+from django.db import OperationalError, connection  # noqa: E402
+from django.test import override_settings  # noqa: E402
+
+from carapi.models import Car, RatingShard  # noqa: E402
+
+
+def rate(car_id: int, count: int) -> None:
+    """
+    Add count ratings one by one, like count POST /rate/ requests
+    """
+    try:
+        for i in range(count):
+            while True:
+                try:
+                    Car.add_ratings(car_id, {i % 5 + 1: 1})
+                    break
+                except OperationalError:
+                    # database is locked (SQLite)
+                    time.sleep(0.001)
+    finally:
+        connection.close()
+
+
+def run(make: str, shards: int, threads: int, ratings: int) -> dict:
+    car = Car.objects.create(make=make, model="Hot")
+    with override_settings(RATING_SHARDS=shards):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lambda _: rate(car.id, ratings), range(threads)))
+        elapsed = time.perf_counter() - start
+    RatingShard.fold(car.id)
+    car.refresh_from_db()
+    assert car.rates_number == threads * ratings, "lost updates"
+    return {
+        "shards": shards,
+        "ratings": car.rates_number,
+        "ratings_per_s": round(car.rates_number / elapsed, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument(
+        "--ratings", type=int, default=200, help="Ratings per thread"
+    )
+    parser.add_argument("--shards", type=int, default=8)
+    args = parser.parse_args()
+
+    with test_database() as db:
+        print(
+            "%s, %d threads x %d ratings of one car"
+            % (db.vendor, args.threads, args.ratings)
+        )
+        print("  single row:", run("Single", 0, args.threads, args.ratings))
+        print(
+            "  sharded:   ",
+            run("Sharded", args.shards, args.threads, args.ratings),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Fills the database with a synthetic dataset of cars and ratings
+
+Car popularity follows a Zipf-like distribution, so a few cars get most
+of the ratings like in production. Ratings are inserted in chunks with
+plain INSERTs, and the rating counters of the cars are set to match,
+so that 10M ratings take minutes rather than hours.
+Run against an empty, migrated database, see benchmarks.loadtest.
+
+Usage: python -m benchmarks.seed --ratings 100000 [--cars 1000]
+"""
+
+import argparse
+import random
+import time
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from django.db import connection, transaction  # noqa: E402
+
+from carapi.management.commands.reconcile_ratings import (  # noqa: E402
+    expected_counters,
+)
+from carapi.models import STARS, Car, Rating  # noqa: E402
+
+# Share of every star among the ratings
+STAR_WEIGHTS = (10, 8, 17, 30, 35)
+CHUNK_SIZE = 50000
+
+
+def seed(ratings: int, cars: int, seed: int = 0) -> dict:
+    """
+    Inserts the cars and ratings, returns the numbers inserted
+
+    Keyword arguments:
+        ratings (int):     Number of ratings
+        cars (int):        Number of cars
+        seed (int):        Seed of the random generator
+    """
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    Car.objects.bulk_create(
+        [
+            Car(make="Make%d" % (i // 10), model="Model%d" % i)
+            for i in range(cars)
+        ],
+        batch_size=1000,
+    )
+    car_ids = list(Car.objects.order_by("id").values_list("id", flat=True))
+    popularity = [1.0 / (rank + 1) ** 0.8 for rank in range(cars)]
+    rng.shuffle(popularity)
+    histograms = [dict.fromkeys(STARS, 0) for _ in range(cars)]
+
+    insert = "INSERT INTO {} ({}, {}) VALUES (%s, %s)".format(
+        Rating._meta.db_table,
+        Rating._meta.get_field("car_id").column,
+        Rating._meta.get_field("rating").column,
+    )
+    left = ratings
+    while left:
+        size = min(left, CHUNK_SIZE)
+        indexes = rng.choices(range(cars), weights=popularity, k=size)
+        stars = rng.choices(STARS, weights=STAR_WEIGHTS, k=size)
+        for index, star in zip(indexes, stars):
+            histograms[index][star] += 1
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(
+                insert,
+                [
+                    (car_ids[index], star)
+                    for index, star in zip(indexes, stars)
+                ],
+            )
+        left -= size
+
+    updated = []
+    for car_id, histogram in zip(car_ids, histograms):
+        counters = expected_counters(histogram)
+        if not counters["rates_number"]:
+            continue
+        updated.append(Car(id=car_id, **counters))
+    with transaction.atomic():
+        Car.objects.bulk_update(
+            updated, list(expected_counters({})), batch_size=1000
+        )
+    return {
+        "cars": cars,
+        "ratings": ratings,
+        "seconds": round(time.perf_counter() - start, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--ratings", type=int, default=100000)
+    parser.add_argument(
+        "--cars", type=int, help="Number of cars (default ratings / 100)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cars = args.cars or max(args.ratings // 100, 100)
+    print("Seeded", seed(args.ratings, cars, args.seed))
+
+
+if __name__ == "__main__":
+    main()
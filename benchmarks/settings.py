@@ -0,0 +1,19 @@
+"""
+Settings of the servers started by the benchmarks: project settings,
+with the SQLite database at BENCHMARK_DATABASE, and the backend
+BENCHMARK_DATABASE_ENGINE (see carapi.db.sqlite)
+"""
+
+import os
+
+from project.settings import *  # noqa: F401,F403
+from project.settings import DATABASES
+
+DATABASES["default"] = {
+    "ENGINE": os.environ.get(
+        "BENCHMARK_DATABASE_ENGINE", "django.db.backends.sqlite3"
+    ),
+    "NAME": os.environ["BENCHMARK_DATABASE"],
+    # Concurrent workers wait for each other's writes
+    "OPTIONS": {"timeout": 30},
+}
@@ -0,0 +1,111 @@
+"""
+Benchmark of POST /rate/ on SQLite, stock backend vs. carapi.db.sqlite
+
+Seeds a throwaway database for each backend and starts gunicorn on it
+with threaded workers, then sends rating requests for random cars from
+many clients at once. With the stock backend, the threads compete for
+the write lock: they back off with growing sleeps, and fail with
+"database is locked" (500) when their transaction read before writing.
+The tuned backend queues the writes of a process instead.
+
+Usage: python -m benchmarks.sqlite_writes [--requests 2000]
+           [--concurrency 32] [--workers 4] [--threads 8]
+"""
+
+import argparse
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+
+import requests
+
+from benchmarks.common import gunicorn, manage, server_env
+from benchmarks.loadtest import PERCENTILES, percentile
+
+ENGINES = {
+    "stock": "django.db.backends.sqlite3",
+    "tuned": "carapi.db.sqlite",
+}
+CARS = 1000
+
+
+def run(env: dict, args) -> dict:
+    """
+    Start the server, send the requests, stop the server
+    """
+    sessions = local()
+
+    def post(i: int) -> tuple:
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        rng = random.Random(i)
+        start = time.perf_counter()
+        try:
+            status = sessions.session.post(
+                base + "/rate/",
+                json={
+                    "car_id": rng.randint(1, CARS),
+                    "rating": rng.randint(1, 5),
+                },
+                timeout=120,
+            ).status_code
+        except requests.RequestException:
+            status = "error"
+        return status, time.perf_counter() - start
+
+    server_args = ["project.wsgi", "--worker-class", "gthread"]
+    server_args += ["--threads", str(args.threads)]
+    with gunicorn(env, server_args, args.workers) as base:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(post, range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    result = {
+        "statuses": dict(Counter(str(status) for status, _ in results)),
+        "req_per_s": round(args.requests / elapsed, 1),
+    }
+    for p in PERCENTILES:
+        result["p%d_ms" % p] = percentile(latencies, p)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--threads", type=int, default=8, help="Threads per worker"
+    )
+    args = parser.parse_args()
+
+    print(
+        "%d POST /rate/ requests, %d concurrent, %d workers of %d threads"
+        % (args.requests, args.concurrency, args.workers, args.threads)
+    )
+    for name, engine in ENGINES.items():
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                server_env(directory, "http://127.0.0.1:9"),
+                BENCHMARK_DATABASE_ENGINE=engine,
+            )
+            manage(env, "migrate", "--run-syncdb", "-v", "0")
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.seed"]
+                + ["--ratings", str(CARS * 10), "--cars", str(CARS)],
+                env=env,
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            print("  %s: %s" % (name, run(env, args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,18 @@
 from django.contrib import admin
-from .models import Car, Rating
+from .models import (
+    Car,
+    Rating,
+    RatingShard,
+    PendingCar,
+    NhtsaMakeCache,
+    NhtsaCatalogEntry,
+)
 
 
 # Register your models here.
 admin.site.register(Car)
 admin.site.register(Rating)
+admin.site.register(RatingShard)
+admin.site.register(PendingCar)
+admin.site.register(NhtsaMakeCache)
+admin.site.register(NhtsaCatalogEntry)
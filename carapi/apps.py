@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CarapiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "carapi"
+
+    def ready(self) -> None:
+        # Installs the database query counter of the request metrics,
+        # and registers the check of the cache of the data versions
+        from . import dataversion, metrics  # noqa: F401
+
+        if settings.RATING_WRITE_BEHIND:
+            # Ratings queued before a restart are flushed from the first
+            # request on, management commands don't start the flusher
+            from . import rating_buffer
+
+            rating_buffer.start_flusher_on_request()
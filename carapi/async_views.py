@@ -0,0 +1,137 @@
+"""
+Async versions of GET & POST /cars/ and POST /rate/, see README
+
+Served natively when running under an ASGI server (project.asgi). While
+a car is validated against NHTSA the worker isn't blocked, see
+nhtsa.avalidate(), so one process serves many requests waiting for
+NHTSA at once. Django 3.2 has no async ORM, so database work runs
+in a thread with sync_to_async().
+
+Requests and responses are the same as those of the viewsets.
+"""
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed
+from rest_framework import exceptions, status
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from . import nhtsa
+from .renderers import FastJSONRenderer
+from .serializers import CarSerializerPost, RatingSerializer
+from .views import CarViewSet, queue_car, save_car, save_rating
+
+PARSERS = (JSONParser, FormParser, MultiPartParser)
+
+# The listing is read from the database only, it runs in a thread
+car_list = CarViewSet.as_view({"get": "list"})
+
+
+def parse(request):
+    """
+    Parse the body of the request like the viewsets do. Returns its data,
+    or raises APIException (e.g. ParseError) for an unreadable body.
+    """
+    return Request(request, parsers=[parser() for parser in PARSERS]).data
+
+
+def render(response: Response) -> HttpResponse:
+    """
+    Render a DRF response as JSON, like the viewsets do
+    """
+    response.accepted_renderer = FastJSONRenderer()
+    response.accepted_media_type = FastJSONRenderer.media_type
+    response.renderer_context = {}
+    return response.render()
+
+
+def failed(error: exceptions.APIException) -> HttpResponse:
+    """
+    Render an error of the request, like DRF's exception handler does
+    for the viewsets
+    """
+    return render(Response({"detail": error.detail}, status=error.status_code))
+
+
+def errors(serializer) -> HttpResponse:
+    return render(
+        Response(
+            {"status": "error", "data": serializer.errors},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    )
+
+
+async def cars(request):
+    """
+    Allows listing: GET /async/cars/?cursor=..&page_size=..
+    Allows posting: POST /async/cars/{make:str, model:str}
+    """
+    if request.method == "GET":
+        return await sync_to_async(car_list)(request)
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["GET", "POST"])
+
+    try:
+        data = parse(request)
+    except exceptions.APIException as error:
+        return failed(error)
+    serializer = CarSerializerPost(data=data)
+    # Checks that the car doesn't exist yet
+    if not await sync_to_async(serializer.is_valid)():
+        return errors(serializer)
+    if settings.CAR_VALIDATION_QUEUE:
+        return render(await sync_to_async(queue_car)(request, serializer))
+    try:
+        exists = await nhtsa.avalidate(data["make"], data["model"])
+    except nhtsa.NhtsaUnavailable as error:
+        return render(
+            Response(
+                {"status": "error", "data": str(error)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        )
+    if not exists:
+        return render(
+            Response(
+                {
+                    "status": "error",
+                    "data": (
+                        data["make"] + " " + data["model"] + " doesn't exist"
+                    ),
+                },
+                status=status.HTTP_406_NOT_ACCEPTABLE,
+            )
+        )
+    await sync_to_async(save_car)(serializer)
+    return render(
+        Response(
+            {"status": "success", "data": serializer.data},
+            status=status.HTTP_201_CREATED,
+        )
+    )
+
+
+async def rate(request):
+    """
+    Allows posting: POST /async/rate/{car_id:int, rating:int}
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    try:
+        serializer = RatingSerializer(data=parse(request))
+    except exceptions.APIException as error:
+        return failed(error)
+    # Looks the car up
+    if not await sync_to_async(serializer.is_valid)():
+        return errors(serializer)
+    return render(await sync_to_async(save_rating)(serializer))
+
+
+# DRF views are exempt from CSRF checks (without session authentication),
+# csrf_exempt() can't wrap coroutine functions before Django 4.1
+cars.csrf_exempt = True
+rate.csrf_exempt = True
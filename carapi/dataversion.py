@@ -0,0 +1,147 @@
+"""
+Data version markers for conditional GET requests (ETag / Last-Modified)
+
+Every scope of data has a random version token and a modification time
+in the shared Django cache, replaced by bump() whenever a write changes
+the data. Listings of a scope answer If-None-Match and If-Modified-Since
+with 304 Not Modified from these alone, before querying or serializing
+anything, see conditional().
+
+Scopes:
+    cars:      Cars and their rating counters, GET /cars/ and /popular/
+    ratings:   Ratings, GET /rate/
+
+and the leaderboard of /popular/ kept by every worker, see leaderboard.py
+
+Every listing reads these keys and every write replaces some, so the
+shared cache mustn't be the database itself: a database cache turns them
+into the hottest rows of the database, see check_cache().
+"""
+
+import hashlib
+import logging
+import math
+import time
+import uuid
+from functools import wraps
+
+from django.core import checks
+from django.core.cache import cache, caches
+from django.core.cache.backends.db import BaseDatabaseCache
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from . import replicas
+
+logger = logging.getLogger(__name__)
+
+KEY = "carapi:dataversion:"
+
+
+def current(scopes) -> list:
+    """
+    Returns the (token, modified) versions of the given scopes.
+    Scopes without a version yet (or evicted) get a new one.
+    """
+    keys = [KEY + scope for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # add() so that concurrent requests agree on the version
+            version = (uuid.uuid4().hex, time.time())
+            if not cache.add(key, version, None):
+                # Evicted or replaced again since, any new version does
+                version = cache.get(key, version)
+            versions[key] = version
+    return [versions[key] for key in keys]
+
+
+@checks.register(checks.Tags.caches)
+def check_cache(app_configs, **kwargs) -> list:
+    """
+    Warns when the data versions are kept in a database table
+    """
+    if not isinstance(caches["default"], BaseDatabaseCache):
+        return []
+    return [
+        checks.Warning(
+            "The data versions are kept in the database cache, every "
+            "listing and every write queries it.",
+            hint="Set CACHE_URL to file:///path or memcached://host:port.",
+            id="carapi.W001",
+        )
+    ]
+
+
+def replace(*scopes) -> None:
+    """
+    Marks the data of the given scopes as changed now
+    """
+    version = (uuid.uuid4().hex, time.time())
+    cache.set_many({KEY + scope: version for scope in scopes}, None)
+
+
+def bump(*scopes) -> None:
+    """
+    Marks the data of the given scopes as changed, once the current
+    transaction is committed
+    """
+
+    def call() -> None:
+        try:
+            replace(*scopes)
+        except Exception:
+            logger.exception("Bumping the data version failed")
+
+    transaction.on_commit(call)
+
+
+def conditional(*scopes):
+    """
+    Decorator of viewset actions serving data of the given scopes.
+    Returns 304 Not Modified when the client's copy is current, and
+    sets the ETag & Last-Modified headers of successful responses.
+    The ETag depends on the URL (query) and the rendered media type.
+    Responses read from a replica right after a write may miss it, they
+    get neither header, see replicas.caught_up().
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            versions = current(scopes)
+            # Reused by response_cache.cached()
+            request.data_versions = dict(zip(scopes, versions))
+            digest = hashlib.md5(
+                "\n".join(
+                    [token for token, _ in versions]
+                    + [request.get_full_path(), request.accepted_media_type]
+                ).encode()
+            ).hexdigest()
+            etag = '"{}"'.format(digest)
+            modified = max(modified for _, modified in versions)
+            # Last-Modified has a resolution of a second, it's only sent
+            # once that second is over, so later writes always change it
+            last_modified = (
+                math.floor(modified)
+                if math.floor(modified) < math.floor(time.time())
+                else None
+            )
+            response = get_conditional_response(
+                request, etag=etag, last_modified=last_modified
+            )
+            if response is not None:
+                response["ETag"] = etag
+                return response
+
+            response = func(self, request, *args, **kwargs)
+            if response.status_code == 200 and replicas.caught_up(modified):
+                response["ETag"] = etag
+                if last_modified is not None:
+                    response["Last-Modified"] = http_date(last_modified)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,284 @@
+"""
+Pool of database connections shared by the threads of a process
+
+Django opens a connection per thread, kept open for CONN_MAX_AGE seconds.
+Connections then add up to workers x threads, and the ones idle for a
+long time fail at their next query (closed by the server or a proxy).
+With PooledDatabaseWrapperMixin, Django's connections are borrowed from
+a ConnectionPool at the first query of a request, and given back at its
+end (CONN_MAX_AGE = 0). A process keeps at most max_size connections,
+threads wait up to timeout seconds for one when all are in use.
+
+Borrowed connections are checked first: connections older than
+max_lifetime or idle for more than max_idle seconds are replaced, and
+the others are pinged with "SELECT 1" (pre_ping). Connections given back
+in a transaction are rolled back, unusable ones are closed.
+
+Pools are configured with OPTIONS["pool"] of the database, see
+DATABASE_POOL in project/settings.py. Waiting time, timeouts and new
+connections are reported at /metrics.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+from django.db import OperationalError
+
+from .. import metrics
+
+DEFAULTS = {
+    "max_size": 10,
+    "timeout": 10.0,
+    "max_lifetime": 1800.0,
+    "max_idle": 300.0,
+    "pre_ping": True,
+}
+
+
+class PoolTimeout(OperationalError):
+    """
+    No connection was given back to the pool within its timeout
+    """
+
+
+class ConnectionPool:
+    """
+    Bounded pool of connections, reused most recently returned first
+
+    Attributes:
+        name (str):           Label of the metrics, the database alias
+        ping (callable):      Returns whether a connection is usable
+        reset (callable):     Readies a returned connection for reuse,
+                              returns False when it's unusable
+        close (callable):     Closes a connection
+        max_size (int):       Maximum number of open connections
+        timeout (float):      Seconds to wait for a connection
+        max_lifetime (float): Seconds after which connections are replaced
+        max_idle (float):     Seconds of idleness after which connections
+                              are replaced
+        pre_ping (bool):      Whether to ping connections before lending
+                              them
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ping,
+        reset,
+        close,
+        max_size: int = DEFAULTS["max_size"],
+        timeout: float = DEFAULTS["timeout"],
+        max_lifetime: float = DEFAULTS["max_lifetime"],
+        max_idle: float = DEFAULTS["max_idle"],
+        pre_ping: bool = DEFAULTS["pre_ping"],
+    ) -> None:
+        self.name = name
+        self.ping = ping
+        self.reset = reset
+        self.close = close
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.pre_ping = pre_ping
+        # (connection, opened at, returned at), last returned at the end
+        self._idle: deque = deque()
+        # id(connection) -> opened at, of the lent connections
+        self._lent: dict = {}
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def get(self, connect):
+        """
+        Lend a connection, opening one with connect() if none is idle and
+        the pool isn't full. Raises PoolTimeout when none is available
+        within timeout.
+        """
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.inc("db_pool_timeouts_total", self.name)
+                        raise PoolTimeout(
+                            "No connection available in the pool of {} "
+                            "within {}s ({} connections in use)".format(
+                                self.name, self.timeout, self.max_size
+                            )
+                        )
+                    self._condition.wait(remaining)
+                if self._idle:
+                    connection, opened, returned = self._idle.pop()
+                else:
+                    connection, opened, returned = None, None, None
+                    self._size += 1
+
+            if connection is None:
+                try:
+                    connection = connect()
+                except Exception:
+                    self._discard(None)
+                    raise
+                opened = time.monotonic()
+                metrics.inc("db_pool_connects_total", self.name)
+            elif not self.usable(connection, opened, returned):
+                self._discard(connection)
+                continue
+            break
+
+        with self._condition:
+            self._lent[id(connection)] = opened
+        metrics.observe(
+            "db_pool_wait_seconds", time.perf_counter() - start, self.name
+        )
+        return connection
+
+    def usable(self, connection, opened: float, returned: float) -> bool:
+        """
+        Return whether an idle connection can be lent again
+        """
+        now = time.monotonic()
+        if now - opened > self.max_lifetime or now - returned > self.max_idle:
+            return False
+        return not self.pre_ping or self.ping(connection)
+
+    def put(self, connection, reusable: bool = True) -> None:
+        """
+        Take a lent connection back, closing it when it's not reusable,
+        unusable or too old
+        """
+        with self._condition:
+            opened = self._lent.pop(id(connection))
+        expired = time.monotonic() - opened > self.max_lifetime
+        if not reusable or expired or not self.reset(connection):
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, opened, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, connection) -> None:
+        if connection is not None:
+            try:
+                self.close(connection)
+            except Exception:
+                pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def clear(self) -> None:
+        """
+        Close the idle connections
+        """
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+    def info(self) -> dict:
+        with self._condition:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": len(self._lent),
+                "max_size": self.max_size,
+            }
+
+
+_pools: dict = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key: tuple, create) -> ConnectionPool:
+    """
+    Return the pool of the given key in this process, a new one after a
+    fork (connections can't be shared by processes)
+    """
+    key = (os.getpid(),) + key
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = create()
+        return _pools[key]
+
+
+def clear_pools() -> None:
+    """
+    Close the idle connections of all the pools of this process
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.clear()
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Borrows the connections of a Django database backend from a pool,
+    and gives them back instead of closing them. Connections with other
+    parameters (e.g. to the test database) come from another pool.
+    """
+
+    _pool = None
+
+    def get_connection_params(self) -> dict:
+        params = super().get_connection_params()
+        params.pop("pool", None)
+        return params
+
+    def get_pool(self, conn_params: dict) -> ConnectionPool:
+        def create() -> ConnectionPool:
+            options = dict(
+                DEFAULTS, **self.settings_dict["OPTIONS"].get("pool", {})
+            )
+            return ConnectionPool(
+                self.alias,
+                self.ping,
+                self.reset,
+                lambda connection: connection.close(),
+                **options,
+            )
+
+        key = tuple(sorted((k, repr(v)) for k, v in conn_params.items()))
+        return get_pool((self.alias,) + key, create)
+
+    def get_new_connection(self, conn_params):
+        self._pool = self.get_pool(conn_params)
+        return self._pool.get(
+            lambda: super(PooledDatabaseWrapperMixin, self).get_new_connection(
+                conn_params
+            )
+        )
+
+    @staticmethod
+    def ping(connection) -> bool:
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def reset(connection) -> bool:
+        try:
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self) -> None:
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # Closed within a transaction, Django keeps referencing it
+                self._pool.put(
+                    self.connection, reusable=not self.in_atomic_block
+                )
@@ -0,0 +1,47 @@
+"""
+PostgreSQL backend borrowing its connections from a pool shared by the
+threads of the process, ENGINE "carapi.db.postgresql", see carapi.db.pool
+"""
+
+from django.db.backends.postgresql import base, creation
+from psycopg2 import extensions
+
+from ..pool import PooledDatabaseWrapperMixin, clear_pools
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity) -> None:
+        # Idle connections to the test database would prevent its removal
+        clear_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        # Only set by Django for the connections it opens itself
+        self.isolation_level = self.settings_dict["OPTIONS"].get(
+            "isolation_level", connection.isolation_level
+        )
+        return connection
+
+    @staticmethod
+    def reset(connection) -> bool:
+        """
+        Roll back the transaction left open, if any, without a round trip
+        to the server otherwise
+        """
+        if connection.closed:
+            return False
+        status = connection.get_transaction_status()
+        if status == extensions.TRANSACTION_STATUS_IDLE:
+            return True
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            connection.rollback()
+            return True
+        except base.Database.Error:
+            return False
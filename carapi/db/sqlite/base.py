@@ -0,0 +1,189 @@
+"""
+SQLite backend tuned for concurrent writes, ENGINE "carapi.db.sqlite"
+
+Every new connection is set up with the PRAGMAS below: WAL journaling,
+so that reads don't wait for writes, fewer fsyncs, and larger caches.
+OPTIONS["pragmas"] overrides them, OPTIONS["timeout"] is the number of
+seconds a write waits for the database before failing.
+
+SQLite allows a single writer at a time. Threads competing for the
+write lock retry with growing sleeps, and transactions that read before
+writing fail with "database is locked" when another one wrote meanwhile.
+Instead, all the writes of a process wait their turn in a WriterQueue:
+    - transactions start with BEGIN IMMEDIATE, taking the write lock
+      before their first read, once their turn comes
+    - writes outside of transactions take their turn for the statement
+Writers of other processes are still waited for by SQLite, up to the
+timeout.
+"""
+
+import re
+import threading
+import time
+from collections import deque
+
+from django.db import OperationalError
+from django.db.backends.sqlite3 import base
+
+from ... import metrics
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    # Durable at checkpoints rather than every commit with WAL
+    "synchronous": "NORMAL",
+    # KiB when negative
+    "cache_size": -65536,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+TIMEOUT = 20
+WRITE = re.compile(r"^\s*(INSERT|UPDATE|DELETE|REPLACE)\b", re.I)
+
+
+class WriterQueue:
+    """
+    First come, first served lock of the writers of a database file,
+    reentrant for the thread holding it
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._waiters: deque = deque()
+        self._owner = None
+        self._depth = 0
+
+    def acquire(self, timeout: float) -> float:
+        """
+        Wait for the turn of the thread, return the seconds waited.
+        Raises OperationalError after timeout seconds.
+        """
+        me = threading.get_ident()
+        with self._lock:
+            if self._owner == me:
+                self._depth += 1
+                return 0.0
+            if self._owner is None and not self._waiters:
+                self._owner, self._depth = me, 1
+                return 0.0
+            turn = threading.Event()
+            self._waiters.append((me, turn))
+        start = time.perf_counter()
+        if not turn.wait(timeout):
+            with self._lock:
+                if self._owner != me:
+                    self._waiters.remove((me, turn))
+                    raise OperationalError("database is locked")
+        return time.perf_counter() - start
+
+    def release(self) -> None:
+        with self._lock:
+            self._depth -= 1
+            if self._depth:
+                return
+            if self._waiters:
+                # Handed over, so that no thread can cut in line
+                self._owner, turn = self._waiters.popleft()
+                self._depth = 1
+                turn.set()
+            else:
+                self._owner = None
+
+    def waiting(self) -> int:
+        with self._lock:
+            return len(self._waiters)
+
+
+_queues: dict = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(name: str) -> WriterQueue:
+    """
+    Return the writer queue of a database file, shared by all the
+    connections of the process
+    """
+    with _queues_lock:
+        if name not in _queues:
+            _queues[name] = WriterQueue()
+        return _queues[name]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    Attributes:
+        writer (WriterQueue):  Queue of the writers of the database file
+        pragmas (dict):        PRAGMA statements of new connections
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.writer = get_queue(str(self.settings_dict["NAME"]))
+        self.pragmas = dict(
+            PRAGMAS, **self.settings_dict["OPTIONS"].get("pragmas", {})
+        )
+        self.timeout = self.settings_dict["OPTIONS"].get("timeout", TIMEOUT)
+        # Whether the current transaction holds the turn of the thread
+        self._writing = False
+        self.execute_wrappers.append(self.queue_write)
+
+    def get_connection_params(self) -> dict:
+        params = super().get_connection_params()
+        params.pop("pragmas", None)
+        params["timeout"] = self.timeout
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        pragmas = dict(self.pragmas, busy_timeout=int(self.timeout * 1000))
+        for name, value in pragmas.items():
+            conn.execute("PRAGMA {} = {}".format(name, value))
+        return conn
+
+    def wait_turn(self) -> None:
+        waited = self.writer.acquire(self.timeout)
+        metrics.observe("db_write_wait_seconds", waited, self.alias)
+
+    def queue_write(self, execute, sql, params, many, context):
+        """
+        Execute wrapper making writes outside of transactions wait
+        their turn
+        """
+        if not self.get_autocommit() or not WRITE.match(sql):
+            return execute(sql, params, many, context)
+        self.wait_turn()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.writer.release()
+
+    def _start_transaction_under_autocommit(self) -> None:
+        self.wait_turn()
+        self._writing = True
+        try:
+            self.cursor().execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.end_turn()
+            raise
+
+    def end_turn(self) -> None:
+        if self._writing:
+            self._writing = False
+            self.writer.release()
+
+    def _commit(self) -> None:
+        try:
+            super()._commit()
+        finally:
+            self.end_turn()
+
+    def _rollback(self) -> None:
+        try:
+            super()._rollback()
+        finally:
+            self.end_turn()
+
+    def _close(self) -> None:
+        try:
+            super()._close()
+        finally:
+            self.end_turn()
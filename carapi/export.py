@@ -0,0 +1,123 @@
+"""
+Streaming exports of whole tables, see CarViewSet.export()
+
+Rows are read with QuerySet.iterator(), so only EXPORT_CHUNK_SIZE rows
+are held in memory at a time, encoded as NDJSON (one JSON object per
+line) or CSV, and optionally gzip compressed while they are sent.
+"""
+
+import csv
+import io
+import json
+import zlib
+from typing import Iterator
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+# Encoded rows are sent in pieces of about this many bytes
+FLUSH_SIZE = 65536
+
+
+def ndjson_lines(rows: Iterator[dict], fields: list) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+def csv_lines(rows: Iterator[dict], fields: list) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow([row[field] for field in fields])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+ENCODERS = {"ndjson": ndjson_lines, "csv": csv_lines}
+
+
+def stream(queryset, fields: list, fmt: str) -> Iterator[bytes]:
+    """
+    Yields the rows of the queryset encoded as fmt, in pieces
+    of about FLUSH_SIZE bytes
+    """
+    rows = queryset.values(*fields).iterator(
+        chunk_size=settings.EXPORT_CHUNK_SIZE
+    )
+    pending, size = [], 0
+    first = True
+    for line in ENCODERS[fmt](rows, fields):
+        pending.append(line)
+        size += len(line)
+        # The first row is sent right away
+        if size >= FLUSH_SIZE or first:
+            yield "".join(pending).encode()
+            pending, size = [], 0
+            first = False
+    if pending:
+        yield "".join(pending).encode()
+
+
+def gzip_stream(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """
+    Compresses a stream of bytes on the fly
+    """
+    # wbits 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    first = True
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if first:
+            # Don't hold back the first row until the buffer is full
+            compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+            first = False
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def accepts_gzip(request) -> bool:
+    """
+    Whether the client accepts gzip, per the Accept-Encoding header
+    """
+    for coding in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "x-gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00")
+    return False
+
+
+def export_response(
+    request, queryset, fields: list, fmt: str, filename: str
+) -> StreamingHttpResponse:
+    """
+    Returns a response streaming the rows of the queryset, compressed
+    when the client accepts gzip
+
+    Keyword arguments:
+        request:           The export request
+        queryset:          Rows to export, sorted
+        fields (list):     Names of the exported fields
+        fmt (str):         "ndjson" or "csv"
+        filename (str):    Name of the downloaded file, without extension
+    """
+    chunks = stream(queryset, fields, fmt)
+    gzip = accepts_gzip(request)
+    if gzip:
+        chunks = gzip_stream(chunks)
+    response = StreamingHttpResponse(chunks, content_type=CONTENT_TYPES[fmt])
+    response["Content-Disposition"] = 'attachment; filename="{}.{}"'.format(
+        filename, fmt
+    )
+    if gzip:
+        response["Content-Encoding"] = "gzip"
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
@@ -0,0 +1,178 @@
+"""
+Top LEADERBOARD_SIZE cars by number of ratings, served by GET /popular/
+
+Every worker keeps the leaderboard in memory, loaded from the database
+with one query, so GET /popular/ doesn't sort the Car table on every
+request. Two version tokens in the shared Django cache (dataversion
+scopes) tell the workers when to load it again:
+
+    leaderboard:        Replaced when a write changes the leaderboard
+    leaderboard-reset:  Replaced by invalidate(), when rating counts
+                        were lowered or cars removed
+
+It's also loaded again after LEADERBOARD_TTL seconds.
+
+Writes compare the new rating counts of the cars they changed with the
+leaderboard of their worker once committed, and only replace the version
+when a car is in it or now ranks above its last car, the cutoff. Rating
+counts only grow between resets, so the cutoff only rises: a cutoff
+loaded since the last reset is never above the current one, and the
+cars it lets through are the only ones which can enter the leaderboard.
+Most ratings, of the cars far below it, write nothing to the cache and
+leave the leaderboards of all the workers as they are.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from . import dataversion
+
+logger = logging.getLogger(__name__)
+
+SCOPE = "leaderboard"
+RESET_SCOPE = "leaderboard-reset"
+FIELDS = ("id", "make", "model", "rates_number")
+
+# The leaderboard of this worker, None until loaded
+_board = None
+_load_lock = threading.Lock()
+
+
+def sort_key(row: dict) -> tuple:
+    """
+    Order of /popular/: most ratings first, newest car first among equals
+    """
+    return (row["rates_number"], row["id"])
+
+
+def load(version: str, reset: str) -> dict:
+    """
+    Loads the leaderboard from the database as of the given versions
+    """
+    from .models import Car
+
+    # Compared with the writes, so never read from a lagging replica
+    rows = list(
+        Car.objects.using(DEFAULT_DB_ALIAS)
+        .filter(rates_number__isnull=False)
+        .order_by("-rates_number", "-id")
+        .values(*FIELDS)[: settings.LEADERBOARD_SIZE + 1]
+    )
+    return {
+        "rows": rows[: settings.LEADERBOARD_SIZE],
+        # True when the leaderboard holds all the cars
+        "complete": len(rows) <= settings.LEADERBOARD_SIZE,
+        "version": version,
+        "reset": reset,
+        "loaded": time.monotonic(),
+    }
+
+
+def get(current: bool = True) -> dict:
+    """
+    Returns the leaderboard of this worker, loaded again when outdated.
+    With current False, any leaderboard loaded since the last reset does.
+    """
+    global _board
+    (version, _), (reset, _) = dataversion.current([SCOPE, RESET_SCOPE])
+
+    def usable(board) -> bool:
+        return (
+            board is not None
+            and board["reset"] == reset
+            and (board["version"] == version or not current)
+            and time.monotonic() - board["loaded"] < settings.LEADERBOARD_TTL
+        )
+
+    board = _board
+    if usable(board):
+        return board
+    # One query per worker when threads find it outdated together
+    with _load_lock:
+        board = _board
+        if not usable(board):
+            board = _board = load(version, reset)
+    return board
+
+
+def top() -> dict:
+    """
+    Returns the leaderboard {"rows": [..], "complete": bool}, rows sorted
+    like GET /popular/ and holding the fields of PopularSerializer
+    """
+    return get()
+
+
+def invalidate() -> None:
+    """
+    Drops the leaderboard of all the workers, it's loaded again by the
+    next GET /popular/
+    """
+    global _board
+    dataversion.replace(SCOPE, RESET_SCOPE)
+    _board = None
+
+
+def merge(rows: list) -> None:
+    """
+    Updates the leaderboard for the current rating counts of some cars,
+    when any of them is in it or can enter it
+
+    Keyword arguments:
+        rows (list):       Dicts with the FIELDS of the cars
+    """
+    rows = [row for row in rows if row["rates_number"] is not None]
+    if not rows:
+        return
+    board = get(current=False)
+    if not board["complete"]:
+        ids = {row["id"] for row in board["rows"]}
+        cutoff = min(map(sort_key, board["rows"]), default=None)
+        if not any(
+            row["id"] in ids or (cutoff is not None and sort_key(row) > cutoff)
+            for row in rows
+        ):
+            return
+    # Still a valid cutoff for the next writes, until the next reset
+    dataversion.replace(SCOPE)
+
+
+def refresh(car_ids) -> None:
+    """
+    Merges the rating counts of the given cars, read from the database
+    """
+    from .models import Car
+
+    merge(list(Car.objects.filter(id__in=car_ids).values(*FIELDS)))
+
+
+def rated(car_ids) -> None:
+    """
+    Merges the rating counts of the given cars once the current
+    transaction is committed
+    """
+    on_commit(refresh, list(car_ids))
+
+
+def on_commit(func, *args) -> None:
+    """
+    Calls one of the functions above once the current transaction is
+    committed. The write is done by then, so a failure only invalidates
+    the leaderboard, if possible, and is logged.
+    """
+
+    def call() -> None:
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("Updating the leaderboard failed")
+            try:
+                invalidate()
+            except Exception:
+                pass
+
+    transaction.on_commit(call)
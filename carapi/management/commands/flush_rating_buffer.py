@@ -0,0 +1,42 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...rating_buffer import get_buffer
+
+
+class Command(BaseCommand):
+    """
+    Writes the ratings queued by RATING_WRITE_BEHIND to the database
+    Usage: python manage.py flush_rating_buffer [--loop] [--batch 500]
+    """
+
+    help = "Flush the write-behind rating buffer"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=settings.RATING_FLUSH_BATCH,
+            help="Maximum number of ratings written per transaction",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep flushing every RATING_FLUSH_INTERVAL seconds",
+        )
+
+    def handle(self, *args, **options) -> None:
+        buffer = get_buffer()
+        while True:
+            flushed = buffer.flush_all(options["batch"])
+            if options["verbosity"] > 0 and (flushed or not options["loop"]):
+                self.stdout.write(
+                    "Flushed {} ratings, {} pending".format(
+                        flushed, buffer.pending()["pending"]
+                    )
+                )
+            if not options["loop"]:
+                return
+            time.sleep(max(settings.RATING_FLUSH_INTERVAL, 0.1))
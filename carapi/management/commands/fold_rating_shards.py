@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import RatingShard
+
+
+class Command(BaseCommand):
+    """
+    Moves the ratings counted by RatingShards to Car.avg_rating & rates_number
+    Usage: python manage.py fold_rating_shards [--loop [--interval 5]]
+    """
+
+    help = "Fold sharded rating counters into the Car rows"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep folding every --interval seconds",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5.0,
+            help="Seconds between folds with --loop",
+        )
+
+    def handle(self, *args, **options) -> None:
+        while True:
+            cars = folded = 0
+            car_ids = (
+                RatingShard.objects.filter(rates_number__gt=0)
+                .values_list("car_id", flat=True)
+                .distinct()
+            )
+            for car_id in list(car_ids):
+                folded += RatingShard.fold(car_id)
+                cars += 1
+            if options["verbosity"] > 0 and (cars or not options["loop"]):
+                self.stdout.write(
+                    "Folded {} ratings of {} cars".format(folded, cars)
+                )
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,191 @@
+import csv
+import json
+from itertools import islice
+from typing import Iterator
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from ...models import NhtsaCatalogEntry
+from ...nhtsa import normalize
+
+# Between the items of a JSON list
+SEPARATORS = frozenset(" \t\r\n,")
+
+
+def iter_json_results(fp, read_size: int = 65536) -> Iterator[dict]:
+    """
+    Yields the objects of a NHTSA JSON dump one by one, without loading
+    the whole file. Accepts both an API response ({"Results": [...]})
+    and a bare list of results.
+    """
+    decoder = json.JSONDecoder()
+    buf = fp.read(read_size).lstrip()
+    if buf.startswith("{"):
+        # Skip to the "Results" key of an API response
+        while '"Results"' not in buf:
+            chunk = fp.read(read_size)
+            if not chunk:
+                raise CommandError('No "Results" list found')
+            buf = buf[-len('"Results"') :] + chunk
+        buf = buf[buf.index('"Results"') + len('"Results"') :]
+    while "[" not in buf:
+        chunk = fp.read(read_size)
+        if not chunk:
+            raise CommandError("No list of results found")
+        buf += chunk
+    # Position in buf, which is only cut when refilled: cutting it after
+    # every item would copy the rest of it every time
+    pos = buf.index("[") + 1
+
+    while True:
+        while pos < len(buf) and buf[pos] in SEPARATORS:
+            pos += 1
+        if buf.startswith("]", pos):
+            return
+        try:
+            if pos == len(buf):
+                raise ValueError
+            item, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            chunk = fp.read(read_size)
+            if not chunk:
+                raise CommandError("Unexpected end of JSON file")
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+
+
+def iter_rows(path: str, fmt: str) -> Iterator[dict]:
+    """
+    Yields {"Make_Name", "Model_Name"} rows from a CSV, JSON or
+    JSON lines (one result per line) file
+    """
+    with open(path, newline="", encoding="utf-8") as fp:
+        if fmt == "csv":
+            yield from csv.DictReader(fp)
+        elif fmt == "jsonl":
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_results(fp)
+
+
+class Command(BaseCommand):
+    """
+    Imports a NHTSA makes & models dump into the NhtsaCatalogEntry table
+    Usage: python manage.py import_nhtsa_catalog <path> [--prune]
+
+    The file is streamed and written in chunks, every chunk in its own
+    short transaction. Existing entries are never removed while importing,
+    so readers keep validating against the previous snapshot until the
+    new one is complete. With --prune, entries missing from the file are
+    deleted afterwards.
+    """
+
+    help = "Import a NHTSA makes & models dump (CSV, JSON or JSON lines)"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument("path", help="File to import")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "json", "jsonl"],
+            help="File format, guessed from the extension by default",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Number of rows written per transaction",
+        )
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help="Delete entries that are not present in the file",
+        )
+
+    def handle(self, *args, **options) -> None:
+        path = options["path"]
+        fmt = options["format"] or path.rsplit(".", 1)[-1].lower()
+        if fmt == "ndjson":
+            fmt = "jsonl"
+        if fmt not in ("csv", "json", "jsonl"):
+            raise CommandError("Unknown file format: " + fmt)
+
+        started = timezone.now()
+        rows = iter_rows(path, fmt)
+        created = refreshed = skipped = 0
+        while True:
+            chunk = list(islice(rows, options["chunk_size"]))
+            if not chunk:
+                break
+            c, r, s = self.import_chunk(chunk, started)
+            created += c
+            refreshed += r
+            skipped += s
+
+        pruned = 0
+        if options["prune"]:
+            pruned = self.prune(started, options["chunk_size"])
+
+        summary = (
+            "Imported {} new, refreshed {}, skipped {}, pruned {} entries"
+        )
+        self.stdout.write(summary.format(created, refreshed, skipped, pruned))
+
+    def import_chunk(self, chunk: list, started) -> tuple:
+        """
+        Insert new entries of the chunk and mark the existing ones as
+        refreshed. Returns (created, refreshed, skipped) counts.
+        """
+        entries = {}
+        skipped = 0
+        for row in chunk:
+            make = (row.get("Make_Name") or "").strip()
+            model = (row.get("Model_Name") or "").strip()
+            if not make or not model or max(len(make), len(model)) > 100:
+                skipped += 1
+                continue
+            entries[(normalize(make), normalize(model))] = (make, model)
+
+        with transaction.atomic():
+            candidates = NhtsaCatalogEntry.objects.filter(
+                make_key__in={key[0] for key in entries},
+                model_key__in={key[1] for key in entries},
+            ).values_list("make_key", "model_key", "pk")
+            existing = {(make, model): pk for make, model, pk in candidates}
+            refreshed = [pk for key, pk in existing.items() if key in entries]
+            NhtsaCatalogEntry.objects.filter(pk__in=refreshed).update(
+                refreshed_at=started
+            )
+            new = [
+                NhtsaCatalogEntry(
+                    make_key=key[0],
+                    model_key=key[1],
+                    make_name=names[0],
+                    model_name=names[1],
+                    refreshed_at=started,
+                )
+                for key, names in entries.items()
+                if key not in existing
+            ]
+            # Another import may be running, skip entries it already added
+            NhtsaCatalogEntry.objects.bulk_create(new, ignore_conflicts=True)
+
+        return len(new), len(refreshed), skipped
+
+    def prune(self, started, chunk_size: int) -> int:
+        """
+        Delete entries not refreshed by this import, chunk by chunk
+        """
+        stale = NhtsaCatalogEntry.objects.filter(refreshed_at__lt=started)
+        pruned = 0
+        while True:
+            pks = list(stale.values_list("pk", flat=True)[:chunk_size])
+            if not pks:
+                return pruned
+            deleted, _ = NhtsaCatalogEntry.objects.filter(pk__in=pks).delete()
+            pruned += deleted
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.utils import timezone
+
+from ...models import NhtsaMakeCache
+
+
+class Command(BaseCommand):
+    """
+    Reports hit/miss counts of the NHTSA model name cache
+    Usage: python manage.py nhtsa_cache_stats [--purge-expired]
+    """
+
+    help = "Report hit/miss counts of the NHTSA model name cache"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--purge-expired",
+            action="store_true",
+            help="Delete expired cache entries after reporting",
+        )
+
+    def handle(self, *args, **options) -> None:
+        now = timezone.now()
+        entries = NhtsaMakeCache.objects.order_by("-hits", "make")
+        for entry in entries.iterator():
+            self.stdout.write(
+                "{:<30} {:>6} models {:>8} hits {:>6} misses  {}".format(
+                    entry.make,
+                    len(entry.model_names),
+                    entry.hits,
+                    entry.misses,
+                    "expired" if entry.expires_at <= now else "fresh",
+                )
+            )
+
+        totals = entries.aggregate(hits=Sum("hits"), misses=Sum("misses"))
+        hits = totals["hits"] or 0
+        misses = totals["misses"] or 0
+        lookups = hits + misses
+        ratio = 100.0 * hits / lookups if lookups else 0.0
+        self.stdout.write(
+            "Total: {} makes, {} hits, {} misses, {:.1f}% hit ratio".format(
+                entries.count(), hits, misses, ratio
+            )
+        )
+
+        if options["purge_expired"]:
+            deleted, _ = NhtsaMakeCache.objects.filter(
+                expires_at__lte=now
+            ).delete()
+            self.stdout.write("Purged {} expired entries".format(deleted))
@@ -0,0 +1,63 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...models import PendingCar
+
+
+class Command(BaseCommand):
+    """
+    Validates the cars queued by CAR_VALIDATION_QUEUE against NHTSA
+    Usage: python manage.py process_pending_cars [--loop [--interval 1]]
+                                                 [--batch 500]
+    """
+
+    help = "Validate and add the pending cars"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=settings.PENDING_CARS_BATCH,
+            help="Maximum number of cars processed per transaction",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep processing every --interval seconds",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds between runs with --loop, once the queue is empty",
+        )
+
+    def handle(self, *args, **options) -> None:
+        while True:
+            totals: dict = {}
+            while True:
+                counts = PendingCar.process(options["batch"])
+                for status, count in counts.items():
+                    totals[status] = totals.get(status, 0) + count
+                # Stop at cars left pending, e.g. NHTSA unavailable
+                if sum(counts.values()) < options["batch"]:
+                    break
+            if options["verbosity"] > 0 and (totals or not options["loop"]):
+                self.stdout.write(
+                    "Processed {} cars: {}, {} pending".format(
+                        sum(totals.values()),
+                        ", ".join(
+                            "{} {}".format(count, status)
+                            for status, count in sorted(totals.items())
+                        )
+                        or "none",
+                        PendingCar.objects.filter(
+                            status=PendingCar.PENDING
+                        ).count(),
+                    )
+                )
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
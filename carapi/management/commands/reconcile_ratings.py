@@ -0,0 +1,171 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Q
+
+from ... import dataversion, leaderboard
+from ...models import STARS, Car, Rating, RatingShard, average_rating
+
+COUNTERS = ["rating_sum", "rates_number", "avg_rating"] + [
+    "rates_" + str(star) for star in STARS
+]
+
+
+def expected_counters(histogram: dict) -> dict:
+    """
+    Returns the Car counters matching a histogram {star: count}, with the
+    average rounded like Car.update_ratings() does
+    """
+    count = sum(histogram.values())
+    total = sum(star * n for star, n in histogram.items())
+    counters = {
+        "rating_sum": total,
+        "rates_number": count,
+        "avg_rating": average_rating(total, count),
+    }
+    for star in STARS:
+        counters["rates_" + str(star)] = histogram.get(star, 0)
+    return counters
+
+
+def reconcile_chunk(car_ids: list, dry_run: bool) -> list:
+    """
+    Recomputes the rating counters of the given cars from the Rating
+    table with a single GROUP BY, and writes the corrections with
+    bulk_update. Ratings not yet folded from the RatingShards of the
+    cars are included, and the shards are emptied.
+    Returns (car, expected counters) of the cars whose ratings drifted.
+
+    Keyword arguments:
+        car_ids (list):    IDs of the cars, in ascending order
+        dry_run (bool):    Only report the drifted cars, change nothing
+    """
+    with transaction.atomic():
+        # Concurrent ratings of these cars wait until the chunk is done
+        cars = list(
+            Car.objects.select_for_update()
+            .filter(id__in=car_ids)
+            .order_by("id")
+            .only("id", "make", "model", *COUNTERS)
+        )
+        shards: dict = {}
+        for shard in (
+            RatingShard.objects.select_for_update()
+            .filter(car_id__in=car_ids, rates_number__gt=0)
+            .order_by("car_id", "shard")
+        ):
+            histogram = shards.setdefault(shard.car_id_id, {})
+            for star, count in shard.histogram().items():
+                histogram[star] = histogram.get(star, 0) + count
+
+        histograms = {
+            row["car_id"]: {star: row["rates_" + str(star)] for star in STARS}
+            for row in Rating.objects.filter(
+                car_id__gte=car_ids[0], car_id__lte=car_ids[-1]
+            )
+            .values("car_id")
+            .annotate(
+                **{
+                    "rates_" + str(star): Count("id", filter=Q(rating=star))
+                    for star in STARS
+                }
+            )
+            .order_by()
+            .iterator()
+        }
+
+        drifted, changed = [], []
+        for car in cars:
+            expected = expected_counters(histograms.get(car.id, {}))
+            current = {field: getattr(car, field) for field in COUNTERS}
+            current["rates_number"] = current["rates_number"] or 0
+            unfolded = shards.get(car.id, {})
+            if unfolded:
+                # Counted by the shards, but not yet by the car
+                current = expected_counters(
+                    {
+                        star: current["rates_" + str(star)]
+                        + unfolded.get(star, 0)
+                        for star in STARS
+                    }
+                )
+            if current != expected:
+                drifted.append((car, expected))
+            if unfolded or current != expected:
+                for field, value in expected.items():
+                    setattr(car, field, value)
+                changed.append(car)
+
+        if not dry_run:
+            Car.objects.bulk_update(changed, COUNTERS)
+            if changed:
+                # Counts may have been lowered
+                leaderboard.on_commit(leaderboard.invalidate)
+                dataversion.bump("cars")
+            RatingShard.objects.filter(
+                car_id__in=shards.keys(), rates_number__gt=0
+            ).update(
+                rating_sum=0,
+                rates_number=0,
+                **{"rates_" + str(star): 0 for star in STARS}
+            )
+    return drifted
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds Car.avg_rating, rates_number, rating_sum and the star counters
+    from the Rating table, one chunk of cars at a time
+    Usage: python manage.py reconcile_ratings [--dry-run] [--chunk-size 1000]
+    """
+
+    help = "Recompute the rating counters of all cars from the ratings"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the cars whose counters drifted",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of cars recomputed per query and transaction",
+        )
+
+    def handle(self, *args, **options) -> None:
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1")
+        checked = drifted = 0
+        last_id = 0
+        while True:
+            # Keyset pagination, every chunk costs the same
+            car_ids = list(
+                Car.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[: options["chunk_size"]]
+            )
+            if not car_ids:
+                break
+            for car, expected in reconcile_chunk(car_ids, options["dry_run"]):
+                drifted += 1
+                if options["verbosity"] > 1:
+                    self.stdout.write(
+                        "{} (id {}): {} ratings, average {}".format(
+                            car,
+                            car.id,
+                            expected["rates_number"],
+                            expected["avg_rating"],
+                        )
+                    )
+            checked += len(car_ids)
+            last_id = car_ids[-1]
+
+        if options["verbosity"] > 0:
+            self.stdout.write(
+                "Checked {} cars, {} {}".format(
+                    checked,
+                    drifted,
+                    "drifted" if options["dry_run"] else "fixed",
+                )
+            )
@@ -0,0 +1,447 @@
+"""
+Request metrics in the Prometheus text format, served at GET /metrics
+
+MetricsMiddleware times every request, and counts the database queries
+and serializer time spent on it (collected through a database execute
+wrapper and serializers.MeasuredSerializerMixin). The NHTSA client
+reports the latency and outcome of its upstream requests with observe().
+
+Every process keeps its metrics in memory and writes them to a file of
+its own in METRICS_DIR every METRICS_FLUSH_INTERVAL seconds. /metrics
+adds up the files of all the processes, so it reports the totals of all
+the gunicorn workers, whichever of them answers. Files of stopped
+processes are kept, their counts stay in the totals.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "carapi_"
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# name: (type, help, histogram buckets, label names)
+METRICS = {
+    "request_duration_seconds": (
+        "histogram",
+        "Time to answer a request",
+        SECONDS,
+        ("view", "method", "status"),
+    ),
+    "request_db_queries": (
+        "histogram",
+        "Database queries per request",
+        QUERIES,
+        ("view",),
+    ),
+    "request_db_seconds": (
+        "histogram",
+        "Time per request spent in database queries",
+        SECONDS,
+        ("view",),
+    ),
+    "request_serializer_seconds": (
+        "histogram",
+        "Time per request spent serializing objects",
+        SECONDS,
+        ("view",),
+    ),
+    "nhtsa_request_duration_seconds": (
+        "histogram",
+        "Time of the requests to the NHTSA API, by outcome (ok or error)",
+        SECONDS,
+        ("outcome",),
+    ),
+    "db_write_wait_seconds": (
+        "histogram",
+        "Time writes waited for their turn, see carapi.db.sqlite",
+        SECONDS,
+        ("database",),
+    ),
+    "db_pool_wait_seconds": (
+        "histogram",
+        "Time waited for a connection of the pool, see carapi.db.pool",
+        SECONDS,
+        ("database",),
+    ),
+    "db_pool_connects_total": (
+        "counter",
+        "Connections opened by the pool",
+        None,
+        ("database",),
+    ),
+    "db_pool_timeouts_total": (
+        "counter",
+        "Requests for a connection of the pool that timed out",
+        None,
+        ("database",),
+    ),
+    "nhtsa_short_circuits_total": (
+        "counter",
+        "NHTSA lookups not sent because the circuit breaker was open",
+        None,
+        (),
+    ),
+}
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Counters of the request being handled, None outside of requests
+_request_stats: ContextVar = ContextVar("carapi_request_stats", default=None)
+
+
+class Registry:
+    """
+    Metrics of the process. Histograms are stored as the counts of their
+    buckets (plus +Inf) followed by the sum of the observed values.
+
+    Attributes:
+        path (str):        File the metrics are written to, None to keep
+                           them in memory only
+        values (dict):     (name, label values) -> counter value or
+                           histogram counts & sum
+    """
+
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+        self.values: dict = {}
+        self._lock = threading.Lock()
+        # Held while writing the file, so the last snapshot is written last
+        self._flush_lock = threading.Lock()
+        self._flushed = time.monotonic()
+
+    def observe(self, name: str, value: float, *labels: str) -> None:
+        """
+        Add a value to a histogram
+        """
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(buckets) + 1) + [0.0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+            counts[-1] += value
+
+    def inc(self, name: str, *labels: str, amount: float = 1) -> None:
+        """
+        Increment a counter
+        """
+        key = (name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) -> list:
+        """
+        Return the metrics as a JSON serializable list of
+        [name, label values, value]
+        """
+        with self._lock:
+            return [
+                [
+                    name,
+                    list(labels),
+                    list(value) if isinstance(value, list) else value,
+                ]
+                for (name, labels), value in self.values.items()
+            ]
+
+    def flush(self, force: bool = False) -> None:
+        """
+        Write the metrics to the file of the process, at most every
+        METRICS_FLUSH_INTERVAL seconds unless forced
+        """
+        if self.path is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if (
+                not force
+                and now - self._flushed < settings.METRICS_FLUSH_INTERVAL
+            ):
+                return
+            self._flushed = now
+        with self._flush_lock:
+            try:
+                directory = os.path.dirname(self.path)
+                os.makedirs(directory, exist_ok=True)
+                # Readers never see a partly written file, they skip the
+                # temporary one (not named *.json)
+                fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(self.snapshot(), f)
+                    os.replace(temporary, self.path)
+                except BaseException:
+                    os.unlink(temporary)
+                    raise
+            except OSError:
+                # Metrics never fail the request being recorded
+                logger.exception("Writing the metrics failed")
+
+
+def process_path() -> Optional[str]:
+    """
+    File of this process in METRICS_DIR. Named after the process ID and
+    a random suffix, so a restarted worker reusing an ID doesn't replace
+    the counts of its predecessor.
+    """
+    if not settings.METRICS_DIR:
+        return None
+    return os.path.join(
+        str(settings.METRICS_DIR),
+        "{}-{}.json".format(os.getpid(), uuid.uuid4().hex[:8]),
+    )
+
+
+_registry: Optional[Registry] = None
+_registry_pid: Optional[int] = None
+
+
+def get_registry() -> Registry:
+    """
+    Return the registry of this process, a new one after a fork
+    """
+    global _registry, _registry_pid
+    if _registry is None or _registry_pid != os.getpid():
+        _registry = Registry(process_path())
+        _registry_pid = os.getpid()
+    return _registry
+
+
+def reset() -> None:
+    """
+    Forget the metrics of this process (the files are left untouched)
+    """
+    global _registry
+    _registry = None
+
+
+def observe(name: str, value: float, *labels: str) -> None:
+    if settings.METRICS:
+        get_registry().observe(name, value, *labels)
+
+
+def inc(name: str, *labels: str) -> None:
+    if settings.METRICS:
+        get_registry().inc(name, *labels)
+
+
+def add_serializer_time(seconds: float) -> None:
+    """
+    Count serializer time towards the current request
+    """
+    stats = _request_stats.get()
+    if stats is not None:
+        stats[2] += seconds
+
+
+def measure_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper counting the queries of the current request
+    """
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats[0] += 1
+        stats[1] += time.perf_counter() - start
+
+
+def install_query_wrapper(sender, connection, **kwargs) -> None:
+    """
+    Install measure_query() on every new database connection
+    """
+    if measure_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(measure_query)
+
+
+connection_created.connect(install_query_wrapper)
+
+
+def collect() -> dict:
+    """
+    Add up the metrics of all the processes, from METRICS_DIR,
+    and the current ones of this process
+    """
+    registry = get_registry()
+    registry.flush(force=True)
+    snapshots = [registry.snapshot()] if registry.path is None else []
+    directory = settings.METRICS_DIR
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Removed meanwhile
+                continue
+
+    totals: dict = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(labels))
+            if isinstance(value, list):
+                total = totals.setdefault(key, [0] * len(value))
+                if len(total) != len(value):
+                    # Written with other buckets
+                    continue
+                for i, count in enumerate(value):
+                    total[i] += count
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, escape(value))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def exposition(totals: dict) -> str:
+    """
+    Format metrics in the Prometheus text format
+    """
+    lines = []
+    for name, (kind, text, buckets, label_names) in METRICS.items():
+        full_name = PREFIX + name
+        lines.append("# HELP {} {}".format(full_name, text))
+        lines.append("# TYPE {} {}".format(full_name, kind))
+        for (metric, labels), value in sorted(totals.items()):
+            if metric != name:
+                continue
+            if kind == "counter":
+                lines.append(
+                    "{}{} {}".format(
+                        full_name, label_text(label_names, labels), value
+                    )
+                )
+                continue
+            cumulative = 0
+            for bound, count in zip(
+                [str(bound) for bound in buckets] + ["+Inf"], value[:-1]
+            ):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        full_name,
+                        label_text(
+                            label_names, labels, 'le="{}"'.format(bound)
+                        ),
+                        cumulative,
+                    )
+                )
+            lines.append(
+                "{}_sum{} {}".format(
+                    full_name, label_text(label_names, labels), value[-1]
+                )
+            )
+            lines.append(
+                "{}_count{} {}".format(
+                    full_name, label_text(label_names, labels), cumulative
+                )
+            )
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    """
+    API endpoint that shows the metrics of all the workers
+    Allows listing: GET /metrics
+    """
+    return HttpResponse(exposition(collect()), content_type=CONTENT_TYPE)
+
+
+class MetricsMiddleware:
+    """
+    Records the duration, database queries and serializer time of every
+    request, labelled with the name of the view (URL pattern) answering it
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Makes Django call the middleware as a coroutine function,
+            # see middleware.AsyncWhiteNoiseMiddleware
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not settings.METRICS:
+            return self.get_response(request)
+        stats = [0, 0.0, 0.0]
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self.record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.METRICS:
+            return await self.get_response(request)
+        stats = [0, 0.0, 0.0]
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self.record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    @staticmethod
+    def record(request, response, duration: float, stats: list) -> None:
+        match = getattr(request, "resolver_match", None)
+        view = (match.view_name or match.route) if match else "unmatched"
+        registry = get_registry()
+        registry.observe(
+            "request_duration_seconds",
+            duration,
+            view,
+            request.method,
+            str(response.status_code),
+        )
+        registry.observe("request_db_queries", stats[0], view)
+        registry.observe("request_db_seconds", stats[1], view)
+        registry.observe("request_serializer_seconds", stats[2], view)
+        registry.flush()
@@ -0,0 +1,82 @@
+"""
+Middleware of the project, see MIDDLEWARE in project/settings.py
+"""
+
+import asyncio
+
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoiseMiddleware usable by async requests too
+
+    Django runs the middleware below a sync-only middleware, and the view,
+    in a single thread per process, so async views would serve only one
+    request at a time under ASGI. Looking up a static file doesn't block,
+    so it's done in the event loop instead.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super(AsyncWhiteNoiseMiddleware, self).__init__(
+            get_response, *args, **kwargs
+        )
+        if asyncio.iscoroutinefunction(get_response):
+            # Makes Django call the middleware as a coroutine function,
+            # like django.utils.deprecation.MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return super(AsyncWhiteNoiseMiddleware, self).__call__(request)
+
+    async def __acall__(self, request):
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+
+class ReplicaPinMiddleware:
+    """
+    Pins clients to the primary database for REPLICA_PIN_SECONDS after
+    a successful write, so they read their own writes, see replicas.py
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # See AsyncWhiteNoiseMiddleware
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return self.pin(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.pin(request, await self.get_response(request))
+
+    @staticmethod
+    def pin(request, response):
+        if (
+            settings.DATABASE_REPLICAS
+            and request.method not in ("GET", "HEAD", "OPTIONS", "TRACE")
+            and response.status_code < 400
+        ):
+            response.set_cookie(
+                settings.REPLICA_PIN_COOKIE,
+                "1",
+                max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
@@ -0,0 +1,71 @@
+# Schema of the first release, created with "migrate --run-syncdb" before
+# the app had migrations. Existing databases are marked as migrated with
+# "migrate --fake-initial", see README.
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="Car",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("make", models.CharField(max_length=50)),
+                ("model", models.CharField(max_length=50)),
+                ("avg_rating", models.FloatField(blank=True, null=True)),
+                (
+                    "rates_number",
+                    models.IntegerField(blank=True, default=0, null=True),
+                ),
+            ],
+            options={
+                "unique_together": {("make", "model")},
+            },
+        ),
+        migrations.CreateModel(
+            name="Rating",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "rating",
+                    models.IntegerField(
+                        validators=[
+                            django.core.validators.MinValueValidator(1),
+                            django.core.validators.MaxValueValidator(5),
+                        ]
+                    ),
+                ),
+                (
+                    "car_id",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="carapi.car",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,244 @@
+# Generated by Django 3.2.8 on 2026-10-18 04:19
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+import django.db.models.deletion
+import django.utils.timezone
+
+CHUNK_SIZE = 1000
+STARS = range(1, 6)
+
+
+def backfill_counters(apps, schema_editor):
+    """
+    Computes the new rating_sum and star counters (rates_1..rates_5) of
+    the existing cars from their ratings, along with rates_number and
+    avg_rating, so that the next rating adds up to the right average and
+    GET /cars/{id}/stats/ counts every rating
+    """
+    Car = apps.get_model("carapi", "Car")
+    Rating = apps.get_model("carapi", "Rating")
+    last_id = 0
+    while True:
+        cars = list(
+            Car.objects.filter(id__gt=last_id).order_by("id")[:CHUNK_SIZE]
+        )
+        if not cars:
+            return
+        totals = {
+            row["car_id"]: row
+            for row in Rating.objects.filter(
+                car_id__in=[car.id for car in cars]
+            )
+            .values("car_id")
+            .annotate(
+                count=Count("id"),
+                total=Sum("rating"),
+                **{
+                    "rates_" + str(star): Count("id", filter=Q(rating=star))
+                    for star in STARS
+                }
+            )
+            .order_by()
+        }
+        for car in cars:
+            row = totals.get(car.id, {"count": 0, "total": 0})
+            car.rates_number = row["count"]
+            car.rating_sum = row["total"]
+            for star in STARS:
+                field = "rates_" + str(star)
+                setattr(car, field, row.get(field, 0))
+            # As models.average_rating(), at the time of this migration
+            car.avg_rating = (
+                (row["total"] * 20 + row["count"]) // (row["count"] * 2) / 10.0
+                if row["count"]
+                else None
+            )
+        Car.objects.bulk_update(
+            cars,
+            ["rates_number", "rating_sum", "avg_rating"]
+            + ["rates_" + str(star) for star in STARS],
+        )
+        last_id = cars[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("carapi", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="NhtsaCatalogEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("make_key", models.CharField(max_length=100)),
+                ("model_key", models.CharField(max_length=100)),
+                ("make_name", models.CharField(max_length=100)),
+                ("model_name", models.CharField(max_length=100)),
+                ("refreshed_at", models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="NhtsaMakeCache",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("make", models.CharField(max_length=50, unique=True)),
+                ("model_names", models.JSONField(default=list)),
+                ("expires_at", models.DateTimeField()),
+                ("hits", models.PositiveIntegerField(default=0)),
+                ("misses", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="PendingCar",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("make", models.CharField(max_length=50)),
+                ("model", models.CharField(max_length=50)),
+                ("status", models.CharField(default="pending", max_length=10)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("processed_at", models.DateTimeField(blank=True, null=True)),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                (
+                    "retry_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="RatingBatch",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=64, unique=True)),
+                (
+                    "applied_at",
+                    models.DateTimeField(auto_now_add=True, db_index=True),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="RatingShard",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("shard", models.PositiveSmallIntegerField()),
+                ("rating_sum", models.BigIntegerField(default=0)),
+                ("rates_number", models.IntegerField(default=0)),
+                ("rates_1", models.IntegerField(default=0)),
+                ("rates_2", models.IntegerField(default=0)),
+                ("rates_3", models.IntegerField(default=0)),
+                ("rates_4", models.IntegerField(default=0)),
+                ("rates_5", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="car",
+            name="rates_1",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="car",
+            name="rates_2",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="car",
+            name="rates_3",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="car",
+            name="rates_4",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="car",
+            name="rates_5",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="car",
+            name="rating_sum",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="car",
+            index=models.Index(
+                fields=["rates_number", "id"], name="car_popular_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="ratingshard",
+            name="car_id",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="carapi.car"
+            ),
+        ),
+        migrations.AddField(
+            model_name="pendingcar",
+            name="car",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="carapi.car",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="nhtsacatalogentry",
+            unique_together={("make_key", "model_key")},
+        ),
+        migrations.AlterUniqueTogether(
+            name="ratingshard",
+            unique_together={("car_id", "shard")},
+        ),
+        migrations.AddIndex(
+            model_name="pendingcar",
+            index=models.Index(
+                fields=["status", "retry_at", "id"],
+                name="pendingcar_queue_idx",
+            ),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
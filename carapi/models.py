@@ -1,7 +1,54 @@
-from django.db import models
-from django.db.models.deletion import CASCADE
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, FloatField, Sum
+from django.db.models.deletion import CASCADE, SET_NULL
+from django.db.models.functions import Cast, Coalesce, Floor
 from django.core.validators import MinValueValidator, MaxValueValidator
-import requests
+from django.utils import timezone
+from . import dataversion, leaderboard, nhtsa, query_budget
+
+# Possible values of Rating.rating, one histogram counter per star
+STARS = range(1, 6)
+# Percentiles returned by Car.rating_stats()
+PERCENTILES = (25, 50, 75, 90, 95, 99)
+
+
+def histogram_counters(histogram: dict, sign: int = 1) -> dict:
+    """
+    Returns the F() expressions that add (or with sign=-1 subtract) the
+    ratings of a histogram {star: count} to the counters of a row
+
+    Keyword arguments:
+        histogram (dict):  Number of the ratings per star
+        sign (int):        1 to add the ratings, -1 to subtract them
+    """
+    counters = {
+        "rating_sum": F("rating_sum")
+        + sign * sum(star * count for star, count in histogram.items()),
+    }
+    for star, count in histogram.items():
+        if count:
+            field = "rates_" + str(star)
+            counters[field] = F(field) + sign * count
+    return counters
+
+
+def average_rating(rating_sum: int, rates_number: int):
+    """
+    Returns the average of ratings rounded to 1 decimal point, halves
+    rounded up, as Car.update_ratings() calculates it in the database.
+    None without ratings.
+
+    Keyword arguments:
+        rating_sum (int):   Sum of the ratings
+        rates_number (int): Number of the ratings
+    """
+    if not rates_number:
+        return None
+    return (rating_sum * 20 + rates_number) // (rates_number * 2) / 10.0
 
 
 # Create your models here.
@@ -17,18 +64,36 @@ class Car(models.Model):
         avg_rating (float): Average rating for the car, defaults to NULL
                             when no ratings have been posted for given car.
                             Not required when creating an instance.
+                            Derived from rating_sum and rates_number,
+                            rounded to 1 decimal point.
         rates_number (int): Number of ratings for a given car, defaults to 0
                             when no ratings have been posted for given car.
                             Not required when creating an instance.
+        rating_sum (int):   Sum of all the ratings for a given car,
+                            defaults to 0. Not required when creating
+                            an instance.
+        rates_1..rates_5 (int): Number of 1 to 5 star ratings for a given
+                            car, defaults to 0. Updated together with
+                            rating_sum, see rating_stats().
     """
 
     make = models.CharField(max_length=50)
     model = models.CharField(max_length=50)
     avg_rating = models.FloatField(blank=True, null=True)
     rates_number = models.IntegerField(blank=True, null=True, default=0)
+    rating_sum = models.BigIntegerField(default=0)
+    rates_1 = models.IntegerField(default=0)
+    rates_2 = models.IntegerField(default=0)
+    rates_3 = models.IntegerField(default=0)
+    rates_4 = models.IntegerField(default=0)
+    rates_5 = models.IntegerField(default=0)
 
     class Meta:
         unique_together = ("make", "model")
+        # Keyset pagination of GET /popular/, see pagination.py
+        indexes = [
+            models.Index(fields=["rates_number", "id"], name="car_popular_idx")
+        ]
 
     def __str__(self) -> str:
         """
@@ -43,55 +108,152 @@ class Car(models.Model):
         the provided make & model combination is valid.
 
         Attributes:
-            url (str):         The address of the external API method
             make (str):        The make of the car, as per request
             model (str):       The model of the car, as per request
 
         """
-        url: str = (
-            "https://vpic.nhtsa.dot.gov/api/vehicles/GetModelsForMake/"
-            + make
-            + "?format=json"
-        )
-        # Make request to external API, 5s timeout
-        r: requests.Response = requests.get(url, timeout=5)
-        if r.status_code == 200:
-            results = r.json()["Results"]
-            # Check for model name in the manufacturer's list of models
-            for item in results:
-                if model.lower() == item["Model_Name"].lower():
-                    return True
-            return False
-        else:
-            # Unable to contact API (no HTTP_200_SUCCESS code)
-            return False
+        # Model names are cached per make, see nhtsa.get_model_names()
+        return nhtsa.validate(make, model)
 
     def rate(self, new_rating) -> None:
         """
-        Calculates the new rating
+        Adds a new rating to the car
         Function is called whenever there is a successful POST /rate/ request.
         See views.RateViewSet.create() for details
 
         Keyword arguments:
-            new_rating (float): New rating to be added, specified
+            new_rating (int):   New rating to be added, specified
                                 in the POST /rate/ request.
         """
-        # The following variables are added for code readability
-        # Old rating, default 0, when none exists yet
-        old = float(0.0 if self.avg_rating is None else self.avg_rating)
-        # New rating, specified in the POST /rate/ request
-        new = float(new_rating)
-        # Number of current ratings, default 0, when none exists yet
-        votes = int(0 if self.rates_number is None else self.rates_number)
+        Car.add_ratings(self.pk, {int(new_rating): 1})
+        # Load the values calculated by the database
+        self.refresh_from_db(
+            fields=["avg_rating", "rates_number", "rating_sum"]
+            + ["rates_" + str(star) for star in STARS]
+        )
+        dataversion.bump("cars", "ratings")
+        if settings.RATING_SHARDS <= 0:
+            leaderboard.on_commit(
+                leaderboard.merge,
+                [
+                    {
+                        field: getattr(self, field)
+                        for field in leaderboard.FIELDS
+                    }
+                ],
+            )
+
+    @classmethod
+    def add_ratings(cls, car_id: int, histogram: dict) -> None:
+        """
+        Adds several ratings to a car with a single UPDATE.
+        The sum and number of ratings are increased by the database, so
+        concurrent updates can't overwrite each other, and the average is
+        calculated from the exact sum rather than from the previous average.
+        With RATING_SHARDS set, a random RatingShard of the car is updated
+        instead, see RatingShard for details.
+        See Rating.bulk_add() for details
 
-        # Calculate the new average rating and round to 1 decimal point
-        self.avg_rating = round(((old * votes) + new) / (votes + 1), 1)
-        # Increase the number of votes
-        # Important - this has to happen after average rating calculation!
-        self.rates_number = votes + 1
-        # Save the changes to the object
-        self.save(update_fields=["avg_rating", "rates_number"])
-        # return None
+        Keyword arguments:
+            car_id (int):      ID of the rated car
+            histogram (dict):  Number of the new ratings per star,
+                               e.g. {5: 2, 3: 1}
+        """
+        if settings.RATING_SHARDS > 0:
+            RatingShard.add(car_id, histogram)
+        else:
+            cls.update_ratings(car_id, histogram)
+
+    @classmethod
+    def update_ratings(cls, car_id: int, histogram: dict) -> None:
+        """
+        Applies ratings to the Car row itself, see add_ratings()
+        """
+        counters = histogram_counters(histogram)
+        rating_sum = counters["rating_sum"]
+        rates_number = Coalesce(F("rates_number"), 0) + sum(histogram.values())
+        # Round to 1 decimal point, halves up. Not with ROUND(), which
+        # rounds halves to even on PostgreSQL, see average_rating()
+        average = Floor(
+            Cast(rating_sum * 20 + rates_number, FloatField())
+            / Cast(rates_number * 2, FloatField())
+        )
+        cls.objects.filter(pk=car_id).update(
+            rates_number=rates_number,
+            avg_rating=average / 10.0,
+            **counters,
+        )
+
+    def rating_totals(self) -> tuple:
+        """
+        Returns the current (rating_sum, rates_number) of the car,
+        including ratings not yet folded from the RatingShards
+        """
+        shards = RatingShard.objects.filter(car_id=self.pk).aggregate(
+            rating_sum=Sum("rating_sum"), rates_number=Sum("rates_number")
+        )
+        return (
+            self.rating_sum + (shards["rating_sum"] or 0),
+            (self.rates_number or 0) + (shards["rates_number"] or 0),
+        )
+
+    def rating_histogram(self) -> dict:
+        """
+        Returns the current number of ratings per star {1: .., 5: ..},
+        including ratings not yet folded from the RatingShards
+        """
+        histogram = {
+            star: getattr(self, "rates_" + str(star)) for star in STARS
+        }
+        if settings.RATING_SHARDS > 0:
+            shards = RatingShard.objects.filter(car_id=self.pk).aggregate(
+                **{str(star): Sum("rates_" + str(star)) for star in STARS}
+            )
+            for star in STARS:
+                histogram[star] += shards[str(star)] or 0
+        return histogram
+
+    def rating_stats(self) -> dict:
+        """
+        Returns the rating distribution of the car, calculated from the
+        star counters only, so the Rating table is never read.
+        Function is called by GET /cars/{id}/stats/,
+        see views.CarViewSet.stats()
+
+        Percentiles use the nearest-rank method, the median of an even
+        number of ratings is the mean of the two middle ratings.
+        Mean, median and percentiles are None without ratings.
+        """
+        histogram = self.rating_histogram()
+        count = sum(histogram.values())
+
+        def nth(rank: int) -> int:
+            # Star of the rank-th lowest rating, counting from 1
+            seen = 0
+            for star in STARS:
+                seen += histogram[star]
+                if seen >= rank:
+                    return star
+
+        if count:
+            mean = round(
+                sum(star * n for star, n in histogram.items()) / count, 2
+            )
+            median = (nth((count + 1) // 2) + nth(count // 2 + 1)) / 2
+            percentiles = {
+                "p" + str(p): nth(max(1, -(-p * count // 100)))
+                for p in PERCENTILES
+            }
+        else:
+            mean = median = None
+            percentiles = {"p" + str(p): None for p in PERCENTILES}
+        return {
+            "count": count,
+            "mean": mean,
+            "median": median,
+            "percentiles": percentiles,
+            "histogram": {str(star): histogram[star] for star in STARS},
+        }
 
 
 class Rating(models.Model):
@@ -111,3 +273,391 @@ class Rating(models.Model):
     rating = models.IntegerField(
         validators=[MinValueValidator(1), MaxValueValidator(5)]
     )
+
+    @classmethod
+    def bulk_add(cls, ratings: list) -> list:
+        """
+        Inserts many ratings with a single INSERT and updates every rated
+        car once, all in one transaction.
+        Function is called by POST /rate/bulk/, see views.RateViewSet.bulk()
+
+        Keyword arguments:
+            ratings (list):    (car_id, rating) pairs, cars have to exist
+        """
+        histograms: dict = {}
+        for car_id, rating in ratings:
+            histogram = histograms.setdefault(car_id, {})
+            histogram[rating] = histogram.get(rating, 0) + 1
+
+        with transaction.atomic():
+            created = cls.objects.bulk_create(
+                [
+                    cls(car_id_id=car_id, rating=rating)
+                    for car_id, rating in ratings
+                ]
+            )
+            # Same order in every transaction, to avoid deadlocks
+            with query_budget.per_item():
+                for car_id in sorted(histograms):
+                    Car.add_ratings(car_id, histograms[car_id])
+            if settings.RATING_SHARDS <= 0:
+                leaderboard.rated(histograms)
+            dataversion.bump("cars", "ratings")
+        return created
+
+
+class RatingShard(models.Model):
+    """
+    One of RATING_SHARDS counters of the ratings of a car.
+    Writers pick a random shard, so ratings of a popular car don't all wait
+    for the lock of the same row. Ratings are added to the Car row itself
+    by RatingShard.fold(), see the fold_rating_shards management command.
+    Car.rating_totals() includes the ratings not yet folded.
+
+    Attributes:
+        car_id (int):       Foreign key associated with the ID of a vehicle
+                            in the Car class.
+        shard (int):        Number of the shard, from 0 to RATING_SHARDS-1.
+                            Car & Shard combination is unique.
+        rating_sum (int):   Sum of the ratings not yet folded
+        rates_number (int): Number of the ratings not yet folded
+        rates_1..rates_5 (int): Number of 1 to 5 star ratings not yet folded
+    """
+
+    car_id = models.ForeignKey(Car, on_delete=CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    rating_sum = models.BigIntegerField(default=0)
+    rates_number = models.IntegerField(default=0)
+    rates_1 = models.IntegerField(default=0)
+    rates_2 = models.IntegerField(default=0)
+    rates_3 = models.IntegerField(default=0)
+    rates_4 = models.IntegerField(default=0)
+    rates_5 = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("car_id", "shard")
+
+    @classmethod
+    def add(cls, car_id: int, histogram: dict) -> None:
+        """
+        Adds ratings to a random shard of the car, creating it when needed
+        """
+        shard = random.randrange(settings.RATING_SHARDS)
+        count = sum(histogram.values())
+        counters = histogram_counters(histogram)
+        counters["rates_number"] = F("rates_number") + count
+        if cls.objects.filter(car_id=car_id, shard=shard).update(**counters):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    car_id_id=car_id,
+                    shard=shard,
+                    rating_sum=sum(s * n for s, n in histogram.items()),
+                    rates_number=count,
+                    **{
+                        "rates_" + str(star): n
+                        for star, n in histogram.items()
+                    },
+                )
+        except IntegrityError:
+            # Created by a concurrent writer in the meantime
+            cls.objects.filter(car_id=car_id, shard=shard).update(**counters)
+
+    @classmethod
+    def fold(cls, car_id: int) -> int:
+        """
+        Moves the ratings counted by the shards of a car to the Car row.
+        Returns the number of ratings moved.
+        """
+        with transaction.atomic():
+            shards = list(
+                cls.objects.select_for_update()
+                .filter(car_id=car_id, rates_number__gt=0)
+                .order_by("shard")
+            )
+            histogram = {
+                star: sum(shard.histogram()[star] for shard in shards)
+                for star in STARS
+            }
+            count = sum(histogram.values())
+            if count:
+                # Subtract what was read, rather than zeroing the shards
+                for shard in shards:
+                    cls.objects.filter(pk=shard.pk).update(
+                        rates_number=F("rates_number") - shard.rates_number,
+                        **histogram_counters(shard.histogram(), sign=-1),
+                    )
+                Car.update_ratings(car_id, histogram)
+                leaderboard.rated([car_id])
+                dataversion.bump("cars")
+        return count
+
+    def histogram(self) -> dict:
+        """
+        Returns the number of ratings per star counted by the shard
+        """
+        return {star: getattr(self, "rates_" + str(star)) for star in STARS}
+
+
+class RatingBatch(models.Model):
+    """
+    Batch of the write-behind rating buffer written to the database,
+    see rating_buffer.RatingBuffer.flush(). Added in the same transaction
+    as the ratings, so that a batch taken over by another flusher, or
+    flushed again after a crash, is never written twice.
+
+    Attributes:
+        token (str):        Token of the batch in the buffer
+        applied_at (dt):    Time the ratings were written, batches are
+                            forgotten after KEEP
+    """
+
+    KEEP = timedelta(days=1)
+
+    token = models.CharField(max_length=64, unique=True)
+    applied_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    @classmethod
+    def apply(cls, token: str, ratings: list) -> bool:
+        """
+        Writes the ratings of a batch with Rating.bulk_add(), unless the
+        batch was written already. Returns whether the ratings were added.
+
+        Keyword arguments:
+            token (str):       Token of the batch
+            ratings (list):    (car_id, rating) pairs, cars have to exist
+        """
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    cls.objects.create(token=token)
+            except IntegrityError:
+                return False
+            cls.objects.filter(
+                applied_at__lt=timezone.now() - cls.KEEP
+            ).delete()
+            Rating.bulk_add(ratings)
+        return True
+
+
+class PendingCar(models.Model):
+    """
+    Car waiting to be validated against NHTSA, queued by POST /cars/
+    with CAR_VALIDATION_QUEUE set. Processed in batches by
+    PendingCar.process(), see the process_pending_cars management command.
+
+    Attributes:
+        make (str):         Name of the make of the car, as per request
+        model (str):        Name of the model of the car, as per request
+        status (str):       pending, created (car added), exists (added in
+                            the meantime) or not_found (unknown to NHTSA)
+        car (int):          Foreign key of the car once created or found,
+                            NULL otherwise or when the car was deleted
+        created_at (dt):    Time the car was queued
+        processed_at (dt):  Time the car was validated, NULL while pending
+        attempts (int):     Number of failed validations (NHTSA unavailable)
+        retry_at (dt):      Time from which the car can be processed, later
+                            while a worker validates it or after a failure
+    """
+
+    PENDING = "pending"
+    CREATED = "created"
+    EXISTS = "exists"
+    NOT_FOUND = "not_found"
+
+    # Claimed cars are processed again after this if their worker died
+    CLAIM_TIMEOUT = timedelta(minutes=5)
+    # Delay after a failed validation, doubled at every attempt
+    RETRY_DELAY = timedelta(seconds=10)
+    MAX_RETRY_DELAY = timedelta(hours=1)
+
+    make = models.CharField(max_length=50)
+    model = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, default=PENDING)
+    car = models.ForeignKey(Car, on_delete=SET_NULL, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    retry_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # Pending cars which are due first, see process()
+        indexes = [
+            models.Index(
+                fields=["status", "retry_at", "id"],
+                name="pendingcar_queue_idx",
+            )
+        ]
+
+    def __str__(self) -> str:
+        """
+        Represent pending car as "Make Model (status)"
+        """
+        return self.make + " " + self.model + " (" + self.status + ")"
+
+    @classmethod
+    def claim(cls, batch_size: int) -> list:
+        """
+        Claims up to batch_size of the pending cars which are due, oldest
+        first, by moving their retry_at CLAIM_TIMEOUT ahead. Rows being
+        claimed by another worker are skipped (SELECT ... FOR UPDATE SKIP
+        LOCKED). The transaction ends before the cars are validated.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            pending = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(status=cls.PENDING, retry_at__lte=now)
+                .order_by("retry_at", "id")[:batch_size]
+            )
+            cls.objects.filter(id__in=[row.id for row in pending]).update(
+                retry_at=now + cls.CLAIM_TIMEOUT
+            )
+        return pending
+
+    @classmethod
+    def process(cls, batch_size: int) -> dict:
+        """
+        Validates up to batch_size of the oldest pending cars, asking
+        NHTSA once per make, and adds the valid ones with a single INSERT.
+        The cars are claimed first, see claim(), and NHTSA is asked
+        outside of any transaction, so several workers can run at once.
+        Cars whose make can't be validated (NHTSA unavailable) stay pending
+        and are retried after the others, RETRY_DELAY later, doubled at
+        every attempt up to MAX_RETRY_DELAY.
+        Returns the number of cars per new status.
+
+        Keyword arguments:
+            batch_size (int):  Maximum number of cars to process
+        """
+        pending = cls.claim(batch_size)
+        makes: dict = {}
+        for row in pending:
+            makes.setdefault(nhtsa.normalize(row.make), []).append(row)
+
+        processed, failed = [], []
+        for make, rows in makes.items():
+            try:
+                known = nhtsa.model_names(make)
+            except nhtsa.NhtsaUnavailable:
+                failed.extend(rows)
+                continue
+            for row in rows:
+                if nhtsa.normalize(row.model) not in known:
+                    row.status = cls.NOT_FOUND
+                processed.append(row)
+
+        now = timezone.now()
+        for row in failed:
+            row.attempts += 1
+            row.retry_at = now + min(
+                cls.RETRY_DELAY * 2 ** (row.attempts - 1), cls.MAX_RETRY_DELAY
+            )
+
+        with transaction.atomic():
+            existing = set(
+                Car.objects.filter(
+                    make__in={row.make for row in processed},
+                    model__in={row.model for row in processed},
+                ).values_list("make", "model")
+            )
+            new_cars = []
+            for row in processed:
+                car = (row.make, row.model)
+                if row.status == cls.NOT_FOUND:
+                    continue
+                if car in existing:
+                    row.status = cls.EXISTS
+                else:
+                    row.status = cls.CREATED
+                    new_cars.append(Car(make=row.make, model=row.model))
+                    # Repeated within the batch
+                    existing.add(car)
+
+            # Cars added by a concurrent request in the meantime are skipped
+            Car.objects.bulk_create(new_cars, ignore_conflicts=True)
+            ids = {
+                (make, model): car_id
+                for car_id, make, model in Car.objects.filter(
+                    make__in={row.make for row in processed},
+                    model__in={row.model for row in processed},
+                ).values_list("id", "make", "model")
+            }
+            for row in processed:
+                if row.status != cls.NOT_FOUND:
+                    row.car_id = ids.get((row.make, row.model))
+                row.processed_at = now
+            cls.objects.bulk_update(
+                processed, ["status", "car", "processed_at"]
+            )
+            cls.objects.bulk_update(failed, ["attempts", "retry_at"])
+            if new_cars:
+                dataversion.bump("cars")
+                # IDs of the new cars aren't known with ignore_conflicts
+                leaderboard.on_commit(leaderboard.invalidate)
+
+        counts: dict = {}
+        for row in processed:
+            counts[row.status] = counts.get(row.status, 0) + 1
+        return counts
+
+
+class NhtsaMakeCache(models.Model):
+    """
+    Database tier of the NHTSA model name cache, shared by all workers.
+    See nhtsa.get_model_names() for details
+
+    Attributes:
+        make (str):         Normalized (stripped, lowercase) make name
+        model_names (list): Normalized names of all the models of the make,
+                            empty when NHTSA doesn't know the make
+        expires_at (dt):    Time after which the entry has to be refreshed
+        hits (int):         Number of lookups answered from the cache
+        misses (int):       Number of lookups that had to contact NHTSA
+    """
+
+    make = models.CharField(max_length=50, unique=True)
+    model_names = models.JSONField(default=list)
+    expires_at = models.DateTimeField()
+    hits = models.PositiveIntegerField(default=0)
+    misses = models.PositiveIntegerField(default=0)
+
+    def __str__(self) -> str:
+        """
+        Represent cache entry as "make (N models)"
+        """
+        return self.make + " (" + str(len(self.model_names)) + " models)"
+
+
+class NhtsaCatalogEntry(models.Model):
+    """
+    Local snapshot of the NHTSA makes & models catalog, used to validate
+    cars without contacting the NHTSA API (NHTSA_MODE = "local").
+    Filled by the import_nhtsa_catalog management command.
+
+    Attributes:
+        make_key (str):     Normalized (stripped, lowercase) make name
+        model_key (str):    Normalized model name.
+                            Make & Model combination is unique.
+        make_name (str):    Make name as published by NHTSA
+        model_name (str):   Model name as published by NHTSA
+        refreshed_at (dt):  Start time of the last import that contained
+                            the entry, older entries are pruned after
+                            a full refresh.
+    """
+
+    make_key = models.CharField(max_length=100)
+    model_key = models.CharField(max_length=100)
+    make_name = models.CharField(max_length=100)
+    model_name = models.CharField(max_length=100)
+    refreshed_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ("make_key", "model_key")
+
+    def __str__(self) -> str:
+        """
+        Represent catalog entry as "Make Model"
+        """
+        return self.make_name + " " + self.model_name
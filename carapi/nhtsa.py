@@ -0,0 +1,649 @@
+"""
+Client for the external NHTSA Vehicle API
+
+With NHTSA_MODE = "local" cars are validated against the NhtsaCatalogEntry
+table instead, see the import_nhtsa_catalog management command.
+
+Otherwise model names are looked up per make and kept in a two-tier cache:
+an in-process LRU in front of the NhtsaMakeCache table, so that repeated
+validations of the same make never leave the process, and other workers
+can reuse what one of them already downloaded. Requests go through one
+pooled keep-alive session per worker process, and concurrent lookups of
+the same make share a single request (see SingleFlight).
+
+Requests are guarded by a CircuitBreaker: after NHTSA_BREAKER_THRESHOLD
+consecutive failures (errors or calls slower than NHTSA_LATENCY_BUDGET)
+NHTSA is not contacted for NHTSA_BREAKER_RESET seconds, and makes are
+validated against locally known data only (expired cache entries and the
+catalog snapshot). NhtsaUnavailable is raised when there is none.
+
+The async views (see async_views.py) use avalidate(), which follows the
+same steps but downloads with a non-blocking httpx client, so a worker
+can wait for many NHTSA responses at once.
+"""
+
+import asyncio
+import os
+import time
+import weakref
+from collections import OrderedDict
+from datetime import timedelta
+from threading import Event, Lock
+from typing import Callable, Optional
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics
+
+
+class NhtsaUnavailable(Exception):
+    """
+    The NHTSA API can't be used and nothing is known locally about the make
+    """
+
+
+def normalize(name: str) -> str:
+    """
+    Normalize a make or model name, so that lookups are case-insensitive
+    """
+    return name.strip().lower()
+
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Return the HTTP session shared by all threads of this worker process.
+    Its connection pool keeps up to NHTSA_POOL_SIZE keep-alive connections
+    to the NHTSA API open, so validations skip the TCP & TLS handshakes.
+    A new session is created after a fork, sockets are never shared
+    between gunicorn workers.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=settings.NHTSA_POOL_SIZE
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session, _session_pid = session, pid
+    return _session
+
+
+def fetch_model_names(make: str) -> Optional[frozenset]:
+    """
+    Downloads the list of models for the given make from the NHTSA API.
+    Returns a set of normalized model names (empty for unknown makes),
+    or None when the API could not be contacted successfully.
+    """
+    url: str = settings.NHTSA_API_URL + "GetModelsForMake/" + make
+    r: requests.Response = get_session().get(
+        url, params={"format": "json"}, timeout=settings.NHTSA_LATENCY_BUDGET
+    )
+    if r.status_code != 200:
+        # Unable to contact API (no HTTP_200_SUCCESS code)
+        return None
+    return frozenset(
+        normalize(item["Model_Name"]) for item in r.json()["Results"]
+    )
+
+
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Return the async HTTP client of the running event loop, keeping up to
+    NHTSA_POOL_SIZE keep-alive connections to the NHTSA API open, like
+    get_session() does for the synchronous client
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=settings.NHTSA_POOL_SIZE,
+            ),
+            timeout=settings.NHTSA_LATENCY_BUDGET,
+        )
+    return client
+
+
+async def afetch_model_names(make: str) -> Optional[frozenset]:
+    """
+    Async version of fetch_model_names()
+    """
+    url: str = settings.NHTSA_API_URL + "GetModelsForMake/" + make
+    r: httpx.Response = await get_async_client().get(
+        url, params={"format": "json"}
+    )
+    if r.status_code != 200:
+        # Unable to contact API (no HTTP_200_SUCCESS code)
+        return None
+    return frozenset(
+        normalize(item["Model_Name"]) for item in r.json()["Results"]
+    )
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one: the first caller
+    runs the function, the others wait for it and share its result
+    (or exception).
+
+    Attributes:
+        calls (int):  Number of calls that actually ran the function
+        shared (int): Number of calls that reused a call in flight
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.shared = 0
+        self._flights: dict = {}
+        self._lock = Lock()
+
+    def do(self, key: str, fn: Callable, *args):
+        """
+        Run fn(*args), unless a call for the same key is already running
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = {"done": Event()}
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            flight["done"].wait()
+            if "error" in flight:
+                raise flight["error"]
+            return flight["result"]
+
+        try:
+            flight["result"] = fn(*args)
+            return flight["result"]
+        except BaseException as error:
+            flight["error"] = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight["done"].set()
+
+    def info(self) -> dict:
+        """
+        Return the call counters
+        """
+        with self._lock:
+            return {"calls": self.calls, "shared": self.shared}
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines: concurrent calls with the same key
+    running on the same event loop share one call
+
+    Attributes:
+        calls (int):  Number of calls that actually ran the function
+        shared (int): Number of calls that reused a call in flight
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.shared = 0
+        self._flights: dict = {}
+
+    async def do(self, key: str, fn: Callable, *args):
+        """
+        Await fn(*args), unless a call for the same key is already running
+        """
+        flight_key = (id(asyncio.get_running_loop()), key)
+        task = self._flights.get(flight_key)
+        if task is None:
+            self.calls += 1
+            task = self._flights[flight_key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(
+                lambda _: self._flights.pop(flight_key, None)
+            )
+        else:
+            self.shared += 1
+        # A cancelled caller doesn't cancel the call of the others
+        return await asyncio.shield(task)
+
+    def info(self) -> dict:
+        """
+        Return the call counters
+        """
+        return {"calls": self.calls, "shared": self.shared}
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency for a while, then lets a single
+    probe call through (half-open) to check whether it has recovered.
+    Also keeps latency statistics of the calls, for monitoring.
+
+    Attributes:
+        failure_threshold (int): Consecutive failures that open the breaker
+        reset_timeout (float):   Seconds after which an open breaker
+                                 lets a probe call through
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latency_last = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        """
+        Return whether a call may be made now
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == self.OPEN and elapsed >= self.reset_timeout:
+                # Let this call through as the probe
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, latency: float, ok: bool) -> None:
+        """
+        Record the outcome of a call made after allow()
+        """
+        with self._lock:
+            self.calls += 1
+            self.latency_last = latency
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            if ok:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.errors += 1
+            self.failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self.failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def reset(self) -> None:
+        """
+        Close the breaker and reset the counters
+        """
+        self.__init__(self.failure_threshold, self.reset_timeout)
+
+    def info(self) -> dict:
+        """
+        Return the breaker state and upstream latency statistics
+        """
+        with self._lock:
+            retry_in = 0.0
+            if self.state == self.OPEN:
+                retry_in = max(
+                    0.0,
+                    self.reset_timeout - (time.monotonic() - self.opened_at),
+                )
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_in": round(retry_in, 3),
+                "calls": self.calls,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "latency_last": round(self.latency_last, 4),
+                "latency_avg": round(
+                    self.latency_total / self.calls if self.calls else 0.0, 4
+                ),
+                "latency_max": round(self.latency_max, 4),
+            }
+
+
+class ModelNameCache:
+    """
+    Thread-safe, size-bounded LRU mapping a normalized make to its
+    set of model names and the time that set expires at.
+
+    Hits are counted per make and written to the database in batches
+    of HITS_FLUSH, to keep the management command's counters close to
+    reality without a write per lookup.
+    """
+
+    HITS_FLUSH: int = 100
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, make: str) -> Optional[frozenset]:
+        """
+        Return the cached model names for make, or None when the make
+        is not cached or its entry has expired
+        """
+        flush = 0
+        with self._lock:
+            entry = self._entries.get(make)
+            if entry is None:
+                return None
+            names, expires_at, pending = entry
+            if expires_at <= timezone.now():
+                del self._entries[make]
+                flush = pending
+                names = None
+            else:
+                self._entries.move_to_end(make)
+                self.hits += 1
+                pending += 1
+                if pending >= self.HITS_FLUSH:
+                    flush, pending = pending, 0
+                entry[2] = pending
+        if flush:
+            _record_hits(make, flush)
+        return names
+
+    def put(self, make: str, names: frozenset, expires_at) -> None:
+        """
+        Store the model names for make, evicting the least recently used
+        entry when the cache is full
+        """
+        evicted = None
+        with self._lock:
+            self._entries[make] = [names, expires_at, 0]
+            self._entries.move_to_end(make)
+            if len(self._entries) > self.maxsize:
+                evicted = self._entries.popitem(last=False)
+        if evicted is not None and evicted[1][2]:
+            _record_hits(evicted[0], evicted[1][2])
+
+    def count(self, counter: str) -> None:
+        """
+        Increase one of the db_hits/misses counters
+        """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def clear(self) -> None:
+        """
+        Drop all entries and reset the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.db_hits = self.misses = 0
+
+    def info(self) -> dict:
+        """
+        Return the hit/miss counters of this process
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+
+_cache = ModelNameCache(settings.NHTSA_CACHE_SIZE)
+_flight = SingleFlight()
+_async_flight = AsyncSingleFlight()
+breaker = CircuitBreaker(
+    settings.NHTSA_BREAKER_THRESHOLD, settings.NHTSA_BREAKER_RESET
+)
+
+
+def _record_hits(make: str, count: int) -> None:
+    from .models import NhtsaMakeCache
+
+    NhtsaMakeCache.objects.filter(make=make).update(hits=F("hits") + count)
+
+
+def get_model_names(make: str) -> frozenset:
+    """
+    Return the set of normalized model names NHTSA knows for the make.
+    Looks in the in-process LRU first, then in the NhtsaMakeCache table,
+    and only then contacts the NHTSA API.
+    Unknown makes are cached as an empty set for NHTSA_CACHE_NEGATIVE_TTL.
+    API failures are not cached, locally known data is used instead
+    (see _fallback()).
+    """
+    key = normalize(make)
+    names = _cached_model_names(key)
+    if names is not None:
+        return names
+
+    # Concurrent lookups of the same make wait for one request
+    return _flight.do(key, _refresh, key)
+
+
+async def aget_model_names(make: str) -> frozenset:
+    """
+    Async version of get_model_names(), the database is used from
+    a thread and NHTSA is contacted without blocking
+    """
+    key = normalize(make)
+    names = await sync_to_async(_cached_model_names)(key)
+    if names is not None:
+        return names
+
+    # Concurrent lookups of the same make wait for one request
+    return await _async_flight.do(key, _arefresh, key)
+
+
+def _cached_model_names(key: str) -> Optional[frozenset]:
+    """
+    Return the model names of the normalized make from the in-process LRU
+    or the NhtsaMakeCache table, None when neither has a current entry
+    """
+    from .models import NhtsaMakeCache
+
+    names = _cache.get(key)
+    if names is not None:
+        return names
+
+    row = NhtsaMakeCache.objects.filter(
+        make=key, expires_at__gt=timezone.now()
+    ).first()
+    if row is not None:
+        names = frozenset(row.model_names)
+        _cache.put(key, names, row.expires_at)
+        NhtsaMakeCache.objects.filter(pk=row.pk).update(hits=F("hits") + 1)
+        _cache.count("db_hits")
+        return names
+    return None
+
+
+def _refresh(key: str) -> frozenset:
+    """
+    Download the model names for the normalized make and store them
+    in both cache tiers
+    """
+    _cache.count("misses")
+    if not breaker.allow():
+        metrics.inc("nhtsa_short_circuits_total")
+        return _fallback(key)
+    start = time.perf_counter()
+    try:
+        names = fetch_model_names(key)
+    except Exception:
+        # Any error counts as a failure, so that a probe always ends
+        # the half-open state
+        names = None
+    return _store(key, names, time.perf_counter() - start)
+
+
+async def _arefresh(key: str) -> frozenset:
+    """
+    Async version of _refresh()
+    """
+    _cache.count("misses")
+    if not breaker.allow():
+        metrics.inc("nhtsa_short_circuits_total")
+        return await sync_to_async(_fallback)(key)
+    start = time.perf_counter()
+    try:
+        names = await afetch_model_names(key)
+    except Exception:
+        names = None
+    return await sync_to_async(_store)(key, names, time.perf_counter() - start)
+
+
+def _store(key: str, names: Optional[frozenset], latency: float) -> frozenset:
+    """
+    Record the outcome of a download of the model names for the
+    normalized make, and store them in both cache tiers.
+    Falls back to locally known data when the download failed.
+    """
+    from .models import NhtsaMakeCache
+
+    breaker.record(
+        latency,
+        names is not None and latency <= settings.NHTSA_LATENCY_BUDGET,
+    )
+    metrics.observe(
+        "nhtsa_request_duration_seconds",
+        latency,
+        "ok" if names is not None else "error",
+    )
+    if names is None:
+        return _fallback(key)
+
+    ttl = (
+        settings.NHTSA_CACHE_TTL
+        if names
+        else settings.NHTSA_CACHE_NEGATIVE_TTL
+    )
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    row, created = NhtsaMakeCache.objects.update_or_create(
+        make=key,
+        defaults={"model_names": sorted(names), "expires_at": expires_at},
+    )
+    NhtsaMakeCache.objects.filter(pk=row.pk).update(misses=F("misses") + 1)
+    _cache.put(key, names, expires_at)
+    return names
+
+
+def _fallback(key: str) -> frozenset:
+    """
+    Return the locally known model names for the normalized make, used
+    while NHTSA can't be contacted: an expired cache entry, or else
+    the catalog snapshot. Raises NhtsaUnavailable when neither exists.
+    """
+    from .models import NhtsaMakeCache
+
+    row = NhtsaMakeCache.objects.filter(make=key).first()
+    if row is not None:
+        return frozenset(row.model_names)
+    names = catalog_model_names(key)
+    if names:
+        return names
+    raise NhtsaUnavailable("NHTSA API is unavailable")
+
+
+def catalog_contains(make: str, model: str) -> bool:
+    """
+    Check whether the local catalog snapshot lists the model for the make
+    """
+    from .models import NhtsaCatalogEntry
+
+    return NhtsaCatalogEntry.objects.filter(
+        make_key=normalize(make), model_key=normalize(model)
+    ).exists()
+
+
+def catalog_model_names(make: str) -> frozenset:
+    """
+    Return the model names the local catalog snapshot lists for the make
+    """
+    from .models import NhtsaCatalogEntry
+
+    return frozenset(
+        NhtsaCatalogEntry.objects.filter(make_key=normalize(make)).values_list(
+            "model_key", flat=True
+        )
+    )
+
+
+def model_names(make: str) -> frozenset:
+    """
+    Return the set of normalized model names known for the make,
+    from the catalog or from NHTSA depending on NHTSA_MODE.
+    Raises NhtsaUnavailable, see get_model_names().
+    """
+    if settings.NHTSA_MODE == "local":
+        return catalog_model_names(make)
+    return get_model_names(make)
+
+
+def validate(make: str, model: str) -> bool:
+    """
+    Check whether NHTSA lists the model for the given make.
+    Raises NhtsaUnavailable, see get_model_names().
+    """
+    if settings.NHTSA_MODE == "local":
+        return catalog_contains(make, model)
+    return normalize(model) in get_model_names(make)
+
+
+async def avalidate(make: str, model: str) -> bool:
+    """
+    Async version of validate()
+    """
+    if settings.NHTSA_MODE == "local":
+        return await sync_to_async(catalog_contains)(make, model)
+    return normalize(model) in await aget_model_names(make)
+
+
+def cache_info() -> dict:
+    """
+    Return the in-process cache counters
+    """
+    return dict(
+        _cache.info(),
+        coalesced=_flight.info()["shared"] + _async_flight.info()["shared"],
+    )
+
+
+def clear_cache() -> None:
+    """
+    Empty the in-process cache (the database tier is left untouched)
+    """
+    _cache.clear()
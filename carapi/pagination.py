@@ -0,0 +1,166 @@
+"""
+Keyset (cursor) pagination for the list endpoints
+
+Pages are selected with a WHERE on the ordering columns of the last row
+of the previous page instead of an OFFSET, so a deep page costs the same
+as the first one, and no COUNT(*) is run.
+"""
+
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginates a queryset by a unique combination of columns, all sorted
+    in the same direction. The position is passed in the opaque "cursor"
+    query parameter, the URL of the next page is returned as "next".
+
+    Attributes:
+        ordering (tuple):       Integer fields to sort by, the last one
+                                unique, e.g. ("-rates_number", "-id")
+        cursor_query_param:     Name of the cursor query parameter
+        page_size_query_param:  Name of the page size query parameter
+    """
+
+    ordering: tuple = ("id",)
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def get_page_size(self, request) -> int:
+        """
+        Page size requested by the client, at most MAX_PAGE_SIZE
+        """
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.PAGE_SIZE
+        return min(max(page_size, 1), settings.MAX_PAGE_SIZE)
+
+    def encode_cursor(self, values: list) -> str:
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, request):
+        """
+        Return the ordering values of the last row of the previous page,
+        or None for the first page
+        """
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor is None:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (binascii.Error, ValueError):
+            raise NotFound("Invalid cursor")
+        if (
+            not isinstance(values, list)
+            or len(values) != len(self.ordering)
+            # Compared with the ordering columns, all integers
+            or any(type(value) is not int for value in values)
+        ):
+            raise NotFound("Invalid cursor")
+        return values
+
+    def after(self, values: list) -> Q:
+        """
+        Condition selecting the rows after the given ordering values, e.g.
+        (a < 3) OR (a = 3 AND b < 7) for ("-a", "-b")
+        """
+        lookup = "__lt" if self.ordering[0].startswith("-") else "__gt"
+        fields = [field.lstrip("-") for field in self.ordering]
+        condition = Q(**{fields[-1] + lookup: values[-1]})
+        for field, value in zip(fields[-2::-1], values[-2::-1]):
+            condition = Q(**{field + lookup: value}) | (
+                Q(**{field: value}) & condition
+            )
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None) -> list:
+        self.request = request
+        values = self.decode_cursor(request)
+        queryset = queryset.order_by(*self.ordering)
+        if values is not None:
+            queryset = queryset.filter(self.after(values))
+        # One extra row tells whether there is a next page
+        return self.page(list(queryset[: self.get_page_size(request) + 1]))
+
+    def paginate_rows(self, rows: list, complete: bool, request):
+        """
+        Paginates a list of dicts already sorted by the ordering fields,
+        e.g. a cached copy of the first rows of the queryset.
+        Returns None when the page reaches past the end of the rows,
+        unless the rows are complete (hold the whole queryset).
+        """
+        self.request = request
+        values = self.decode_cursor(request)
+        if values is not None:
+            cursor = tuple(values)
+            if self.ordering[0].startswith("-"):
+                rows = [row for row in rows if self.key(row) < cursor]
+            else:
+                rows = [row for row in rows if self.key(row) > cursor]
+        if len(rows) < self.get_page_size(request) and not complete:
+            return None
+        rows = self.page(rows[: self.get_page_size(request) + 1])
+        # More rows follow the incomplete ones
+        self.has_next = self.has_next or not complete
+        return rows
+
+    def key(self, row) -> tuple:
+        """
+        Values of the ordering fields of a model instance or dict
+        """
+        fields = [field.lstrip("-") for field in self.ordering]
+        if isinstance(row, dict):
+            return tuple(row[field] for field in fields)
+        return tuple(getattr(row, field) for field in fields)
+
+    def page(self, rows: list) -> list:
+        """
+        Cuts the extra row fetched to tell whether there is a next page
+        """
+        page_size = self.get_page_size(self.request)
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.last = list(self.key(rows[-1])) if rows else None
+        return rows
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.last)
+        )
+
+    def get_paginated_response(self, data) -> Response:
+        return Response(
+            {"status": "success", "data": data, "next": self.get_next_link()}
+        )
+
+    def get_paginated_response_schema(self, schema: dict) -> dict:
+        return {
+            "type": "object",
+            "properties": {
+                "status": {"type": "string"},
+                "data": schema,
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+            },
+        }
+
+
+class PopularPagination(KeysetPagination):
+    """
+    Keyset pagination of GET /popular/, most rated cars first.
+    Uses the (rates_number, id) index of Car.
+    """
+
+    ordering = ("-rates_number", "-id")
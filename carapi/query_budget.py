@@ -0,0 +1,201 @@
+"""
+Query budgets of the viewset actions, and N+1 query detection
+
+Every viewset declares the maximum number of database queries of each of
+its actions in query_budgets. With QUERY_BUDGET set to "log" or "raise",
+QueryBudgetMixin records the queries of every request and reports:
+    - actions exceeding their budget, or without a budget
+    - queries of the same shape (same SQL, other parameters) sent more
+      than once by a request, a sign of an N+1 query loop, also for
+      actions without a budget. Loops sending one query per item of the
+      input by design are wrapped in per_item().
+Reports list every offending query and the line of the app sending it.
+"log" logs them as warnings, "raise" raises QueryBudgetExceeded, which
+the test runner enables (see carapi/tests/runner.py).
+
+Every query is counted, including the health checks of the replicas and
+the queries of a database cache backend, except transaction control
+(BEGIN, savepoints): whether a block is a transaction or a savepoint
+depends on the caller, e.g. on the tests wrapping every test in a
+transaction, rather than on the code of the action.
+"""
+
+import logging
+import os
+import re
+import sys
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Modules sending queries on behalf of others
+SKIPPED_FILES = (
+    os.path.abspath(__file__),
+    os.path.join(APP_DIR, "metrics.py"),
+)
+# Transaction control, sent by Django's SQLite backend
+UNCOUNTED = re.compile(r"^\s*(BEGIN|(RELEASE |ROLLBACK TO )?SAVEPOINT )", re.I)
+# "IN (%s, %s, %s)" has the same shape as "IN (%s)"
+PLACEHOLDERS = re.compile(r"%s(, %s)+")
+# True within per_item()
+_per_item = ContextVar("per_item", default=False)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    An action sent more queries than its budget, or repeated a query
+    """
+
+
+@contextmanager
+def per_item():
+    """
+    Marks the queries sent within as sent once per item of the input,
+    e.g. one UPDATE per rated car: counted, but never reported as N+1
+    queries
+    """
+    token = _per_item.set(True)
+    try:
+        yield
+    finally:
+        _per_item.reset(token)
+
+
+def location() -> str:
+    """
+    Return "file:line in function" of the innermost frame of the app
+    (outside of the tests) sending the current query
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if (
+            filename.startswith(APP_DIR)
+            and filename not in SKIPPED_FILES
+            and os.sep + "tests" + os.sep not in filename
+        ):
+            return "{}:{} in {}".format(
+                os.path.relpath(filename, os.path.dirname(APP_DIR)),
+                frame.f_lineno,
+                frame.f_code.co_name,
+            )
+        frame = frame.f_back
+    return "outside of the app"
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper recording the counted queries
+
+    Attributes:
+        queries (list):    (SQL, location) of the queries
+        per_item (set):    Indexes in queries of those sent within
+                           per_item()
+    """
+
+    def __init__(self) -> None:
+        self.queries: list = []
+        self.per_item: set = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        if not UNCOUNTED.match(sql):
+            if _per_item.get():
+                self.per_item.add(len(self.queries))
+            self.queries.append((sql, location()))
+        return execute(sql, params, many, context)
+
+    def repeated(self) -> dict:
+        """
+        Return {shape: number of queries} of the query shapes
+        sent more than once, outside of per_item()
+        """
+        shapes = Counter(
+            PLACEHOLDERS.sub("%s", sql)
+            for i, (sql, _) in enumerate(self.queries)
+            if i not in self.per_item
+        )
+        return {shape: count for shape, count in shapes.items() if count > 1}
+
+    def __enter__(self) -> "QueryRecorder":
+        self._stack = ExitStack()
+        for connection in connections.all():
+            self._stack.enter_context(connection.execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stack.close()
+
+
+def problems(budgets: dict, action: str, recorder: QueryRecorder) -> list:
+    """
+    Return the descriptions of the violations of the budget of an action
+    """
+    if action not in budgets:
+        return ["no query budget declared for {}".format(action)]
+    budget = budgets[action]
+    found = []
+    # None: the number of queries scales with the input, see the viewset
+    if budget is not None and len(recorder.queries) > budget:
+        found.append(
+            "{} queries, budget {}:\n".format(len(recorder.queries), budget)
+            + "\n".join(
+                "    {}. {}\n       at {}".format(i, sql, where)
+                for i, (sql, where) in enumerate(recorder.queries, start=1)
+            )
+        )
+    for shape, count in recorder.repeated().items():
+        found.append(
+            "N+1: {} queries of the same shape:\n    {}\n".format(count, shape)
+            + "\n".join(
+                "       at {}".format(where)
+                for i, (sql, where) in enumerate(recorder.queries)
+                if PLACEHOLDERS.sub("%s", sql) == shape
+                and i not in recorder.per_item
+            )
+        )
+    return found
+
+
+def report(view, found: list) -> None:
+    message = "{}.{} ({} {}): {}".format(
+        type(view).__name__,
+        view.action,
+        view.request.method,
+        view.request.get_full_path(),
+        "\n".join(found),
+    )
+    if settings.QUERY_BUDGET == "raise":
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+class QueryBudgetMixin:
+    """
+    Checks the queries of the viewset's actions against their budgets,
+    with QUERY_BUDGET set to "log" or "raise"
+
+    Attributes:
+        query_budgets (dict): Action name -> maximum number of queries,
+                              None for actions whose queries scale with
+                              the input (only checked for N+1 queries)
+    """
+
+    query_budgets: dict = {}
+
+    def dispatch(self, request, *args, **kwargs):
+        if settings.QUERY_BUDGET not in ("log", "raise"):
+            return super().dispatch(request, *args, **kwargs)
+        with QueryRecorder() as recorder:
+            response = super().dispatch(request, *args, **kwargs)
+        action = getattr(self, "action", None)
+        if action is not None and action != "metadata":
+            found = problems(self.query_budgets, action, recorder)
+            if found:
+                report(self, found)
+        return response
@@ -0,0 +1,246 @@
+"""
+Write-behind buffer for POST /rate/ (RATING_WRITE_BEHIND = True)
+
+Ratings are appended to a local SQLite queue in WAL mode and answered
+with 202 Accepted. A background thread of every worker, or the
+flush_rating_buffer management command, drains the queue in batches of
+RATING_FLUSH_BATCH with Rating.bulk_add(): one INSERT for the ratings and
+one UPDATE per rated car. Car.avg_rating lags up to RATING_FLUSH_INTERVAL
+seconds behind. The flusher thread starts with the first request served
+by the worker (see apps.CarapiConfig.ready()), so ratings queued before a
+restart are written without waiting for a new one, while management
+commands such as migrate or shell never start it.
+
+Every rating is written exactly once. A batch keeps its token when its
+flusher dies or takes longer than CLAIM_TIMEOUT and another flusher takes
+it over, and the token is recorded in the database (models.RatingBatch)
+in the same transaction as the ratings: a batch already written is only
+removed from the queue.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+# Claims of a flusher that died are released after this many seconds
+CLAIM_TIMEOUT = 60.0
+
+
+class RatingBuffer:
+    """
+    Queue of ratings not yet written to the database, kept in a SQLite file
+    shared by all the workers of a host.
+    Flushers claim a batch before writing it, so concurrent flushes never
+    write the same rating twice.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = str(path)
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Return the connection of the current thread, creating the queue
+        table when needed
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending_rating ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "car_id INTEGER NOT NULL, "
+                "rating INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "claimed_by TEXT, "
+                "claimed_at REAL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def append(self, car_id: int, rating: int) -> None:
+        """
+        Add a rating to the queue
+        """
+        self._connection().execute(
+            "INSERT INTO pending_rating (car_id, rating, created_at) "
+            "VALUES (?, ?, ?)",
+            (car_id, rating, time.time()),
+        )
+
+    def pending(self) -> dict:
+        """
+        Return the number of queued ratings and the age of the oldest one
+        """
+        count, oldest = (
+            self._connection()
+            .execute("SELECT COUNT(*), MIN(created_at) FROM pending_rating")
+            .fetchone()
+        )
+        return {
+            "pending": count,
+            "oldest_age": round(time.time() - oldest, 3) if oldest else 0.0,
+        }
+
+    def flush(self, batch_size: int) -> int:
+        """
+        Write up to batch_size queued ratings to the database.
+        Ratings of cars deleted in the meantime are dropped.
+        Returns the number of ratings taken from the queue.
+        """
+        from .models import Car, RatingBatch
+
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # The batch of a flusher that died is taken over as a whole,
+            # under the same token
+            stale = conn.execute(
+                "SELECT claimed_by FROM pending_rating WHERE claimed_at < ? "
+                "ORDER BY id LIMIT 1",
+                (now - CLAIM_TIMEOUT,),
+            ).fetchone()
+            if stale is not None:
+                token = stale[0]
+            else:
+                token = uuid.uuid4().hex
+                conn.execute(
+                    "UPDATE pending_rating SET claimed_by = ? "
+                    "WHERE id IN (SELECT id FROM pending_rating "
+                    "WHERE claimed_by IS NULL ORDER BY id LIMIT ?)",
+                    (token, batch_size),
+                )
+            conn.execute(
+                "UPDATE pending_rating SET claimed_at = ? WHERE claimed_by = ?",
+                (now, token),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        ratings = conn.execute(
+            "SELECT car_id, rating FROM pending_rating WHERE claimed_by = ? "
+            "ORDER BY id",
+            (token,),
+        ).fetchall()
+        if not ratings:
+            return 0
+        try:
+            existing = set(
+                Car.objects.filter(
+                    id__in={car_id for car_id, _ in ratings}
+                ).values_list("id", flat=True)
+            )
+            RatingBatch.apply(
+                token,
+                [(car_id, r) for car_id, r in ratings if car_id in existing],
+            )
+        except BaseException:
+            # Taken over by the next flush
+            conn.execute(
+                "UPDATE pending_rating SET claimed_at = 0 "
+                "WHERE claimed_by = ?",
+                (token,),
+            )
+            raise
+        conn.execute(
+            "DELETE FROM pending_rating WHERE claimed_by = ?", (token,)
+        )
+        return len(ratings)
+
+    def flush_all(self, batch_size: int) -> int:
+        """
+        Flush batches until the queue is drained
+        """
+        flushed = 0
+        while True:
+            count = self.flush(batch_size)
+            flushed += count
+            if count < batch_size:
+                return flushed
+
+
+_buffers: dict = {}
+_flusher: Optional[threading.Thread] = None
+_flusher_lock = threading.Lock()
+
+
+def get_buffer() -> RatingBuffer:
+    """
+    Return the buffer stored at RATING_BUFFER_PATH
+    """
+    path = str(settings.RATING_BUFFER_PATH)
+    if path not in _buffers:
+        _buffers[path] = RatingBuffer(path)
+    return _buffers[path]
+
+
+def _flush_forever() -> None:
+    """
+    Body of the background flusher thread
+    """
+    while True:
+        time.sleep(settings.RATING_FLUSH_INTERVAL)
+        try:
+            get_buffer().flush_all(settings.RATING_FLUSH_BATCH)
+        except Exception:
+            # Retried on the next interval, the ratings stay queued
+            logger.exception("Flushing the rating buffer failed")
+        finally:
+            close_old_connections()
+
+
+def start_flusher() -> None:
+    """
+    Start the background flusher thread of this worker, unless it's
+    running already or RATING_FLUSH_INTERVAL is 0 (flush_rating_buffer
+    management command only)
+    """
+    global _flusher
+    if settings.RATING_FLUSH_INTERVAL <= 0:
+        return
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(
+                target=_flush_forever, name="rating-flusher", daemon=True
+            )
+            _flusher.start()
+
+
+def start_flusher_on_request() -> None:
+    """
+    Start the flusher thread with the first request served by this
+    process, so that only the workers of the server run one
+    """
+    request_started.connect(_first_request, dispatch_uid=__name__)
+
+
+def _first_request(sender, **kwargs) -> None:
+    """
+    Receiver of the first request_started signal of this process
+    """
+    request_started.disconnect(dispatch_uid=__name__)
+    start_flusher()
+
+
+def append(car_id: int, rating: int) -> None:
+    """
+    Queue a rating and make sure it will be flushed
+    """
+    get_buffer().append(car_id, rating)
+    start_flusher()
@@ -0,0 +1,185 @@
+"""
+Read replicas of the database, configured with DATABASE_REPLICA_URLS
+
+ReplicaMixin sends the read-only actions of a viewset (replica_actions)
+to a replica picked at random among the healthy ones, through
+ReplicaRouter. All the queries of a request go to the same replica.
+Everything else, writes and the reads of the other actions, goes to the
+primary ("default") database.
+
+Replicas lag behind the primary, so a client would miss its own writes
+for a moment. middleware.ReplicaPinMiddleware answers successful writes
+with a cookie pinning the client to the primary for REPLICA_PIN_SECONDS,
+clients keeping cookies always read their own writes. Listings read
+from a replica are cached apart (see response_cache.cache_key()), pinned
+clients aren't served them. For REPLICA_PIN_SECONDS after a write, the
+listings read from a replica may still miss it: they're neither cached
+nor given an ETag, which would be the one of the new data, see
+caught_up().
+
+A replica is checked with "SELECT 1" every REPLICA_CHECK_INTERVAL
+seconds, and skipped while it fails. The primary is used when no replica
+is healthy.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# Replica of the request being handled, None to use the primary
+_replica: ContextVar = ContextVar("carapi_replica", default=None)
+
+
+class ReplicaRouter:
+    """
+    Database router sending the reads of ReplicaMixin's actions to the
+    replica picked for the request, see DATABASE_ROUTERS
+    """
+
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        # Not the database cache, written by the same requests
+        if model._meta.app_label != "carapi":
+            return None
+        return _replica.get()
+
+    def db_for_write(self, model, **hints) -> str:
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> bool:
+        # Replicas hold the same data as the primary
+        return True
+
+
+class HealthChecks:
+    """
+    Health of the replicas in this process
+
+    Attributes:
+        checked (dict):    Alias -> (healthy, time of the check)
+    """
+
+    def __init__(self) -> None:
+        self.checked: dict = {}
+        self._lock = threading.Lock()
+
+    def healthy(self, alias: str) -> bool:
+        """
+        Return whether the replica answered its last check, checking it
+        again when older than REPLICA_CHECK_INTERVAL seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            healthy, checked_at = self.checked.get(alias, (None, 0.0))
+            if (
+                healthy is not None
+                and now - checked_at < settings.REPLICA_CHECK_INTERVAL
+            ):
+                return healthy
+            # Other threads use the last result during the check
+            self.checked[alias] = (bool(healthy), now)
+        healthy = self.check(alias)
+        with self._lock:
+            self.checked[alias] = (healthy, time.monotonic())
+        return healthy
+
+    @staticmethod
+    def check(alias: str) -> bool:
+        connection = connections[alias]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+        except DatabaseError:
+            # Reconnect at the next check
+            connection.close()
+            return False
+        return True
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                alias: healthy for alias, (healthy, _) in self.checked.items()
+            }
+
+
+health = HealthChecks()
+
+
+def pick() -> Optional[str]:
+    """
+    Return a healthy replica at random, None when there is none
+    """
+    replicas = list(settings.DATABASE_REPLICAS)
+    random.shuffle(replicas)
+    for alias in replicas:
+        if health.healthy(alias):
+            return alias
+    return None
+
+
+def pinned(request) -> bool:
+    """
+    Return whether the client wrote recently, and reads from the primary
+    """
+    return settings.REPLICA_PIN_COOKIE in request.COOKIES
+
+
+def in_use() -> bool:
+    """
+    Return whether the reads of the current request go to a replica
+    """
+    return _replica.get() is not None
+
+
+def caught_up(modified: float) -> bool:
+    """
+    Return whether the reads of the current request see the data as of
+    the given time: always on the primary, on a replica once the
+    replication lag covered by REPLICA_PIN_SECONDS is over
+    """
+    return (
+        not in_use() or time.time() - modified >= settings.REPLICA_PIN_SECONDS
+    )
+
+
+@contextmanager
+def reading():
+    """
+    Send the reads of the block to a healthy replica, if any
+    """
+    token = _replica.set(pick())
+    try:
+        yield _replica.get()
+    finally:
+        _replica.reset(token)
+
+
+class ReplicaMixin:
+    """
+    Serves the read-only actions of the viewset from a replica, unless
+    the client is pinned to the primary
+
+    Attributes:
+        replica_actions (tuple): Actions only reading the database
+    """
+
+    replica_actions: tuple = ()
+
+    def dispatch(self, request, *args, **kwargs):
+        # self.action is only set by super().dispatch()
+        action = self.action_map.get(request.method.lower())
+        if (
+            not settings.DATABASE_REPLICAS
+            or action not in self.replica_actions
+            or request.method not in ("GET", "HEAD")
+            or pinned(request)
+        ):
+            return super().dispatch(request, *args, **kwargs)
+        with reading():
+            return super().dispatch(request, *args, **kwargs)
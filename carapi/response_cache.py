@@ -0,0 +1,143 @@
+"""
+Cache of rendered listings (RESPONSE_CACHE_TTL > 0)
+
+JSON bodies of GET /cars/, /popular/ and /rate/ are stored in the
+"responses" cache with their headers, keyed by the scheme, the host, the
+path, the query parameters and the media type. Every entry remembers the
+data versions (see dataversion.py) it was rendered from, and is only
+served while they are current, so entries are invalidated by exactly the
+writes that change their data.
+Listings read from a replica aren't cached right after a write, they may
+not show it yet (see replicas.caught_up()).
+
+Stampedes: when an entry is missing or outdated, one request renders it
+while holding a lock, the others wait for it. When an entry only
+expired, the others are served the expired copy meanwhile.
+"""
+
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from . import dataversion, replicas
+
+KEY = "carapi:response:"
+# Seconds to wait for another request rendering the same entry, and
+# after which its lock is released anyway
+LOCK_WAIT = 2.0
+LOCK_TIMEOUT = 30
+
+
+def cache_key(request) -> str:
+    """
+    Key of the entry of a request, the order of the query
+    parameters doesn't matter. Responses of other hosts or schemes,
+    holding other absolute URLs, and responses read from a replica, maybe
+    lagging behind the data versions, are kept apart.
+    """
+    query = sorted(request.GET.lists())
+    digest = hashlib.md5(
+        repr(
+            (
+                request.scheme,
+                request.get_host(),
+                request.path,
+                query,
+                request.accepted_media_type,
+                replicas.in_use(),
+            )
+        ).encode()
+    ).hexdigest()
+    return KEY + digest
+
+
+def from_entry(entry: dict) -> HttpResponse:
+    """
+    Response of a cache entry, with the headers of the response stored
+    """
+    response = HttpResponse(entry["content"])
+    for name, value in entry["headers"].items():
+        response[name] = value
+    return response
+
+
+def render(view, request, response) -> None:
+    """
+    Renders the Response of a viewset action with the renderer picked
+    for the request, like APIView.finalize_response(), which dispatch()
+    still calls once on the response returned
+    """
+    response.accepted_renderer = request.accepted_renderer
+    response.accepted_media_type = request.accepted_media_type
+    response.renderer_context = view.get_renderer_context()
+    response.render()
+
+
+def cached(*scopes):
+    """
+    Decorator of viewset actions serving data of the given scopes, to be
+    applied below dataversion.conditional(). Only successful JSON
+    responses are cached.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            ttl = settings.RESPONSE_CACHE_TTL
+            if ttl <= 0 or request.accepted_renderer.format != "json":
+                return func(self, request, *args, **kwargs)
+
+            versions = getattr(request, "data_versions", None) or dict(
+                zip(scopes, dataversion.current(scopes))
+            )
+            modified = max(modified for _, modified in versions.values())
+            if not replicas.caught_up(modified):
+                # Maybe rendered from data older than the tokens
+                return func(self, request, *args, **kwargs)
+            tokens = [versions[scope][0] for scope in scopes]
+            store = caches["responses"]
+            key = cache_key(request)
+            deadline = time.monotonic() + LOCK_WAIT
+            while True:
+                entry = store.get(key)
+                stale = None
+                if entry is not None and entry["tokens"] == tokens:
+                    if entry["expires"] > time.time():
+                        return from_entry(entry)
+                    stale = entry
+                if store.add(key + ":lock", 1, LOCK_TIMEOUT):
+                    break
+                if stale is not None:
+                    # Being refreshed by another request
+                    return from_entry(stale)
+                if time.monotonic() > deadline:
+                    return func(self, request, *args, **kwargs)
+                time.sleep(0.01)
+
+            try:
+                response = func(self, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                render(self, request, response)
+                # Allow and Vary: Accept as well, added by dispatch()
+                headers = dict(self.headers)
+                headers.update(response.items())
+                entry = {
+                    "tokens": tokens,
+                    "expires": time.time() + ttl,
+                    "content": response.content,
+                    "headers": headers,
+                }
+                # Expired entries are kept a while for stampedes
+                store.set(key, entry, 2 * ttl)
+                return response
+            finally:
+                store.delete(key + ":lock")
+
+        return wrapper
+
+    return decorator
@@ -1,8 +1,25 @@
+import time
+
 from rest_framework import serializers
-from .models import Car, Rating
+from . import metrics
+from .models import Car, PendingCar, Rating
 
 
-class CarSerializer(serializers.ModelSerializer):
+class MeasuredSerializerMixin:
+    """
+    Counts the time spent serializing objects towards the request,
+    see metrics.MetricsMiddleware
+    """
+
+    def to_representation(self, instance):
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.add_serializer_time(time.perf_counter() - start)
+
+
+class CarSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     """
     Default serializer - featuring all datafields
     Not actually used in API
@@ -13,7 +30,7 @@ class CarSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class CarSerializerPost(serializers.ModelSerializer):
+class CarSerializerPost(MeasuredSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for POST /cars/
     Requires only make and model of the car
@@ -24,7 +41,33 @@ class CarSerializerPost(serializers.ModelSerializer):
         fields = ("make", "model")
 
 
-class CarSerializerGet(serializers.ModelSerializer):
+class CarSerializerBulk(MeasuredSerializerMixin, serializers.ModelSerializer):
+    """
+    Serializer for a single car of POST /cars/bulk/
+    Requires only make and model of the car, uniqueness is checked
+    for the whole list at once (see views.CarViewSet.bulk())
+    """
+
+    class Meta:
+        model = Car
+        fields = ("make", "model")
+        validators = []
+
+
+class PendingCarSerializer(
+    MeasuredSerializerMixin, serializers.ModelSerializer
+):
+    """
+    Serializer for GET /cars/pending/{id}/
+    Returns id, make, model, validation status and id of the car
+    """
+
+    class Meta:
+        model = PendingCar
+        fields = ("id", "make", "model", "status", "car")
+
+
+class CarSerializerGet(MeasuredSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for GET /cars/
     Returns id, make, model and average rating
@@ -35,7 +78,9 @@ class CarSerializerGet(serializers.ModelSerializer):
         fields = ("id", "make", "model", "avg_rating")
 
 
-class CarSerializerDelete(serializers.ModelSerializer):
+class CarSerializerDelete(
+    MeasuredSerializerMixin, serializers.ModelSerializer
+):
     """
     Serializer for DELETE /cars/{id}
     Requires only id for deletion
@@ -46,7 +91,7 @@ class CarSerializerDelete(serializers.ModelSerializer):
         fields = "id"
 
 
-class RatingSerializer(serializers.ModelSerializer):
+class RatingSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for POST /rate/{id}
     Requires car_id and a rating
@@ -57,7 +102,18 @@ class RatingSerializer(serializers.ModelSerializer):
         fields = ("car_id", "rating")
 
 
-class PopularSerializer(serializers.ModelSerializer):
+class RatingSerializerBulk(MeasuredSerializerMixin, serializers.Serializer):
+    """
+    Serializer for a single rating of POST /rate/bulk/
+    Requires car_id and a rating, existence of the cars is checked
+    for the whole list at once (see views.RateViewSet.bulk())
+    """
+
+    car_id = serializers.IntegerField()
+    rating = serializers.IntegerField(min_value=1, max_value=5)
+
+
+class PopularSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for GET /popular/
     Returns id, make, model and number of ratings
@@ -0,0 +1,194 @@
+"""
+Local stand-in for the NHTSA Vehicle API, used by tests and benchmarks
+
+Serves GET /api/vehicles/GetModelsForMake/<make> from an in-memory
+catalog and counts the requests and TCP connections it receives.
+Test cases using NHTSA inherit NhtsaStubMixin, so that they never
+contact the real API.
+"""
+
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from unittest import mock
+from urllib.parse import unquote, urlsplit
+
+from django.test import override_settings
+
+
+class NhtsaStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers GetModelsForMake requests, keeping connections alive
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately, don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.stub.count("connections")
+
+    def do_GET(self) -> None:
+        stub = self.server.stub
+        stub.count("requests")
+        if stub.delay:
+            time.sleep(stub.delay)
+
+        path = unquote(urlsplit(self.path).path).rstrip("/")
+        prefix = "/api/vehicles/GetModelsForMake/"
+        if stub.status != 200 or not path.startswith(prefix):
+            self.respond(stub.status if stub.status != 200 else 404, {})
+            return
+
+        make = path[len(prefix) :].strip()
+        models = stub.catalog.get(make.lower(), [])
+        results = [
+            {
+                "Make_ID": 1,
+                "Make_Name": make.upper(),
+                "Model_ID": i,
+                "Model_Name": name,
+            }
+            for i, name in enumerate(models, start=1)
+        ]
+        self.respond(
+            200,
+            {
+                "Count": len(results),
+                "Message": "Response returned successfully",
+                "SearchCriteria": "Make:" + make,
+                "Results": results,
+            },
+        )
+
+    def respond(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # Keep test & benchmark output clean
+        pass
+
+
+class NhtsaStub:
+    """
+    Threaded HTTP server on a free local port, usable as a context manager
+
+    Attributes:
+        catalog (dict): Lowercase make -> list of model names
+        delay (float):  Seconds to wait before answering every request
+        status (int):   HTTP status to answer with, 200 serves the catalog
+        requests (int): Number of requests received
+        connections (int): Number of TCP connections accepted
+    """
+
+    def __init__(self, catalog: dict, delay: float = 0.0) -> None:
+        self.catalog = {
+            make.lower(): models for make, models in catalog.items()
+        }
+        self.delay = delay
+        self.status = 200
+        self.requests = 0
+        self.connections = 0
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), NhtsaStubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+
+    @property
+    def url(self) -> str:
+        """
+        Base URL to use as NHTSA_API_URL
+        """
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/api/vehicles/".format(host, port)
+
+    def count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = self.connections = 0
+
+    def start(self) -> "NhtsaStub":
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "NhtsaStub":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+class NhtsaStubMixin:
+    """
+    Runs a NhtsaStub as NHTSA_API_URL for the tests of a test case,
+    and empties the NHTSA client's cache & breaker before every test.
+    Tests of the callers of nhtsa.get_model_names() can mock it instead,
+    see mock_lookup().
+
+    Attributes:
+        nhtsa_catalog (dict): Catalog served by the stub
+        stub (NhtsaStub):     The running stub
+    """
+
+    nhtsa_catalog: dict = {
+        "Toyota": ["Supra", "Corolla"],
+        "Volkswagen": ["Golf", "Passat"],
+    }
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.stub = NhtsaStub(cls.nhtsa_catalog).start()
+        cls.stub_settings = override_settings(NHTSA_API_URL=cls.stub.url)
+        cls.stub_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.stub_settings.disable()
+        cls.stub.stop()
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        # Not imported at the top, benchmarks use the stub without Django
+        from .. import nhtsa
+
+        super().setUp()
+        self.stub.delay = 0.0
+        self.stub.status = 200
+        self.stub.reset()
+        nhtsa.clear_cache()
+        nhtsa.breaker.reset()
+        self.addCleanup(nhtsa.clear_cache)
+
+    def mock_lookup(self):
+        """
+        Replaces nhtsa.get_model_names() with a mock answering from
+        nhtsa_catalog, for the rest of the test, and returns the mock
+        """
+        from .. import nhtsa
+
+        catalog = {
+            nhtsa.normalize(make): frozenset(map(nhtsa.normalize, models))
+            for make, models in self.nhtsa_catalog.items()
+        }
+        patcher = mock.patch.object(
+            nhtsa,
+            "get_model_names",
+            side_effect=lambda make: catalog.get(make, frozenset()),
+        )
+        self.addCleanup(patcher.stop)
+        return patcher.start()
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Runs the tests with the query budgets of the viewset actions
+    enforced, see carapi.query_budget, a "replica" database standing
+    in for a read replica, see carapi.replicas, and a shared cache of
+    their own
+    """
+
+    def setup_test_environment(self, **kwargs) -> None:
+        super().setup_test_environment(**kwargs)
+        settings.QUERY_BUDGET = "raise"
+        # Data versions & leaderboard tokens, from scratch for every run
+        settings.CACHES["default"] = {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+        }
+        # A test database of its own on the server of the primary, not
+        # replicating it: tests tell where a read went from the data found
+        primary = settings.DATABASES["default"]
+        settings.DATABASES.setdefault(
+            "replica",
+            dict(
+                primary,
+                TEST=(
+                    {"NAME": "test_{}_replica".format(primary["NAME"])}
+                    if primary["ENGINE"] != "django.db.backends.sqlite3"
+                    else {}
+                ),
+            ),
+        )
@@ -0,0 +1,412 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import OperationalError, connections, transaction
+from django.db.backends.sqlite3 import base
+from django.test import SimpleTestCase
+
+from .. import metrics
+from ..db.pool import (
+    ConnectionPool,
+    PooledDatabaseWrapperMixin,
+    PoolTimeout,
+    clear_pools,
+)
+from ..db.sqlite.base import WriterQueue
+
+
+class WriterQueueTest(SimpleTestCase):
+    """
+    Test module for the queue of the writers of a SQLite database
+    """
+
+    def test_first_come_first_served(self) -> None:
+        """
+        Test whether writers get their turn in the order they came
+        """
+        queue = WriterQueue()
+        order = []
+
+        def write(number: int) -> None:
+            queue.acquire(5)
+            order.append(number)
+            queue.release()
+
+        queue.acquire(5)
+        threads = []
+        for number in range(5):
+            threads.append(threading.Thread(target=write, args=(number,)))
+            threads[-1].start()
+            while queue.waiting() <= number:
+                time.sleep(0.001)
+        queue.release()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, list(range(5)))
+
+    def test_reentrant(self) -> None:
+        """
+        Test whether the thread holding the turn can take it again
+        """
+        queue = WriterQueue()
+        queue.acquire(5)
+        queue.acquire(5)
+        queue.release()
+
+        other = threading.Thread(target=queue.acquire, args=(5,))
+        other.start()
+        other.join(0.05)
+        self.assertTrue(other.is_alive())
+        queue.release()
+        other.join()
+
+    def test_timeout(self) -> None:
+        """
+        Test whether writers give up after the timeout
+        """
+        queue = WriterQueue()
+        queue.acquire(5)
+
+        with ThreadPoolExecutor(1) as pool:
+            waiting = pool.submit(queue.acquire, 0.01)
+            with self.assertRaisesMessage(
+                OperationalError, "database is locked"
+            ):
+                waiting.result()
+
+        self.assertEqual(queue.waiting(), 0)
+
+
+class TunedSqliteTest(SimpleTestCase):
+    """
+    Test module for the tuned SQLite backend, on a database file of
+    its own, shared by several threads
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.databases["tuned"] = {
+            "ENGINE": "carapi.db.sqlite",
+            "NAME": os.path.join(cls.directory.name, "tuned.sqlite3"),
+        }
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        connections["tuned"].close()
+        del connections["tuned"]
+        del connections.databases["tuned"]
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        with connections["tuned"].cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS counter")
+            cursor.execute(
+                "CREATE TABLE counter (id INTEGER PRIMARY KEY, n INTEGER)"
+            )
+            cursor.execute("INSERT INTO counter VALUES (1, 0)")
+
+    def count(self) -> int:
+        with connections["tuned"].cursor() as cursor:
+            cursor.execute("SELECT n FROM counter WHERE id = 1")
+            return cursor.fetchone()[0]
+
+    def run_threads(self, target, threads: int = 8) -> None:
+        def run() -> None:
+            try:
+                target()
+            finally:
+                connections["tuned"].close()
+
+        with ThreadPoolExecutor(threads) as pool:
+            for future in [pool.submit(run) for _ in range(threads)]:
+                future.result()
+
+    def test_pragmas(self) -> None:
+        """
+        Test whether new connections are tuned
+        """
+        with connections["tuned"].cursor() as cursor:
+            values = {}
+            for name in ("journal_mode", "synchronous", "busy_timeout"):
+                cursor.execute("PRAGMA " + name)
+                values[name] = cursor.fetchone()[0]
+
+        self.assertEqual(
+            values,
+            {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 20000},
+        )
+
+    def test_concurrent_transactions(self) -> None:
+        """
+        Test whether transactions reading before writing, run by many
+        threads at once, neither fail nor lose updates
+        """
+
+        def increment() -> None:
+            for _ in range(25):
+                with transaction.atomic(using="tuned"):
+                    n = self.count()
+                    with connections["tuned"].cursor() as cursor:
+                        cursor.execute(
+                            "UPDATE counter SET n = %s WHERE id = 1", [n + 1]
+                        )
+
+        self.run_threads(increment)
+
+        self.assertEqual(self.count(), 200)
+
+    def test_concurrent_writes(self) -> None:
+        """
+        Test whether writes outside of transactions wait their turn
+        """
+
+        def increment() -> None:
+            for _ in range(25):
+                with connections["tuned"].cursor() as cursor:
+                    cursor.execute("UPDATE counter SET n = n + 1 WHERE id = 1")
+
+        self.run_threads(increment)
+
+        self.assertEqual(self.count(), 200)
+
+    def test_rollback(self) -> None:
+        """
+        Test whether failed transactions give up their turn
+        """
+        with self.assertRaises(ValueError):
+            with transaction.atomic(using="tuned"):
+                with connections["tuned"].cursor() as cursor:
+                    cursor.execute("UPDATE counter SET n = 1 WHERE id = 1")
+                raise ValueError
+
+        def take_turn() -> None:
+            connections["tuned"].writer.acquire(0.1)
+            connections["tuned"].writer.release()
+
+        self.run_threads(take_turn, threads=1)
+        self.assertEqual(self.count(), 0)
+
+
+def connect():
+    return sqlite3.connect(":memory:", check_same_thread=False)
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    """
+    Test module for the pool of database connections
+    """
+
+    def setUp(self) -> None:
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def pool(self, **options) -> ConnectionPool:
+        return ConnectionPool(
+            "test",
+            PooledDatabaseWrapperMixin.ping,
+            PooledDatabaseWrapperMixin.reset,
+            lambda connection: connection.close(),
+            **options,
+        )
+
+    def counter(self, name: str) -> float:
+        return metrics.get_registry().values.get((name, ("test",)), 0)
+
+    def test_reuse(self) -> None:
+        """
+        Test whether returned connections are lent again
+        """
+        pool = self.pool()
+        connection = pool.get(connect)
+        pool.put(connection)
+
+        self.assertIs(pool.get(connect), connection)
+        self.assertEqual(self.counter("db_pool_connects_total"), 1)
+        self.assertEqual(
+            pool.info(), {"size": 1, "idle": 0, "in_use": 1, "max_size": 10}
+        )
+
+    def test_bounded(self) -> None:
+        """
+        Test whether borrowers wait for a connection when all of them
+        are in use, up to the timeout
+        """
+        pool = self.pool(max_size=2, timeout=0.05)
+        first, second = pool.get(connect), pool.get(connect)
+
+        with self.assertRaises(PoolTimeout):
+            pool.get(connect)
+        self.assertEqual(self.counter("db_pool_timeouts_total"), 1)
+
+        pool.timeout = 5
+        with ThreadPoolExecutor(1) as executor:
+            waiting = executor.submit(pool.get, connect)
+            time.sleep(0.05)
+            pool.put(first)
+            self.assertIs(waiting.result(), first)
+
+        waits = metrics.get_registry().values[
+            ("db_pool_wait_seconds", ("test",))
+        ]
+        # Histogram counts, then the sum of the waits
+        self.assertEqual(sum(waits[:-1]), 3)
+        self.assertGreaterEqual(waits[-1], 0.05)
+
+    def test_pre_ping(self) -> None:
+        """
+        Test whether broken idle connections are replaced
+        """
+        pool = self.pool()
+        connection = pool.get(connect)
+        pool.put(connection)
+        connection.close()
+
+        replacement = pool.get(connect)
+
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(PooledDatabaseWrapperMixin.ping(replacement))
+        self.assertEqual(pool.info()["size"], 1)
+
+    def test_max_lifetime(self) -> None:
+        """
+        Test whether connections are replaced after max_lifetime
+        """
+        pool = self.pool(max_lifetime=0)
+        connection = pool.get(connect)
+        pool.put(connection)
+
+        self.assertIsNot(pool.get(connect), connection)
+        self.assertEqual(self.counter("db_pool_connects_total"), 2)
+        self.assertEqual(pool.info()["size"], 1)
+
+    def test_max_idle(self) -> None:
+        """
+        Test whether connections idle for longer than max_idle are
+        replaced
+        """
+        pool = self.pool(max_idle=0.01)
+        connection = pool.get(connect)
+        pool.put(connection)
+        time.sleep(0.02)
+
+        self.assertIsNot(pool.get(connect), connection)
+
+    def test_not_reusable(self) -> None:
+        """
+        Test whether connections given back as not reusable are closed
+        """
+        pool = self.pool()
+        connection = pool.get(connect)
+        pool.put(connection, reusable=False)
+
+        self.assertFalse(PooledDatabaseWrapperMixin.ping(connection))
+        self.assertEqual(pool.info()["size"], 0)
+
+    def test_connect_error(self) -> None:
+        """
+        Test whether failed connections don't take a place in the pool
+        """
+        pool = self.pool(max_size=1)
+
+        def fail():
+            raise OperationalError("unreachable")
+
+        with self.assertRaises(OperationalError):
+            pool.get(fail)
+        self.assertEqual(pool.info()["size"], 0)
+        pool.get(connect)
+
+
+class PooledSqliteWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """
+    Django's SQLite backend with pooled connections, as the PostgreSQL
+    backend of carapi.db.postgresql
+    """
+
+
+class PooledBackendTest(SimpleTestCase):
+    """
+    Test module for Django database backends with pooled connections
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.databases["pooled"] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.path.join(cls.directory.name, "pooled.sqlite3"),
+            "OPTIONS": {"pool": {"max_size": 2}},
+        }
+        connections.ensure_defaults("pooled")
+        connections.prepare_test_settings("pooled")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        del connections.databases["pooled"]
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        clear_pools()
+
+    def wrapper(self) -> PooledSqliteWrapper:
+        return PooledSqliteWrapper(connections.databases["pooled"], "pooled")
+
+    def test_borrowed_and_returned(self) -> None:
+        """
+        Test whether closing a Django connection gives it back to the pool
+        """
+        wrapper = self.wrapper()
+        wrapper.ensure_connection()
+        connection = wrapper.connection
+        wrapper.close()
+
+        self.assertEqual(wrapper._pool.info()["idle"], 1)
+        self.assertTrue(PooledDatabaseWrapperMixin.ping(connection))
+        other = self.wrapper()
+        with other.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.assertIs(other.connection, connection)
+        other.close()
+
+    def test_closed_in_transaction(self) -> None:
+        """
+        Test whether a connection closed in a transaction isn't reused
+        """
+        wrapper = self.wrapper()
+        wrapper.ensure_connection()
+        connection = wrapper.connection
+        # As Django does when a query of the transaction fails
+        wrapper.in_atomic_block = True
+        wrapper.close()
+
+        self.assertFalse(PooledDatabaseWrapperMixin.ping(connection))
+
+    def test_threads(self) -> None:
+        """
+        Test whether the threads of a process share max_size connections
+        """
+        wrappers = []
+
+        def query() -> None:
+            wrapper = self.wrapper()
+            wrappers.append(wrapper)
+            for _ in range(10):
+                with wrapper.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                wrapper.close()
+
+        with ThreadPoolExecutor(8) as executor:
+            for future in [executor.submit(query) for _ in range(8)]:
+                future.result()
+
+        self.assertLessEqual(wrappers[0]._pool.info()["size"], 2)
@@ -1,9 +1,17 @@
-from django.test import TestCase
-from ..models import Car, Rating
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from ..models import Car, Rating, RatingShard
+from .nhtsa_stub import NhtsaStubMixin
 
 
 # Create your tests here.
-class CarTest(TestCase):
+class CarTest(NhtsaStubMixin, TestCase):
     """
     Test module for the Car model
     """
@@ -88,6 +96,33 @@ class CarTest(TestCase):
         self.assertEqual(car_1.rates_number, 3)
         self.assertEqual(car_2.rates_number, 2)
 
+    def test_car_rating_sum(self) -> None:
+        """
+        Test whether the average is calculated from the exact sum
+        """
+        car = Car.objects.get(id=1)
+
+        for rating in [1, 1, 1, 1, 1, 2, 3]:
+            car.rate(rating)
+
+        # Average = 10/7 = 1.43, averaging rounded averages gives 1.5
+        self.assertEqual(car.rating_sum, 10)
+        self.assertEqual(car.avg_rating, 1.4)
+
+    def test_car_rate_stale_instances(self) -> None:
+        """
+        Test whether rating through outdated instances loses no updates
+        """
+        car_a = Car.objects.get(id=1)
+        car_b = Car.objects.get(id=1)  # Both read 0 ratings
+
+        car_a.rate(5)
+        car_b.rate(1)
+
+        car = Car.objects.get(id=1)
+        self.assertEqual(car.rates_number, 2)
+        self.assertEqual(car.avg_rating, 3.0)
+
     def test_car_external_api(self) -> None:
         """
         Test external API check
@@ -172,3 +207,227 @@ class RatingTest(TestCase):
 
         self.assertEqual(rated_car3_1, "Fake Car")
         self.assertEqual(rated_car3_2, "Fake Car")
+
+
+@override_settings(RATING_SHARDS=4)
+class RatingShardTest(TestCase):
+    """
+    Test module for the sharded rating counters
+    """
+
+    def setUp(self) -> None:
+        Car.objects.create(make="Toyota", model="Supra")
+
+    def test_sharded_rating(self) -> None:
+        """
+        Test whether ratings go to the shards until they are folded
+        """
+        car = Car.objects.get(id=1)
+        for rating in [1, 2, 3, 4, 5, 5]:
+            car.rate(rating)
+        Car.add_ratings(car.id, {4: 1, 5: 1})
+
+        self.assertEqual(car.rates_number, 0)
+        self.assertEqual(car.rating_totals(), (29, 8))
+        self.assertEqual(car.rating_stats()["count"], 8)
+        self.assertLessEqual(RatingShard.objects.count(), 4)
+
+        out = StringIO()
+        call_command("fold_rating_shards", stdout=out)
+
+        self.assertEqual(out.getvalue().strip(), "Folded 8 ratings of 1 cars")
+        car.refresh_from_db()
+        self.assertEqual(car.rates_number, 8)
+        self.assertEqual(car.rating_sum, 29)
+        self.assertEqual(car.avg_rating, 3.6)
+        self.assertEqual(car.rating_totals(), (29, 8))
+        self.assertEqual(
+            car.rating_histogram(), {1: 1, 2: 1, 3: 1, 4: 2, 5: 3}
+        )
+
+    def test_fold_keeps_earlier_ratings(self) -> None:
+        """
+        Test whether folding adds to the ratings stored in the Car row
+        """
+        with override_settings(RATING_SHARDS=0):
+            Car.objects.get(id=1).rate(5)
+        Car.objects.get(id=1).rate(1)
+
+        self.assertEqual(RatingShard.fold(1), 1)
+        self.assertEqual(RatingShard.fold(1), 0)
+        car = Car.objects.get(id=1)
+        self.assertEqual(car.rates_number, 2)
+        self.assertEqual(car.avg_rating, 3.0)
+
+
+class ReconcileRatingsTest(TestCase):
+    """
+    Test module for the reconcile_ratings management command
+    """
+
+    def setUp(self) -> None:
+        Car.objects.create(make="Toyota", model="Supra")
+        Car.objects.create(make="Volkswagen", model="Golf")
+        Car.objects.create(make="Fake", model="Car")
+        Rating.bulk_add([(1, 5), (1, 4), (2, 1), (2, 2)])
+
+    def reconcile(self, *args) -> str:
+        out = StringIO()
+        call_command(
+            "reconcile_ratings", "--chunk-size", "2", *args, stdout=out
+        )
+        return out.getvalue().strip()
+
+    def test_reconcile(self) -> None:
+        """
+        Test whether drifted counters are rebuilt from the ratings
+        """
+        # Rating saved without updating the car, and a lost rating
+        Rating.objects.create(car_id_id=1, rating=1)
+        Car.objects.filter(id=2).update(rates_number=9, avg_rating=4.0)
+
+        self.assertEqual(
+            self.reconcile("--dry-run"), "Checked 3 cars, 2 drifted"
+        )
+        self.assertEqual(Car.objects.get(id=2).rates_number, 9)
+
+        self.assertEqual(self.reconcile(), "Checked 3 cars, 2 fixed")
+        car_1 = Car.objects.get(id=1)
+        car_2 = Car.objects.get(id=2)
+        self.assertEqual(car_1.rates_number, 3)
+        self.assertEqual(car_1.rating_sum, 10)
+        self.assertEqual(car_1.avg_rating, 3.3)
+        self.assertEqual(
+            car_1.rating_histogram(), {1: 1, 2: 0, 3: 0, 4: 1, 5: 1}
+        )
+        self.assertEqual(car_2.rates_number, 2)
+        self.assertEqual(car_2.avg_rating, 1.5)
+        self.assertIsNone(Car.objects.get(id=3).avg_rating)
+
+        self.assertEqual(
+            self.reconcile("--dry-run"), "Checked 3 cars, 0 drifted"
+        )
+
+    def test_reconcile_half_average(self) -> None:
+        """
+        Test whether averages ending in 5 are rounded up by both the
+        database and the command, so that they aren't seen as drifted
+        """
+        # Average = 9/4 = 2.25
+        Rating.bulk_add([(3, 1), (3, 2), (3, 3), (3, 3)])
+
+        self.assertEqual(Car.objects.get(id=3).avg_rating, 2.3)
+        self.assertEqual(
+            self.reconcile("--dry-run"), "Checked 3 cars, 0 drifted"
+        )
+
+    @override_settings(RATING_SHARDS=2)
+    def test_reconcile_shards(self) -> None:
+        """
+        Test whether unfolded shards are not reported, but folded
+        """
+        Rating.bulk_add([(3, 2), (3, 3)])
+
+        self.assertEqual(self.reconcile(), "Checked 3 cars, 0 fixed")
+        car = Car.objects.get(id=3)
+        self.assertEqual(car.rates_number, 2)
+        self.assertEqual(car.avg_rating, 2.5)
+        self.assertFalse(
+            RatingShard.objects.filter(rates_number__gt=0).exists()
+        )
+
+
+# Keep the leaderboard & data versions out of the database under test
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+)
+class CarRateConcurrencyTest(TransactionTestCase):
+    """
+    Stress test of Car.rate() with many parallel writers
+    """
+
+    WRITERS = 8
+    RATINGS = 25
+
+    def rate_many(self, car_id: int, rating: int) -> None:
+        """
+        Rate the car RATINGS times through a separate connection
+        """
+        try:
+            car = Car.objects.get(id=car_id)
+            for _ in range(self.RATINGS):
+                while True:
+                    try:
+                        car.rate(rating)
+                        break
+                    except OperationalError:
+                        # SQLite test databases don't wait for locks
+                        time.sleep(0.001)
+        finally:
+            connection.close()
+
+    def test_no_lost_updates(self) -> None:
+        """
+        Test whether every rating of every writer is counted
+        """
+        car = Car.objects.create(make="Toyota", model="Supra")
+        ratings = [i % 5 + 1 for i in range(self.WRITERS)]
+
+        with ThreadPoolExecutor(max_workers=self.WRITERS) as pool:
+            list(pool.map(lambda r: self.rate_many(car.id, r), ratings))
+
+        car.refresh_from_db()
+        self.assertEqual(car.rates_number, self.WRITERS * self.RATINGS)
+        self.assertEqual(car.rating_sum, sum(ratings) * self.RATINGS)
+        self.assertEqual(car.avg_rating, round(sum(ratings) / len(ratings), 1))
+
+
+class UpgradeMigrationTest(TransactionTestCase):
+    """
+    Test module for the upgrade of databases of the first release
+    """
+
+    def migrate(self, target: str):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([("carapi", target)])
+        return executor.loader.project_state(("carapi", target)).apps
+
+    def test_counters_backfilled(self) -> None:
+        """
+        Test whether the rating counters and histograms of existing cars
+        are computed from their ratings, so that the next rating keeps
+        the average
+        """
+        old_apps = self.migrate("0001_initial")
+        self.addCleanup(call_command, "migrate", "carapi", verbosity=0)
+        OldCar = old_apps.get_model("carapi", "Car")
+        OldRating = old_apps.get_model("carapi", "Rating")
+        car = OldCar.objects.create(
+            make="Toyota", model="Supra", avg_rating=4.0, rates_number=10
+        )
+        OldCar.objects.create(make="Toyota", model="Corolla")
+        for rating in [4] * 5 + [3, 5] * 2 + [4]:
+            OldRating.objects.create(car_id=car, rating=rating)
+
+        self.migrate("0002_rating_counters")
+        car = Car.objects.get(id=car.id)
+        self.assertEqual((car.rates_number, car.rating_sum), (10, 40))
+        self.assertEqual(
+            [getattr(car, "rates_" + str(star)) for star in range(1, 6)],
+            [0, 0, 2, 6, 2],
+        )
+        self.assertEqual(car.rating_stats()["count"], 10)
+        car.rate(5)
+
+        car.refresh_from_db()
+        self.assertEqual(
+            (car.rates_number, car.rating_sum, car.avg_rating), (11, 45, 4.1)
+        )
+        corolla = Car.objects.get(model="Corolla")
+        self.assertEqual(
+            (corolla.rates_number, corolla.rating_sum, corolla.avg_rating),
+            (0, 0, None),
+        )
@@ -0,0 +1,429 @@
+import asyncio
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from io import StringIO
+from unittest import mock
+
+import requests
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+
+from .. import nhtsa
+from ..management.commands import import_nhtsa_catalog
+from ..models import Car, NhtsaCatalogEntry, NhtsaMakeCache
+from .nhtsa_stub import NhtsaStubMixin
+
+TOYOTA = frozenset(["supra", "corolla"])
+
+
+class NhtsaCacheTest(TestCase):
+    """
+    Test module for the NHTSA model name cache
+    """
+
+    def setUp(self) -> None:
+        nhtsa.clear_cache()
+        nhtsa.breaker.reset()
+        patcher = mock.patch.object(nhtsa, "fetch_model_names")
+        self.fetch = patcher.start()
+        self.fetch.side_effect = lambda make: (
+            TOYOTA if make == "toyota" else frozenset()
+        )
+        self.addCleanup(patcher.stop)
+        self.addCleanup(nhtsa.clear_cache)
+
+    def test_repeated_lookup_uses_cache(self) -> None:
+        """
+        Test whether repeated validations of a make contact NHTSA only once
+        """
+        self.assertTrue(Car.check_nhtsa_api("Toyota", "Supra"))
+        self.assertTrue(Car.check_nhtsa_api("toyota ", "COROLLA"))
+        self.assertFalse(Car.check_nhtsa_api("TOYOTA", "Golf"))
+
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(nhtsa.cache_info()["hits"], 2)
+
+    def test_negative_caching(self) -> None:
+        """
+        Test whether unknown makes are cached with the negative TTL
+        """
+        with override_settings(NHTSA_CACHE_NEGATIVE_TTL=60):
+            self.assertFalse(Car.check_nhtsa_api("Fake", "Car"))
+            self.assertFalse(Car.check_nhtsa_api("Fake", "Car"))
+
+        entry = NhtsaMakeCache.objects.get(make="fake")
+        self.assertEqual(entry.model_names, [])
+        self.assertLess(entry.expires_at, timezone.now() + timedelta(hours=1))
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_failures_are_not_cached(self) -> None:
+        """
+        Test whether a failed NHTSA request is retried on the next lookup
+        """
+        self.fetch.side_effect = [None, TOYOTA]
+
+        with self.assertRaises(nhtsa.NhtsaUnavailable):
+            Car.check_nhtsa_api("Toyota", "Supra")
+        self.assertTrue(Car.check_nhtsa_api("Toyota", "Supra"))
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_database_tier(self) -> None:
+        """
+        Test whether another worker (empty memory tier) reuses the DB entry
+        """
+        Car.check_nhtsa_api("Toyota", "Supra")
+        nhtsa.clear_cache()
+
+        self.assertTrue(Car.check_nhtsa_api("Toyota", "Supra"))
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(nhtsa.cache_info()["db_hits"], 1)
+        self.assertEqual(NhtsaMakeCache.objects.get(make="toyota").hits, 1)
+
+    def test_expired_entry_is_refreshed(self) -> None:
+        """
+        Test whether entries past their TTL are downloaded again
+        """
+        with override_settings(NHTSA_CACHE_TTL=-1):
+            Car.check_nhtsa_api("Toyota", "Supra")
+        Car.check_nhtsa_api("Toyota", "Supra")
+
+        self.assertEqual(self.fetch.call_count, 2)
+        self.assertEqual(NhtsaMakeCache.objects.get(make="toyota").misses, 2)
+
+    def test_stats_command(self) -> None:
+        """
+        Test whether the management command reports hits and misses
+        """
+        Car.check_nhtsa_api("Toyota", "Supra")
+        nhtsa.clear_cache()
+        Car.check_nhtsa_api("Toyota", "Supra")
+
+        out = StringIO()
+        call_command("nhtsa_cache_stats", stdout=out)
+
+        self.assertIn(
+            "1 makes, 1 hits, 1 misses, 50.0% hit ratio", out.getvalue()
+        )
+
+
+class NhtsaCatalogTest(TestCase):
+    """
+    Test module for the local NHTSA catalog snapshot
+    """
+
+    def write_dump(self, name: str, content: str) -> str:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, name)
+        with open(path, "w", encoding="utf-8") as fp:
+            fp.write(content)
+        return path
+
+    def test_import_json(self) -> None:
+        """
+        Test whether an API response dump is imported
+        """
+        results = [
+            {"Make_ID": 448, "Make_Name": "TOYOTA", "Model_Name": "Supra"},
+            {"Make_ID": 448, "Make_Name": "TOYOTA", "Model_Name": "Corolla"},
+            {"Make_ID": 482, "Make_Name": "VOLKSWAGEN", "Model_Name": "Golf"},
+        ]
+        path = self.write_dump(
+            "dump.json", json.dumps({"Count": 3, "Results": results})
+        )
+        # Read the file in tiny pieces to exercise the streaming parser
+        with mock.patch.object(
+            import_nhtsa_catalog,
+            "iter_json_results",
+            partial(import_nhtsa_catalog.iter_json_results, read_size=7),
+        ):
+            call_command("import_nhtsa_catalog", path, stdout=StringIO())
+
+        self.assertEqual(NhtsaCatalogEntry.objects.count(), 3)
+        self.assertEqual(
+            str(NhtsaCatalogEntry.objects.get(model_key="golf")),
+            "VOLKSWAGEN Golf",
+        )
+
+    def test_import_csv_refresh_and_prune(self) -> None:
+        """
+        Test whether re-importing keeps existing entries and prunes old ones
+        """
+        first = self.write_dump(
+            "first.csv",
+            "Make_Name,Model_Name\nTOYOTA,Supra\nTOYOTA,Celica\n",
+        )
+        second = self.write_dump(
+            "second.csv",
+            "Make_Name,Model_Name\nTOYOTA,Supra\nTOYOTA,Corolla\n,\n",
+        )
+        call_command("import_nhtsa_catalog", first, stdout=StringIO())
+        supra = NhtsaCatalogEntry.objects.get(model_key="supra")
+
+        out = StringIO()
+        call_command(
+            "import_nhtsa_catalog",
+            second,
+            "--prune",
+            "--chunk-size=1",
+            stdout=out,
+        )
+
+        self.assertIn(
+            "Imported 1 new, refreshed 1, skipped 1, pruned 1", out.getvalue()
+        )
+        self.assertEqual(
+            set(NhtsaCatalogEntry.objects.values_list("model_key", flat=True)),
+            {"supra", "corolla"},
+        )
+        self.assertEqual(
+            NhtsaCatalogEntry.objects.get(model_key="supra").pk, supra.pk
+        )
+
+    @override_settings(NHTSA_MODE="local")
+    def test_local_mode(self) -> None:
+        """
+        Test whether local mode validates against the catalog only
+        """
+        path = self.write_dump(
+            "dump.jsonl",
+            '{"Make_Name": "TOYOTA", "Model_Name": "Supra"}\n',
+        )
+        call_command("import_nhtsa_catalog", path, stdout=StringIO())
+
+        with mock.patch.object(nhtsa, "fetch_model_names") as fetch:
+            self.assertTrue(Car.check_nhtsa_api("Toyota", "Supra"))
+            self.assertFalse(Car.check_nhtsa_api("Fake", "Car"))
+            fetch.assert_not_called()
+
+
+class NhtsaClientTest(NhtsaStubMixin, SimpleTestCase):
+    """
+    Test module for the pooled NHTSA client, against a local stub server
+    """
+
+    def test_fetch_model_names(self) -> None:
+        """
+        Test whether model names are parsed and normalized
+        """
+        self.assertEqual(nhtsa.fetch_model_names("toyota"), TOYOTA)
+        self.assertEqual(nhtsa.fetch_model_names("fake"), frozenset())
+
+    def test_connection_reuse(self) -> None:
+        """
+        Test whether sequential requests reuse one keep-alive connection
+        """
+        for _ in range(5):
+            nhtsa.fetch_model_names("toyota")
+
+        self.assertEqual(self.stub.requests, 5)
+        self.assertEqual(self.stub.connections, 1)
+
+    def test_single_flight(self) -> None:
+        """
+        Test whether concurrent lookups of a make send a single request
+        """
+        self.stub.delay = 0.2
+        flight = nhtsa.SingleFlight()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(
+                pool.map(
+                    lambda _: flight.do(
+                        "toyota", nhtsa.fetch_model_names, "toyota"
+                    ),
+                    range(8),
+                )
+            )
+
+        self.assertEqual(results, [TOYOTA] * 8)
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual(flight.info(), {"calls": 1, "shared": 7})
+
+    def test_single_flight_error(self) -> None:
+        """
+        Test whether waiting callers get the exception of the shared call
+        """
+        flight = nhtsa.SingleFlight()
+
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            flight.do("toyota", fail)
+        self.assertEqual(flight.do("toyota", lambda: 1), 1)
+
+    def test_async_fetch_model_names(self) -> None:
+        """
+        Test whether the async client parses model names the same way,
+        reusing a keep-alive connection
+        """
+
+        async def fetch():
+            return [
+                await nhtsa.afetch_model_names("toyota"),
+                await nhtsa.afetch_model_names("toyota"),
+                await nhtsa.afetch_model_names("fake"),
+            ]
+
+        self.assertEqual(asyncio.run(fetch()), [TOYOTA, TOYOTA, frozenset()])
+        self.assertEqual(self.stub.connections, 1)
+
+    def test_async_single_flight(self) -> None:
+        """
+        Test whether concurrent async lookups of a make send a single request
+        """
+        self.stub.delay = 0.2
+        flight = nhtsa.AsyncSingleFlight()
+
+        async def lookups():
+            return await asyncio.gather(
+                *(
+                    flight.do("toyota", nhtsa.afetch_model_names, "toyota")
+                    for _ in range(8)
+                )
+            )
+
+        self.assertEqual(asyncio.run(lookups()), [TOYOTA] * 8)
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual(flight.info(), {"calls": 1, "shared": 7})
+
+
+class CircuitBreakerTest(TestCase):
+    """
+    Test module for the circuit breaker around NHTSA requests
+    """
+
+    def setUp(self) -> None:
+        nhtsa.clear_cache()
+        patcher = mock.patch.multiple(
+            nhtsa.breaker, failure_threshold=2, reset_timeout=60
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        nhtsa.breaker.reset()
+        self.addCleanup(nhtsa.breaker.reset)
+        self.addCleanup(nhtsa.clear_cache)
+
+    def test_breaker_states(self) -> None:
+        """
+        Test whether the breaker opens, probes and closes again
+        """
+        breaker = nhtsa.CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        breaker.record(0.1, ok=False)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record(0.1, ok=False)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # Reset timeout has passed: one probe is let through
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record(0.1, ok=False)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        self.assertTrue(breaker.allow())
+        breaker.record(0.1, ok=True)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.info()["errors"], 3)
+
+    def test_fail_fast_with_fallback(self) -> None:
+        """
+        Test whether an open breaker skips NHTSA and uses local data
+        """
+        NhtsaMakeCache.objects.create(
+            make="toyota",
+            model_names=["supra"],
+            expires_at=timezone.now() - timedelta(days=1),
+        )
+        with mock.patch.object(
+            nhtsa, "fetch_model_names", side_effect=requests.Timeout
+        ) as fetch:
+            # Failures fall back to the expired entry
+            self.assertTrue(Car.check_nhtsa_api("Toyota", "Supra"))
+            self.assertTrue(Car.check_nhtsa_api("Toyota", "Supra"))
+            self.assertEqual(nhtsa.breaker.state, nhtsa.breaker.OPEN)
+            # Open breaker: no more requests
+            self.assertFalse(Car.check_nhtsa_api("Toyota", "Golf"))
+            with self.assertRaises(nhtsa.NhtsaUnavailable):
+                Car.check_nhtsa_api("Fake", "Car")
+
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(nhtsa.breaker.info()["rejected"], 2)
+
+    def test_slow_calls_are_failures(self) -> None:
+        """
+        Test whether calls over the latency budget count as failures
+        """
+        with override_settings(NHTSA_LATENCY_BUDGET=-1), mock.patch.object(
+            nhtsa, "fetch_model_names", return_value=TOYOTA
+        ):
+            self.assertTrue(Car.check_nhtsa_api("Toyota", "Supra"))
+
+        self.assertEqual(nhtsa.breaker.info()["consecutive_failures"], 1)
+
+    def test_malformed_probe(self) -> None:
+        """
+        Test whether a probe answered with an unexpected payload opens
+        the breaker again, instead of leaving it half-open
+        """
+        for _ in range(2):
+            nhtsa.breaker.record(0.1, ok=False)
+        nhtsa.breaker.reset_timeout = 0
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {"Results": [["Supra"]]}
+        session = mock.Mock()
+        session.get.return_value = response
+
+        with mock.patch.object(nhtsa, "get_session", return_value=session):
+            with self.assertRaises(nhtsa.NhtsaUnavailable):
+                Car.check_nhtsa_api("Toyota", "Supra")
+        self.assertEqual(nhtsa.breaker.state, nhtsa.breaker.OPEN)
+
+        async def probe():
+            with self.assertRaises(nhtsa.NhtsaUnavailable):
+                await nhtsa.avalidate("Toyota", "Supra")
+
+        nhtsa.clear_cache()
+        with mock.patch.object(
+            nhtsa, "afetch_model_names", side_effect=TypeError
+        ):
+            # The queries of the lookup run in this thread
+            async_to_sync(probe)()
+        self.assertEqual(nhtsa.breaker.state, nhtsa.breaker.OPEN)
+        self.assertEqual(nhtsa.breaker.info()["errors"], 4)
+
+    def test_unavailable_response(self) -> None:
+        """
+        Test whether POST /cars/ fails fast with 503 while the breaker is open
+        """
+        for _ in range(2):
+            nhtsa.breaker.record(0.1, ok=False)
+
+        with mock.patch.object(nhtsa, "fetch_model_names") as fetch:
+            response = self.client.post(
+                "/cars/", {"make": "Toyota", "model": "Supra"}
+            )
+
+        fetch.assert_not_called()
+        self.assertEqual(
+            response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        self.assertFalse(Car.objects.exists())
+
+    def test_status_endpoint(self) -> None:
+        """
+        Test whether the breaker state is exposed for monitoring
+        """
+        response = self.client.get(reverse("nhtsa-status"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["breaker"]["state"], "closed")
+        self.assertIn("latency_avg", response.json()["breaker"])
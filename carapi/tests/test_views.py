@@ -1,12 +1,41 @@
-from django.test import TestCase
+import base64
+import gzip
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest import mock
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
 from rest_framework import status
 
-from ..models import Car
+from .. import (
+    dataversion,
+    leaderboard,
+    metrics,
+    nhtsa,
+    query_budget,
+    rating_buffer,
+    replicas,
+    response_cache,
+    views,
+)
+from ..models import Car, PendingCar, Rating, RatingBatch
+from .nhtsa_stub import NhtsaStubMixin
 
 
 # Create your tests here.
-class CarViewSetTest(TestCase):
+class CarViewSetTest(NhtsaStubMixin, TestCase):
     """
     Test module for the /cars viewset
     """
@@ -64,7 +93,7 @@ class CarViewSetTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
-class RateViewSetTest(TestCase):
+class RateViewSetTest(NhtsaStubMixin, TestCase):
     """
     Test module for the /cars viewset
     """
@@ -197,3 +226,1567 @@ class PopularViewSetTest(TestCase):
         response = self.client.get(reverse("popular-list"))
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class CarBulkTest(NhtsaStubMixin, TestCase):
+    """
+    Test module for POST /cars/bulk/
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.lookup = self.mock_lookup()
+
+    def test_bulk_create(self) -> None:
+        """
+        Test the per-car status and the number of NHTSA lookups
+        """
+        Car.objects.create(make="Toyota", model="Supra")
+        cars = [
+            {"make": "Toyota", "model": "Supra"},
+            {"make": "Toyota", "model": "Corolla"},
+            {"make": "toyota", "model": "Golf"},
+            {"make": "Toyota", "model": "Corolla"},
+            {"make": "Fake", "model": "Car"},
+            {"make": "Toyota"},
+        ]
+        response = self.client.post(
+            "/cars/bulk/", json.dumps(cars), content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            [item["status"] for item in response.json()["data"]],
+            [
+                "exists",
+                "created",
+                "not_found",
+                "duplicate",
+                "not_found",
+                "invalid",
+            ],
+        )
+        # One lookup per make
+        self.assertEqual(self.lookup.call_count, 2)
+        self.assertEqual(Car.objects.count(), 2)
+
+    def test_bulk_create_unavailable(self) -> None:
+        """
+        Test whether cars are reported unavailable when NHTSA is down
+        """
+        self.lookup.side_effect = nhtsa.NhtsaUnavailable
+        cars = [{"make": "Toyota", "model": "Supra"}]
+        response = self.client.post(
+            "/cars/bulk/", json.dumps(cars), content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["data"][0]["status"], "unavailable")
+        self.assertFalse(Car.objects.exists())
+
+    def test_bulk_create_not_a_list(self) -> None:
+        """
+        Test whether a payload other than a list is refused
+        """
+        response = self.client.post(
+            "/cars/bulk/",
+            json.dumps({"make": "Toyota", "model": "Supra"}),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CAR_VALIDATION_QUEUE=1)
+class PendingCarTest(NhtsaStubMixin, TestCase):
+    """
+    Test module for POST /cars/ with the validation queue
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.lookup = self.mock_lookup()
+
+    def post(self, make: str, model: str):
+        return self.client.post("/cars/", {"make": make, "model": model})
+
+    def test_queued(self) -> None:
+        """
+        Test whether cars are accepted without contacting NHTSA
+        """
+        response = self.post("Toyota", "Supra")
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        data = response.json()["data"]
+        self.assertEqual(data["status"], "pending")
+        self.assertEqual(response["Location"], data["url"])
+        self.assertFalse(self.lookup.called)
+        self.assertFalse(Car.objects.exists())
+
+        status_response = self.client.get(data["url"])
+        self.assertEqual(status_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            status_response.json()["data"],
+            {
+                "id": data["id"],
+                "make": "Toyota",
+                "model": "Supra",
+                "status": "pending",
+                "car": None,
+            },
+        )
+
+    def test_process(self) -> None:
+        """
+        Test the status of processed cars and the number of NHTSA lookups
+        """
+        Car.objects.create(make="Toyota", model="Corolla")
+        urls = [
+            self.post(make, model).json()["data"]["url"]
+            for make, model in [
+                ("Toyota", "Supra"),
+                ("toyota", "Golf"),
+                ("Fake", "Car"),
+                ("Toyota", "Supra"),
+            ]
+        ]
+        # Existing cars are refused right away
+        self.assertEqual(
+            self.post("Toyota", "Corolla").status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("process_pending_cars", stdout=out)
+
+        self.assertIn("Processed 4 cars", out.getvalue())
+        # One lookup per make
+        self.assertEqual(self.lookup.call_count, 2)
+        supra = Car.objects.get(make="Toyota", model="Supra")
+        self.assertEqual(
+            [
+                (item["status"], item["car"])
+                for item in (
+                    self.client.get(url).json()["data"] for url in urls
+                )
+            ],
+            [
+                ("created", supra.id),
+                ("not_found", None),
+                ("not_found", None),
+                ("exists", supra.id),
+            ],
+        )
+        self.assertEqual(
+            self.client.get("/cars/").json()["data"][-1]["model"], "Supra"
+        )
+
+    def test_unavailable(self) -> None:
+        """
+        Test whether cars stay pending while NHTSA is down
+        """
+        url = self.post("Toyota", "Supra").json()["data"]["url"]
+        self.lookup.side_effect = nhtsa.NhtsaUnavailable
+
+        self.assertEqual(PendingCar.process(10), {})
+        self.assertEqual(
+            self.client.get(url).json()["data"]["status"], "pending"
+        )
+        # Retried after RETRY_DELAY
+        self.lookup.side_effect = None
+        self.lookup.return_value = frozenset(["supra"])
+        self.assertEqual(PendingCar.process(10), {})
+
+        PendingCar.objects.update(retry_at=timezone.now())
+        self.assertEqual(PendingCar.process(10), {"created": 1})
+
+    def test_failing_head(self) -> None:
+        """
+        Test whether a car which can't be validated doesn't hold up the
+        cars queued after it
+        """
+        self.post("Fake", "Car")
+        self.post("Toyota", "Supra")
+
+        def lookup(make: str) -> frozenset:
+            if make != "toyota":
+                raise nhtsa.NhtsaUnavailable(make)
+            return frozenset(["supra"])
+
+        self.lookup.side_effect = lookup
+
+        self.assertEqual(PendingCar.process(1), {})
+        self.assertEqual(PendingCar.process(1), {"created": 1})
+        head = PendingCar.objects.get(make="Fake")
+        self.assertEqual((head.status, head.attempts), (PendingCar.PENDING, 1))
+        self.assertGreater(head.retry_at, timezone.now())
+
+        # Retried later, with a longer delay after every failure
+        PendingCar.objects.update(retry_at=timezone.now())
+        self.assertEqual(PendingCar.process(1), {})
+        head.refresh_from_db()
+        self.assertEqual(head.attempts, 2)
+        self.assertGreater(
+            head.retry_at,
+            timezone.now() + PendingCar.RETRY_DELAY * 3 / 2,
+        )
+
+    def test_status_not_found(self) -> None:
+        """
+        Test whether unknown pending cars are answered with 404
+        """
+        response = self.client.get("/cars/pending/1/")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RateBulkTest(TestCase):
+    """
+    Test module for POST /rate/bulk/
+    """
+
+    def setUp(self) -> None:
+        Car.objects.create(make="Toyota", model="Supra")
+        Car.objects.create(make="Volkswagen", model="Golf")
+
+    def post(self, ratings):
+        return self.client.post(
+            "/rate/bulk/", json.dumps(ratings), content_type="application/json"
+        )
+
+    def test_bulk_rating(self) -> None:
+        """
+        Test whether ratings are added and aggregated per car
+        """
+        Car.objects.get(id=1).rate(4)
+        ratings = [
+            {"car_id": 1, "rating": 5},
+            {"car_id": 2, "rating": 1},
+            {"car_id": 1, "rating": 3},
+            {"car_id": 2, "rating": 2},
+            {"car_id": 2, "rating": 2},
+        ]
+        response = self.post(ratings)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Rating.objects.count(), 5)
+        car_1 = Car.objects.get(id=1)
+        car_2 = Car.objects.get(id=2)
+        self.assertEqual(car_1.avg_rating, 4.0)  # Average = 4+5+3/3
+        self.assertEqual(car_1.rates_number, 3)
+        self.assertEqual(car_2.avg_rating, 1.7)  # Average = 1+2+2/3
+        self.assertEqual(car_2.rates_number, 3)
+
+    def test_bulk_rating_invalid(self) -> None:
+        """
+        Test whether no rating is added when any of them is invalid
+        """
+        response = self.post(
+            [
+                {"car_id": 1, "rating": 5},
+                {"car_id": 3, "rating": 5},
+                {"car_id": 2, "rating": 8},
+            ]
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Rating.objects.exists())
+
+        response = self.post(
+            [{"car_id": 1, "rating": 5}, {"car_id": 3, "rating": 5}]
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.json()["data"][0], {})
+        self.assertIn("car_id", response.json()["data"][1])
+        self.assertFalse(Rating.objects.exists())
+        self.assertEqual(Car.objects.get(id=1).rates_number, 0)
+
+
+class RateWriteBehindTest(TestCase):
+    """
+    Test module for POST /rate/ with RATING_WRITE_BEHIND
+    """
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(
+            RATING_WRITE_BEHIND=1,
+            RATING_FLUSH_INTERVAL=0,
+            RATING_BUFFER_PATH=os.path.join(directory.name, "buffer.sqlite3"),
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        Car.objects.create(make="Toyota", model="Supra")
+        Car.objects.create(make="Volkswagen", model="Golf")
+
+    def test_queued_rating(self) -> None:
+        """
+        Test whether ratings are queued, and written by the flush
+        """
+        for rating in [1, 2, 5]:
+            response = self.client.post(
+                "/rate/", {"car_id": 1, "rating": rating}
+            )
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.client.post("/rate/", {"car_id": 2, "rating": 4})
+
+        self.assertEqual(Car.objects.get(id=1).rates_number, 0)
+        response = self.client.get("/rate/pending/")
+        self.assertEqual(response.json()["data"]["pending"], 4)
+
+        out = StringIO()
+        call_command("flush_rating_buffer", "--batch=3", stdout=out)
+
+        self.assertEqual(
+            out.getvalue().strip(), "Flushed 4 ratings, 0 pending"
+        )
+        self.assertEqual(Rating.objects.count(), 4)
+        car = Car.objects.get(id=1)
+        self.assertEqual(car.rates_number, 3)
+        self.assertEqual(car.avg_rating, 2.7)
+
+    def test_invalid_rating(self) -> None:
+        """
+        Test whether invalid ratings are refused rather than queued
+        """
+        response = self.client.post("/rate/", {"car_id": 3, "rating": 5})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(rating_buffer.get_buffer().pending()["pending"], 0)
+
+    def test_deleted_car(self) -> None:
+        """
+        Test whether ratings of cars deleted before the flush are dropped
+        """
+        self.client.post("/rate/", {"car_id": 1, "rating": 5})
+        self.client.post("/rate/", {"car_id": 2, "rating": 5})
+        Car.objects.filter(id=2).delete()
+
+        self.assertEqual(rating_buffer.get_buffer().flush(10), 2)
+        self.assertEqual(Rating.objects.count(), 1)
+
+    def test_crash_after_write(self) -> None:
+        """
+        Test whether a batch written by a flusher that died before
+        removing it from the queue isn't written again
+        """
+        self.client.post("/rate/", {"car_id": 1, "rating": 5})
+        self.client.post("/rate/", {"car_id": 2, "rating": 3})
+        buffer = rating_buffer.get_buffer()
+        apply = RatingBatch.apply
+
+        def apply_and_die(token, ratings):
+            apply(token, ratings)
+            raise KeyboardInterrupt
+
+        with mock.patch.object(RatingBatch, "apply", apply_and_die):
+            with self.assertRaises(KeyboardInterrupt):
+                buffer.flush(10)
+        self.assertEqual(buffer.pending()["pending"], 2)
+
+        self.assertEqual(buffer.flush(10), 2)
+        self.assertEqual(Rating.objects.count(), 2)
+        self.assertEqual(Car.objects.get(id=1).rates_number, 1)
+        self.assertEqual(buffer.pending()["pending"], 0)
+
+    def test_slow_flush_taken_over(self) -> None:
+        """
+        Test whether a batch taken over from a flusher slower than
+        CLAIM_TIMEOUT is written once
+        """
+        self.client.post("/rate/", {"car_id": 1, "rating": 5})
+        buffer = rating_buffer.get_buffer()
+        apply = RatingBatch.apply
+        later = rating_buffer.time.time() + rating_buffer.CLAIM_TIMEOUT + 1
+        applied = []
+
+        def slow_apply(token, ratings):
+            if not applied:
+                applied.append(token)
+                # Another flusher runs meanwhile, the claim looks stale
+                with mock.patch.object(
+                    rating_buffer.time, "time", return_value=later
+                ):
+                    self.assertEqual(buffer.flush(10), 1)
+            applied.append(apply(token, ratings))
+            return applied[-1]
+
+        with mock.patch.object(RatingBatch, "apply", slow_apply):
+            self.assertEqual(buffer.flush(10), 1)
+
+        self.assertEqual(applied[1:], [True, False])
+        self.assertEqual(Rating.objects.count(), 1)
+        self.assertEqual(Car.objects.get(id=1).rates_number, 1)
+        self.assertEqual(buffer.pending()["pending"], 0)
+
+    def test_flusher_starts_with_first_request(self) -> None:
+        """
+        Test whether the flusher thread starts with the first request of
+        the worker, so that ratings queued before a restart are written,
+        but not with the app, which management commands load too
+        """
+        self.addCleanup(
+            request_started.disconnect, dispatch_uid=rating_buffer.__name__
+        )
+        with mock.patch.object(rating_buffer, "start_flusher") as start:
+            apps.get_app_config("carapi").ready()
+            start.assert_not_called()
+            self.client.get("/rate/pending/")
+            self.client.get("/rate/pending/")
+
+        start.assert_called_once_with()
+
+
+class CarStatsTest(TestCase):
+    """
+    Test module for GET /cars/{id}/stats/
+    """
+
+    def setUp(self) -> None:
+        Car.objects.create(make="Toyota", model="Supra")
+
+    def test_stats(self) -> None:
+        """
+        Test whether the distribution is calculated from the star counters
+        """
+        car = Car.objects.get(id=1)
+        for rating in [5, 1, 4, 4, 5, 5, 3, 5]:
+            car.rate(rating)
+        Rating.objects.all().delete()  # Not read by the endpoint
+
+        with self.assertNumQueries(1):
+            response = self.client.get("/cars/1/stats/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()["data"]
+        self.assertEqual(data["count"], 8)
+        self.assertEqual(data["mean"], 4.0)
+        self.assertEqual(data["median"], 4.5)
+        self.assertEqual(
+            data["percentiles"],
+            {"p25": 3, "p50": 4, "p75": 5, "p90": 5, "p95": 5, "p99": 5},
+        )
+        self.assertEqual(
+            data["histogram"], {"1": 1, "2": 0, "3": 1, "4": 2, "5": 4}
+        )
+
+    def test_stats_no_ratings(self) -> None:
+        """
+        Test the statistics of a car without ratings
+        """
+        data = self.client.get("/cars/1/stats/").json()["data"]
+
+        self.assertEqual(data["count"], 0)
+        self.assertIsNone(data["mean"])
+        self.assertIsNone(data["median"])
+        self.assertIsNone(data["percentiles"]["p50"])
+
+    def test_stats_invalid_car(self) -> None:
+        """
+        Test the statistics of a car that doesn't exist
+        """
+        response = self.client.get("/cars/2/stats/")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    },
+    PAGE_SIZE=2,
+)
+class PaginationTest(TestCase):
+    """
+    Test module for the keyset pagination of the list endpoints
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        for model in ["A", "B", "C", "D", "E"]:
+            Car.objects.create(make="Toyota", model=model)
+        Rating.bulk_add([(2, 5), (2, 4), (4, 3), (5, 1), (5, 2), (3, 1)])
+
+    def walk(self, url: str) -> list:
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.json()["data"])
+            url = response.json()["next"]
+        return pages
+
+    def test_cars(self) -> None:
+        """
+        Test whether all cars are listed once, in pages by id
+        """
+        pages = self.walk("/cars/")
+
+        self.assertEqual(
+            [[car["id"] for car in page] for page in pages],
+            [[1, 2], [3, 4], [5]],
+        )
+
+    def test_popular(self) -> None:
+        """
+        Test whether cars with the same number of ratings are paged by id
+        """
+        pages = self.walk("/popular/")
+
+        self.assertEqual(
+            [[car["id"] for car in page] for page in pages],
+            [[5, 2], [4, 3], [1]],
+        )
+
+    def test_page_size(self) -> None:
+        """
+        Test the page size query parameter and the cost of a deep page
+        """
+        response = self.client.get("/rate/?page_size=4")
+        self.assertEqual(len(response.json()["data"]), 4)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(response.json()["next"])
+        self.assertEqual(len(response.json()["data"]), 2)
+        self.assertIsNone(response.json()["next"])
+
+    def test_invalid_cursor(self) -> None:
+        """
+        Test a cursor that wasn't returned by the API
+        """
+        response = self.client.get("/cars/?cursor=nonsense")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_values(self) -> None:
+        """
+        Test cursors holding values of the wrong types or number
+        """
+        for url, values in [
+            ("/cars/", ["abc"]),
+            ("/cars/", [{"a": 1}]),
+            ("/cars/", [1.5]),
+            ("/cars/", [True]),
+            ("/rate/", [1, 2]),
+            ("/popular/", ["x", 1]),
+            ("/popular/", [None, None]),
+        ]:
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode())
+            response = self.client.get(url, {"cursor": cursor.decode()})
+
+            self.assertEqual(
+                response.status_code, status.HTTP_404_NOT_FOUND, values
+            )
+
+
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    },
+    LEADERBOARD_SIZE=3,
+)
+class LeaderboardTest(TestCase):
+    """
+    Test module for the /popular/ leaderboard
+    """
+
+    def setUp(self) -> None:
+        for model in ["A", "B", "C", "D"]:
+            Car.objects.create(make="Toyota", model=model)
+        Rating.bulk_add([(1, 5), (1, 4), (2, 3), (3, 1), (3, 2), (3, 3)])
+        leaderboard.invalidate()
+        self.addCleanup(leaderboard.invalidate)
+
+    def popular(self) -> list:
+        response = self.client.get("/popular/?page_size=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [car["id"] for car in response.json()["data"]]
+
+    def test_served_from_cache(self) -> None:
+        """
+        Test whether /popular/ doesn't query the database once loaded
+        """
+        self.assertEqual(self.popular(), [3, 1, 2])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.popular(), [3, 1, 2])
+
+    def test_rating_updates_leaderboard(self) -> None:
+        """
+        Test whether ratings changing the leaderboard load it again
+        """
+        self.popular()
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(4):
+                self.client.post("/rate/", {"car_id": 4, "rating": 5})
+        with self.captureOnCommitCallbacks(execute=True):
+            Rating.bulk_add([(2, 1), (2, 1), (2, 1), (2, 1)])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.popular(), [2, 4, 3])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.popular(), [2, 4, 3])
+        self.assertEqual(leaderboard.top()["rows"][0]["rates_number"], 5)
+
+    def test_rating_below_cutoff(self) -> None:
+        """
+        Test whether ratings of cars which can't enter the leaderboard
+        leave it as it is
+        """
+        Rating.bulk_add([(2, 2)])
+        self.assertEqual(self.popular(), [3, 2, 1])
+        version = dataversion.current([leaderboard.SCOPE])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/rate/", {"car_id": 4, "rating": 5})
+
+        self.assertEqual(dataversion.current([leaderboard.SCOPE]), version)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.popular(), [3, 2, 1])
+
+    def test_delete_invalidates_leaderboard(self) -> None:
+        """
+        Test whether a deleted car leaves the leaderboard
+        """
+        self.popular()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete("/cars/3/")
+
+        self.assertEqual(self.popular(), [1, 2, 4])
+
+    def test_deep_page(self) -> None:
+        """
+        Test whether pages past the leaderboard are read from the database
+        """
+        response = self.client.get("/popular/?page_size=2")
+        self.assertEqual(
+            [car["id"] for car in response.json()["data"]], [3, 1]
+        )
+
+        response = self.client.get(response.json()["next"])
+        self.assertEqual(
+            [car["id"] for car in response.json()["data"]], [2, 4]
+        )
+        self.assertIsNone(response.json()["next"])
+
+
+class ExportTest(TestCase):
+    """
+    Test module for GET /cars/export/ and /rate/export/
+    """
+
+    def setUp(self) -> None:
+        Car.objects.create(make="Toyota", model="Supra")
+        Car.objects.create(make="Volkswagen", model="Golf, GTI")
+        Rating.bulk_add([(1, 5), (1, 4), (2, 3)])
+
+    def test_export_ndjson(self) -> None:
+        """
+        Test whether every car is streamed as one JSON line
+        """
+        response = self.client.get("/cars/export/ndjson/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [
+                {
+                    "id": 1,
+                    "make": "Toyota",
+                    "model": "Supra",
+                    "avg_rating": 4.5,
+                    "rates_number": 2,
+                },
+                {
+                    "id": 2,
+                    "make": "Volkswagen",
+                    "model": "Golf, GTI",
+                    "avg_rating": 3.0,
+                    "rates_number": 1,
+                },
+            ],
+        )
+
+    def test_export_csv(self) -> None:
+        """
+        Test the CSV export of the ratings
+        """
+        response = self.client.get("/rate/export/csv/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            b"".join(response.streaming_content).decode(),
+            "id,car_id,rating\r\n1,1,5\r\n2,1,4\r\n3,2,3\r\n",
+        )
+
+    @override_settings(EXPORT_CHUNK_SIZE=1)
+    def test_export_gzip(self) -> None:
+        """
+        Test whether the export is compressed when the client accepts it
+        """
+        response = self.client.get(
+            "/cars/export/csv/", HTTP_ACCEPT_ENCODING="br, gzip;q=0.8"
+        )
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        body = gzip.decompress(b"".join(response.streaming_content))
+        self.assertEqual(
+            body.decode().splitlines()[2], '2,Volkswagen,"Golf, GTI",3.0,1'
+        )
+
+    def test_export_unknown_format(self) -> None:
+        """
+        Test an export format that isn't supported
+        """
+        response = self.client.get("/cars/export/xml/")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class FastListTest(TestCase):
+    """
+    Test module for the FAST_LIST read path of the list endpoints
+    """
+
+    def setUp(self) -> None:
+        for make, model in [("Toyota", "Supra"), ("Škoda", "Octavia")]:
+            Car.objects.create(make=make, model=model)
+        Car.objects.create(make="Fake", model="Car", rates_number=None)
+        Rating.bulk_add([(1, 5), (1, 4), (2, 3)])
+        leaderboard.invalidate()
+
+    def pages(self, url: str) -> list:
+        contents = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            contents.append(response.content)
+            url = response.json()["next"]
+        return contents
+
+    @override_settings(LEADERBOARD_SIZE=0)
+    def test_same_response(self) -> None:
+        """
+        Test whether the responses are byte for byte the same
+        """
+        for url in [
+            "/cars/",
+            "/cars/?page_size=1",
+            "/rate/?page_size=2",
+            "/popular/?page_size=1",
+        ]:
+            with self.settings(FAST_LIST=0):
+                expected = self.pages(url)
+            with self.settings(FAST_LIST=1):
+                self.assertEqual(self.pages(url), expected)
+
+        with self.settings(FAST_LIST=1):
+            self.assertEqual(
+                self.client.get("/popular/").json()["data"],
+                [
+                    {
+                        "id": 1,
+                        "make": "Toyota",
+                        "model": "Supra",
+                        "rates_number": 2,
+                    },
+                    {
+                        "id": 2,
+                        "make": "Škoda",
+                        "model": "Octavia",
+                        "rates_number": 1,
+                    },
+                ],
+            )
+
+
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+)
+class ConditionalGetTest(TestCase):
+    """
+    Test module for the ETag & Last-Modified headers of the listings
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        Car.objects.create(make="Toyota", model="Supra")
+        Car.objects.create(make="Volkswagen", model="Golf")
+
+    def test_etag(self) -> None:
+        """
+        Test whether unchanged listings are answered with 304
+        """
+        etag = self.client.get("/cars/")["ETag"]
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/cars/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+        response = self.client.get("/cars/?page_size=1")
+        self.assertNotEqual(response["ETag"], etag)
+
+        response = self.client.get("/rate/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_writes_change_etag(self) -> None:
+        """
+        Test whether ratings and deletions change the ETag
+        """
+        etags = {self.client.get("/popular/")["ETag"]}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/rate/", {"car_id": 1, "rating": 5})
+        etags.add(self.client.get("/popular/")["ETag"])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete("/cars/2/")
+        etag = self.client.get("/popular/")["ETag"]
+        etags.add(etag)
+
+        self.assertEqual(len(etags), 3)
+        response = self.client.get("/popular/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_last_modified(self) -> None:
+        """
+        Test If-Modified-Since, Last-Modified is only sent for
+        data that didn't change in the current second
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            dataversion.bump("ratings")
+        self.assertFalse(self.client.get("/rate/").has_header("Last-Modified"))
+
+        cache.set(dataversion.KEY + "ratings", ("old", 1000000000.5), None)
+        last_modified = self.client.get("/rate/")["Last-Modified"]
+        self.assertEqual(last_modified, "Sun, 09 Sep 2001 01:46:40 GMT")
+
+        response = self.client.get(
+            "/rate/", HTTP_IF_MODIFIED_SINCE=last_modified
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Rating.bulk_add([(1, 4)])
+        response = self.client.get(
+            "/rate/", HTTP_IF_MODIFIED_SINCE=last_modified
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_version_lost_after_add(self) -> None:
+        """
+        Test whether a version is returned when the one added by another
+        request is gone before it's read
+        """
+        cache.delete(dataversion.KEY + "ratings")
+        with mock.patch.object(cache, "add", return_value=False):
+            [(token, modified)] = dataversion.current(["ratings"])
+
+        self.assertIsInstance(token, str)
+        self.assertIsInstance(modified, float)
+
+    def test_database_cache_warning(self) -> None:
+        """
+        Test whether keeping the data versions in the database is reported
+        """
+        self.assertEqual(dataversion.check_cache(None), [])
+        db_cache = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                "LOCATION": "carapi_cache",
+            }
+        }
+        with self.settings(CACHES=db_cache):
+            warnings = dataversion.check_cache(None)
+        self.assertEqual([warning.id for warning in warnings], ["carapi.W001"])
+
+
+@override_settings(
+    CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "default",
+        },
+        # Local stand-in for an external cache
+        "responses": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "responses",
+        },
+    },
+    RESPONSE_CACHE_TTL=60,
+    LEADERBOARD_SIZE=0,
+)
+class ResponseCacheTest(TestCase):
+    """
+    Test module for the cache of rendered listings
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        caches["responses"].clear()
+        Car.objects.create(make="Toyota", model="Supra")
+        Car.objects.create(make="Volkswagen", model="Golf")
+
+    def test_cached(self) -> None:
+        """
+        Test whether listings are served from the cache until changed
+        """
+        content = self.client.get("/popular/?page_size=5&x=1").content
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/popular/?x=1&page_size=5")
+        self.assertEqual(response.content, content)
+        self.assertEqual(response["Content-Type"], "application/json")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/rate/", {"car_id": 2, "rating": 5})
+        response = self.client.get("/popular/?page_size=5&x=1")
+        self.assertNotEqual(response.content, content)
+        self.assertEqual(response.json()["data"][0]["id"], 2)
+
+    def test_headers(self) -> None:
+        """
+        Test whether cached listings are sent the headers of the
+        rendered ones
+        """
+        headers = self.client.get("/cars/").headers
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/cars/")
+        for name in ["Content-Type", "Allow", "Vary"]:
+            self.assertEqual(response[name], headers[name])
+        self.assertIn("Accept", response["Vary"])
+
+    @override_settings(ALLOWED_HOSTS=["testserver", "other.example"])
+    def test_hosts(self) -> None:
+        """
+        Test whether entries are kept apart by host and scheme, the next
+        links being absolute URLs
+        """
+        url = "/cars/?page_size=1"
+        links = {self.client.get(url).json()["next"]}
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_HOST="other.example")
+        links.add(response.json()["next"])
+        with self.assertNumQueries(1):
+            links.add(self.client.get(url, secure=True).json()["next"])
+
+        self.assertEqual(
+            {link.split("/cars/")[0] for link in links},
+            {
+                "http://testserver",
+                "http://other.example",
+                "https://testserver",
+            },
+        )
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_HOST="other.example")
+        self.assertIn("other.example", response.json()["next"])
+
+    def test_scopes(self) -> None:
+        """
+        Test whether ratings don't invalidate unrelated entries
+        """
+        self.client.get("/rate/")
+        with self.captureOnCommitCallbacks(execute=True):
+            dataversion.bump("cars")
+
+        with self.assertNumQueries(0):
+            self.client.get("/rate/")
+        with self.assertNumQueries(1):
+            self.client.get("/cars/")
+
+    def test_stampede(self) -> None:
+        """
+        Test whether requests don't render an entry being rendered
+        """
+        key = response_cache.KEY + "cars"
+        patcher = mock.patch.object(
+            response_cache, "cache_key", return_value=key
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.get("/cars/")
+        entry = caches["responses"].get(key)
+        entry["expires"] = 0
+        caches["responses"].set(key, entry)
+        caches["responses"].add(key + ":lock", 1)
+
+        # Expired: served the old copy while it's refreshed
+        with self.assertNumQueries(0):
+            response = self.client.get("/cars/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Outdated: waits for the refresh, renders it itself at last
+        with self.captureOnCommitCallbacks(execute=True):
+            dataversion.bump("cars")
+        with mock.patch.object(response_cache, "LOCK_WAIT", 0.05):
+            with self.assertNumQueries(1):
+                self.client.get("/cars/")
+
+
+class AsyncViewTest(NhtsaStubMixin, TestCase):
+    """
+    Test module for the async /async/cars/ and /async/rate/ views,
+    against a local NHTSA stub
+    """
+
+    def test_create_car(self) -> None:
+        """
+        Test whether cars are validated and saved like by POST /cars/
+        """
+        response = self.client.post(
+            "/async/cars/", {"make": "Toyota", "model": "Supra"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            response.json(),
+            {
+                "status": "success",
+                "data": {"make": "Toyota", "model": "Supra"},
+            },
+        )
+        self.assertTrue(Car.objects.filter(make="Toyota").exists())
+
+        response = self.client.post(
+            "/async/cars/",
+            {"make": "Toyota", "model": "Supra"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.post(
+            "/async/cars/", {"make": "Toyota", "model": "Golf"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        self.assertEqual(response.json()["data"], "Toyota Golf doesn't exist")
+        self.assertEqual(self.stub.requests, 1)
+
+    def test_nhtsa_unavailable(self) -> None:
+        """
+        Test whether 503 is returned when NHTSA can't be reached
+        """
+        self.stub.status = 500
+        response = self.client.post(
+            "/async/cars/", {"make": "Toyota", "model": "Supra"}
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+
+    def test_list_cars(self) -> None:
+        """
+        Test whether the listing is the same as GET /cars/
+        """
+        Car.objects.create(make="Toyota", model="Supra")
+        Car.objects.create(make="Toyota", model="Corolla")
+
+        response = self.client.get("/async/cars/?page_size=1")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.content,
+            self.client.get("/cars/?page_size=1").content.replace(
+                b"/cars/", b"/async/cars/"
+            ),
+        )
+
+    def test_rate(self) -> None:
+        """
+        Test whether ratings update the car like POST /rate/
+        """
+        car = Car.objects.create(make="Toyota", model="Supra")
+        response = self.client.post(
+            "/async/rate/", {"car_id": car.id, "rating": 4}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            response.json(),
+            {"status": "success", "data": {"car_id": car.id, "rating": 4}},
+        )
+        car.refresh_from_db()
+        self.assertEqual(car.rates_number, 1)
+        self.assertEqual(car.avg_rating, 4)
+
+        response = self.client.post(
+            "/async/rate/", {"car_id": car.id + 1, "rating": 4}
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            self.client.get("/async/rate/").status_code,
+            status.HTTP_405_METHOD_NOT_ALLOWED,
+        )
+
+    def test_malformed_body(self) -> None:
+        """
+        Test whether unreadable bodies are answered with 400 like by the
+        viewsets
+        """
+        for url in ["/cars/", "/rate/"]:
+            expected = self.client.post(
+                url, "{", content_type="application/json"
+            )
+            response = self.client.post(
+                "/async" + url, "{", content_type="application/json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.json(), expected.json())
+
+    @override_settings(CAR_VALIDATION_QUEUE=1)
+    def test_queued(self) -> None:
+        """
+        Test whether cars are queued like by POST /cars/
+        """
+        response = self.client.post(
+            "/async/cars/", {"make": "Toyota", "model": "Supra"}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response["Location"], response.json()["data"]["url"])
+        self.assertTrue(PendingCar.objects.filter(model="Supra").exists())
+        self.assertFalse(Car.objects.exists())
+        self.assertEqual(self.stub.requests, 0)
+
+    def test_middleware_async(self) -> None:
+        """
+        Test whether all the middleware is async capable, otherwise Django
+        runs async views one at a time in a thread under ASGI
+        """
+        for path in settings.MIDDLEWARE:
+            self.assertTrue(
+                getattr(import_string(path), "async_capable", False), path
+            )
+
+
+class MetricsTest(NhtsaStubMixin, TestCase):
+    """
+    Test module for the request metrics at /metrics
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def samples(self) -> dict:
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        return dict(
+            line.rsplit(" ", 1)
+            for line in response.content.decode().splitlines()
+            if not line.startswith("#")
+        )
+
+    def test_request_metrics(self) -> None:
+        """
+        Test whether requests are timed, and their queries and
+        serializer time counted, per view
+        """
+        Car.objects.create(make="Toyota", model="Supra")
+        self.client.get("/cars/")
+        self.client.get("/cars/")
+
+        samples = self.samples()
+        labels = '{view="cars-list",method="GET",status="200"}'
+        self.assertEqual(
+            samples["carapi_request_duration_seconds_count" + labels], "2"
+        )
+        self.assertEqual(
+            samples[
+                "carapi_request_duration_seconds_bucket"
+                + labels[:-1]
+                + ',le="+Inf"}'
+            ],
+            "2",
+        )
+        self.assertGreater(
+            float(samples['carapi_request_db_queries_sum{view="cars-list"}']),
+            0,
+        )
+        self.assertGreater(
+            float(
+                samples[
+                    'carapi_request_serializer_seconds_sum{view="cars-list"}'
+                ]
+            ),
+            0,
+        )
+
+    def test_nhtsa_metrics(self) -> None:
+        """
+        Test whether NHTSA requests are timed by outcome
+        """
+        self.client.post("/cars/", {"make": "Toyota", "model": "Supra"})
+        self.stub.status = 500
+        self.client.post("/cars/", {"make": "Fake", "model": "Car"})
+
+        samples = self.samples()
+        for outcome in ("ok", "error"):
+            self.assertEqual(
+                samples[
+                    "carapi_nhtsa_request_duration_seconds_count"
+                    '{outcome="%s"}' % outcome
+                ],
+                "1",
+            )
+
+    def test_processes_added_up(self) -> None:
+        """
+        Test whether the metrics files of all the processes are added up
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        other = metrics.Registry(os.path.join(directory.name, "1-other.json"))
+        other.observe("request_db_queries", 3, "cars-list")
+        other.inc("nhtsa_short_circuits_total")
+        with override_settings(METRICS_DIR=directory.name):
+            other.flush(force=True)
+            self.client.get("/cars/")
+            samples = self.samples()
+
+        self.assertEqual(len(os.listdir(directory.name)), 2)
+        self.assertEqual(
+            samples['carapi_request_db_queries_count{view="cars-list"}'], "2"
+        )
+        self.assertEqual(samples["carapi_nhtsa_short_circuits_total"], "1")
+
+    def test_concurrent_flushes(self) -> None:
+        """
+        Test whether threads flushing at once all succeed, and leave a
+        complete file only
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        registry = metrics.Registry(os.path.join(directory.name, "1-a.json"))
+        registry.inc("nhtsa_short_circuits_total")
+
+        with ThreadPoolExecutor(8) as executor:
+            for future in [
+                executor.submit(registry.flush, force=True) for _ in range(50)
+            ]:
+                future.result()
+
+        self.assertEqual(os.listdir(directory.name), ["1-a.json"])
+        with open(registry.path) as f:
+            self.assertEqual(
+                json.load(f), [["nhtsa_short_circuits_total", [], 1]]
+            )
+
+    def test_flush_error(self) -> None:
+        """
+        Test whether a metrics file that can't be written is only logged
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # A file where the directory of the metrics should be
+        path = os.path.join(directory.name, "file")
+        open(path, "w").close()
+        registry = metrics.Registry(os.path.join(path, "1-a.json"))
+
+        with self.assertLogs("carapi.metrics", "ERROR"):
+            registry.flush(force=True)
+
+    @override_settings(METRICS=0)
+    def test_disabled(self) -> None:
+        """
+        Test whether nothing is recorded with METRICS=0
+        """
+        self.client.get("/cars/")
+
+        self.assertEqual(self.samples(), {})
+
+
+class QueryBudgetTest(TestCase):
+    """
+    Test module for the query budgets of the viewset actions,
+    enforced by the test runner
+    """
+
+    def setUp(self) -> None:
+        self.car = Car.objects.create(make="Toyota", model="Supra")
+        caches["responses"].clear()
+
+    def test_over_budget(self) -> None:
+        """
+        Test whether an action exceeding its budget fails, reporting
+        its queries and where they are sent from
+        """
+        with mock.patch.object(
+            views.CarViewSet, "query_budgets", {"list": 0}
+        ), self.assertRaises(query_budget.QueryBudgetExceeded) as raised:
+            self.client.get("/cars/")
+
+        message = str(raised.exception)
+        self.assertIn(
+            "CarViewSet.list (GET /cars/): 1 queries, budget 0", message
+        )
+        self.assertIn('FROM "carapi_car"', message)
+        self.assertIn("at carapi/pagination.py:", message)
+
+    def test_missing_budget(self) -> None:
+        """
+        Test whether an action without a budget fails
+        """
+        with mock.patch.object(
+            views.CarViewSet, "query_budgets", {}
+        ), self.assertRaisesMessage(
+            query_budget.QueryBudgetExceeded,
+            "no query budget declared for list",
+        ):
+            self.client.get("/cars/")
+
+    def test_n_plus_one(self) -> None:
+        """
+        Test whether a query repeated with other parameters is reported,
+        even within the budget
+        """
+        rate = Car.rate
+
+        def reload_and_rate(car, new_rating) -> None:
+            # Like a view loading the car again before rating it
+            rate(Car.objects.get(id=car.id), new_rating)
+
+        with mock.patch.object(Car, "rate", reload_and_rate), mock.patch.dict(
+            views.RateViewSet.query_budgets, {"create": 10}
+        ):
+            with self.assertRaises(query_budget.QueryBudgetExceeded) as raised:
+                self.client.post(
+                    "/rate/", {"car_id": self.car.id, "rating": 5}
+                )
+
+        message = str(raised.exception)
+        self.assertIn("N+1: 2 queries of the same shape", message)
+        self.assertIn('WHERE "carapi_car"."id" = %s', message)
+        self.assertIn("in save_rating", message)
+
+    def test_n_plus_one_without_budget(self) -> None:
+        """
+        Test whether actions without a budget are still checked for N+1
+        queries, except for the queries sent once per item by design
+        """
+        Car.objects.create(make="Volkswagen", model="Golf")
+        ratings = [{"car_id": 1, "rating": 5}, {"car_id": 2, "rating": 5}]
+        response = self.client.post(
+            "/rate/bulk/", json.dumps(ratings), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        def bulk_add(ratings) -> list:
+            # Like a bulk action rating the cars one by one
+            for car_id, rating in ratings:
+                Car.objects.get(id=car_id).rate(rating)
+            return []
+
+        with mock.patch.object(Rating, "bulk_add", bulk_add):
+            with self.assertRaisesMessage(
+                query_budget.QueryBudgetExceeded,
+                "RateViewSet.bulk (POST /rate/bulk/): N+1: 2 queries",
+            ):
+                self.client.post(
+                    "/rate/bulk/",
+                    json.dumps(ratings),
+                    content_type="application/json",
+                )
+
+    def test_within_budget(self) -> None:
+        """
+        Test whether the rating of a car loads it only once
+        """
+        response = self.client.post(
+            "/rate/", {"car_id": self.car.id, "rating": 5}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    @override_settings(QUERY_BUDGET="log")
+    def test_log(self) -> None:
+        """
+        Test whether violations are logged with QUERY_BUDGET="log"
+        """
+        with mock.patch.object(
+            views.CarViewSet, "query_budgets", {"list": 0}
+        ), self.assertLogs("carapi.query_budget", "WARNING") as logs:
+            response = self.client.get("/cars/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("1 queries, budget 0", logs.output[0])
+
+    @override_settings(QUERY_BUDGET="off")
+    def test_off(self) -> None:
+        """
+        Test whether nothing is checked with QUERY_BUDGET="off"
+        """
+        with mock.patch.object(views.CarViewSet, "query_budgets", {}):
+            response = self.client.get("/cars/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaTest(TestCase):
+    """
+    Test module for the read replicas. The "replica" database doesn't
+    replicate the primary, its cars tell which database was read.
+    """
+
+    databases = {"default", "replica"}
+
+    def setUp(self) -> None:
+        self.car = Car.objects.create(make="Toyota", model="Supra")
+        Car.objects.using("replica").create(make="Ford", model="Focus")
+        caches["responses"].clear()
+        replicas.health.checked.clear()
+        self.addCleanup(replicas.health.checked.clear)
+
+    def makes(self, path: str = "/cars/") -> list:
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [car["make"] for car in response.json()["data"]]
+
+    def test_reads_from_replica(self) -> None:
+        """
+        Test whether the listings are read from the replica
+        """
+        self.assertEqual(self.makes(), ["Ford"])
+        Rating.objects.using("replica").create(
+            car_id=Car.objects.using("replica").get(), rating=5
+        )
+        self.assertEqual(
+            [r["car_id"] for r in self.client.get("/rate/").json()["data"]],
+            [1],
+        )
+
+    def test_export_from_replica(self) -> None:
+        """
+        Test whether the streamed exports are read from the replica
+        """
+        response = self.client.get("/cars/export/ndjson/")
+
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn("Ford", content)
+        self.assertNotIn("Toyota", content)
+
+    def test_writes_to_primary(self) -> None:
+        """
+        Test whether writes, and the reads of other actions, go to the
+        primary
+        """
+        response = self.client.post(
+            "/rate/", {"car_id": self.car.id, "rating": 4}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Rating.objects.count(), 1)
+        self.assertEqual(Rating.objects.using("replica").count(), 0)
+
+    def test_pinned_after_write(self) -> None:
+        """
+        Test whether a client reads from the primary after writing
+        """
+        response = self.client.post(
+            "/rate/", {"car_id": self.car.id, "rating": 4}
+        )
+
+        cookie = response.cookies[settings.REPLICA_PIN_COOKIE]
+        self.assertEqual(cookie["max-age"], settings.REPLICA_PIN_SECONDS)
+        self.assertEqual(self.makes(), ["Toyota"])
+        # Other clients still read from the replica
+        self.client.cookies.clear()
+        self.assertEqual(self.makes(), ["Ford"])
+
+    def test_not_pinned_after_failed_write(self) -> None:
+        """
+        Test whether failed writes don't pin the client
+        """
+        response = self.client.post(
+            "/rate/", {"car_id": self.car.id, "rating": 6}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+        self.assertEqual(self.makes(), ["Ford"])
+
+    @override_settings(RESPONSE_CACHE_TTL=60)
+    def test_cached_apart(self) -> None:
+        """
+        Test whether listings read from the replica aren't served to
+        pinned clients from the response cache
+        """
+        self.assertEqual(self.makes(), ["Ford"])
+        self.client.cookies[settings.REPLICA_PIN_COOKIE] = "1"
+
+        self.assertEqual(self.makes(), ["Toyota"])
+
+    @override_settings(RESPONSE_CACHE_TTL=60)
+    def test_lagging_replica(self) -> None:
+        """
+        Test whether listings read from the replica right after a write,
+        maybe without it, are neither cached nor given validators
+        """
+        dataversion.replace("cars")
+        response = self.client.get("/cars/")
+        self.assertFalse(response.has_header("ETag"))
+        self.assertFalse(response.has_header("Last-Modified"))
+        Car.objects.using("replica").create(make="Ford", model="Fiesta")
+        self.assertEqual(self.makes(), ["Ford", "Ford"])
+        # The primary has the write
+        self.client.cookies[settings.REPLICA_PIN_COOKIE] = "1"
+        self.assertTrue(self.client.get("/cars/").has_header("ETag"))
+
+        self.client.cookies.clear()
+        token, modified = dataversion.current(["cars"])[0]
+        cache.set(
+            dataversion.KEY + "cars",
+            (token, modified - settings.REPLICA_PIN_SECONDS),
+            None,
+        )
+        etag = self.client.get("/cars/")["ETag"]
+        Car.objects.using("replica").create(make="Ford", model="Ka")
+        # Cached, and answered with 304 until the next write
+        self.assertEqual(self.makes(), ["Ford", "Ford"])
+        response = self.client.get("/cars/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_unhealthy(self) -> None:
+        """
+        Test whether the primary is read when the replica fails its
+        health check, which is repeated every REPLICA_CHECK_INTERVAL
+        """
+        with mock.patch.object(
+            replicas.HealthChecks, "check", return_value=False
+        ) as check:
+            self.assertEqual(self.makes(), ["Toyota"])
+            self.assertEqual(self.makes(), ["Toyota"])
+
+        self.assertEqual(check.call_count, 1)
+        self.assertEqual(replicas.health.info(), {"replica": False})
+
+    def test_health_check(self) -> None:
+        """
+        Test the health check of a replica
+        """
+        self.assertTrue(replicas.health.healthy("replica"))
+        with mock.patch(
+            "django.db.backends.sqlite3.base.DatabaseWrapper.create_cursor",
+            side_effect=DatabaseError,
+        ), override_settings(REPLICA_CHECK_INTERVAL=0):
+            self.assertFalse(replicas.health.healthy("replica"))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_disabled(self) -> None:
+        """
+        Test whether everything is read from the primary without replicas
+        """
+        response = self.client.post(
+            "/rate/", {"car_id": self.car.id, "rating": 4}
+        )
+
+        self.assertNotIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+        self.assertEqual(self.makes(), ["Toyota"])
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework import routers
-from . import views
+from . import async_views, metrics, views
 
 
 # Automatic URL routing for the API
@@ -13,6 +13,12 @@ router.register(r"popular", views.PopularViewSet, basename="popular")
 
 urlpatterns: list = [
     path("", include(router.urls)),
+    path("status/nhtsa/", views.nhtsa_status, name="nhtsa-status"),
+    # Prometheus scrapes /metrics by default
+    path("metrics", metrics.metrics_view, name="metrics"),
+    # Same as /cars/ and /rate/, for ASGI servers, see async_views.py
+    path("async/cars/", async_views.cars, name="async-cars"),
+    path("async/rate/", async_views.rate, name="async-rate"),
     path(
         "api-auth/", include("rest_framework.urls", namespace="rest_framework")
     ),
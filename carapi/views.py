@@ -1,28 +1,150 @@
+from django.conf import settings
+from django.db import router, transaction
+from django.urls import reverse
 from rest_framework import viewsets, mixins, status
+from rest_framework.decorators import action, api_view
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from .serializers import (
     CarSerializer,
+    CarSerializerBulk,
     CarSerializerGet,
     CarSerializerPost,
     CarSerializerDelete,
+    PendingCarSerializer,
     RatingSerializer,
+    RatingSerializerBulk,
     PopularSerializer,
 )
-from .models import Car, Rating
+from .models import Car, PendingCar, Rating
+from .pagination import KeysetPagination, PopularPagination
+from .query_budget import QueryBudgetMixin
+from .replicas import ReplicaMixin
+from . import (
+    dataversion,
+    export,
+    leaderboard,
+    nhtsa,
+    query_budget,
+    rating_buffer,
+    response_cache,
+)
 
 
 # Create your views here
+def save_car(serializer) -> Car:
+    """
+    Save a new car validated by CarSerializerPost, and add it
+    to the /popular/ leaderboard
+    """
+    car = serializer.save()
+    dataversion.bump("cars")
+    leaderboard.on_commit(
+        leaderboard.merge,
+        [{field: getattr(car, field) for field in leaderboard.FIELDS}],
+    )
+    return car
+
+
+def queue_car(request, serializer) -> Response:
+    """
+    Queue a car validated by CarSerializerPost to be checked against
+    NHTSA later, see models.PendingCar.process(). Returns 202 Accepted
+    with the URL of the car's status.
+    """
+    pending = PendingCar.objects.create(**serializer.validated_data)
+    url = request.build_absolute_uri(
+        reverse("cars-pending", kwargs={"pending_id": pending.id})
+    )
+    return Response(
+        {
+            "status": "accepted",
+            "data": dict(PendingCarSerializer(pending).data, url=url),
+        },
+        status=status.HTTP_202_ACCEPTED,
+        headers={"Location": url},
+    )
+
+
+def save_rating(serializer) -> Response:
+    """
+    Save a rating validated by RatingSerializer, updating the average
+    rating of the car on the fly. With RATING_WRITE_BEHIND the rating
+    is queued instead, and 202 Accepted is returned.
+    """
+    if settings.RATING_WRITE_BEHIND:
+        # Queue the rating, see rating_buffer for details
+        rating_buffer.append(
+            serializer.validated_data["car_id"].id,
+            serializer.validated_data["rating"],
+        )
+        return Response(
+            {"status": "accepted", "data": serializer.data},
+            status=status.HTTP_202_ACCEPTED,
+        )
+    # Update the car and save the rating info together, see
+    # the reconcile_ratings management command for older data
+    with transaction.atomic():
+        # Send update request to parent Car object, already
+        # loaded by the validation of car_id
+        serializer.validated_data["car_id"].rate(
+            serializer.validated_data["rating"]
+        )
+        # Save the rating info
+        serializer.save()
+    return Response(
+        {"status": "success", "data": serializer.data},
+        status=status.HTTP_201_CREATED,
+    )
+
+
+class FastListMixin(mixins.ListModelMixin):
+    """
+    With FAST_LIST set, the list action reads the fields of the serializer
+    with values() instead of creating a model instance per row and passing
+    it through the serializer. The response is the same, which requires
+    the serializer to consist of plain model fields only.
+    """
+
+    def list(self, request, *args, **kwargs):
+        if not settings.FAST_LIST:
+            return super(FastListMixin, self).list(request, *args, **kwargs)
+        fields = list(self.get_serializer_class().Meta.fields)
+        # Fields needed by the pagination cursor only
+        extra = [
+            field.lstrip("-")
+            for field in self.paginator.ordering
+            if field.lstrip("-") not in fields
+        ]
+        queryset = self.filter_queryset(self.get_queryset()).values(
+            *fields, *extra
+        )
+        rows = self.paginate_queryset(queryset)
+        for row in rows:
+            for field in extra:
+                del row[field]
+        return self.get_paginated_response(rows)
+
+
 class CarViewSet(
+    QueryBudgetMixin,
+    ReplicaMixin,
     mixins.CreateModelMixin,
     mixins.DestroyModelMixin,
-    mixins.ListModelMixin,
+    FastListMixin,
     viewsets.GenericViewSet,
 ):
     """
     API endpoint that shows all the cars in the database.
-    Allows listing: GET /cars/
+    Allows listing: GET /cars/?cursor=..&page_size=.. (keyset pagination)
     Allows posting: POST /cars/{make:str, model:str}/
+                    With CAR_VALIDATION_QUEUE the car is queued and
+                    202 Accepted is returned, with its status URL
+    Allows pending car status: GET /cars/pending/{id:int}/
     Allows deletion: DELETE /cars/{id:int}
+    Allows bulk posting: POST /cars/bulk/ [{make:str, model:str}, ...]
+    Allows rating statistics: GET /cars/{id:int}/stats/
+    Allows exporting: GET /cars/export/{ndjson|csv}/
 
     Attributes:
         queryset:          Looks through all the Car objects in the DB
@@ -32,10 +154,32 @@ class CarViewSet(
 
     queryset = Car.objects.all()
     serializer_class = CarSerializer
+    # Maximum number of queries per action, see query_budget.py
+    # Reads from a replica check it first every REPLICA_CHECK_INTERVAL,
+    # writes load the worker's leaderboard when missing, see leaderboard.py
+    query_budgets = {
+        # Page, replica check
+        "list": 2,
+        # Existence check, NHTSA cache lookup & store (4), insert,
+        # leaderboard load
+        "create": 7,
+        # Car, queued cars pointing to it, delete cascade (3)
+        "destroy": 5,
+        # One NHTSA cache lookup per make of the new cars
+        "bulk": None,
+        "pending": 1,
+        "stats": 2,
+        # Streamed in batches after the view has returned
+        "export": None,
+    }
+    # Served from a read replica, see replicas.py
+    replica_actions = ("list", "stats", "export")
+    pagination_class = KeysetPagination
     action_serializers: dict = {
         "list": CarSerializerGet,
         "create": CarSerializerPost,
         "destroy": CarSerializerDelete,
+        "bulk": CarSerializerBulk,
     }
 
     def get_serializer_class(self):
@@ -58,12 +202,21 @@ class CarViewSet(
         """
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
+            if settings.CAR_VALIDATION_QUEUE:
+                return queue_car(request, serializer)
             # Check external API for existence of the car
-            if Car.check_nhtsa_api(
-                request.data["make"], request.data["model"]
-            ):
+            try:
+                exists = Car.check_nhtsa_api(
+                    request.data["make"], request.data["model"]
+                )
+            except nhtsa.NhtsaUnavailable as error:
+                return Response(
+                    {"status": "error", "data": str(error)},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                )
+            if exists:
                 # Save the car info
-                serializer.save()
+                save_car(serializer)
                 return Response(
                     {"status": "success", "data": serializer.data},
                     status=status.HTTP_201_CREATED,
@@ -87,15 +240,165 @@ class CarViewSet(
                 status=status.HTTP_404_NOT_FOUND,
             )
 
+    @dataversion.conditional("cars")
+    @response_cache.cached("cars")
+    def list(self, request, *args, **kwargs):
+        """
+        Answer unchanged listings with 304 Not Modified, see dataversion.py
+        """
+        return super(CarViewSet, self).list(request, *args, **kwargs)
+
+    def perform_destroy(self, instance) -> None:
+        """
+        Delete the car, and remove it from the /popular/ leaderboard
+        """
+        instance.delete()
+        leaderboard.on_commit(leaderboard.invalidate)
+        dataversion.bump("cars", "ratings")
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request, *args, **kwargs):
+        """
+        Add a list of cars at once, reporting the status of every car:
+        created, exists, duplicate (repeated in the list), invalid,
+        not_found (unknown to NHTSA) or unavailable (NHTSA unavailable).
+        NHTSA is asked once per make, existing cars are looked up with
+        a single query and new cars are inserted with a single INSERT.
+        """
+        items = request.data
+        if not isinstance(items, list) or len(items) > settings.BULK_MAX_ITEMS:
+            return Response(
+                {
+                    "status": "error",
+                    "data": "Expected a list of at most {} cars".format(
+                        settings.BULK_MAX_ITEMS
+                    ),
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        results: list = []
+        pending: dict = {}
+        for item in items:
+            serializer = self.get_serializer(data=item)
+            if not serializer.is_valid():
+                results.append(
+                    {"status": "invalid", "data": serializer.errors}
+                )
+                continue
+            car = (
+                serializer.validated_data["make"],
+                serializer.validated_data["model"],
+            )
+            result = {"make": car[0], "model": car[1], "status": "duplicate"}
+            results.append(result)
+            # Only the first occurrence of a car is processed
+            pending.setdefault(car, result)
+
+        existing = set(
+            Car.objects.filter(
+                make__in={car[0] for car in pending},
+                model__in={car[1] for car in pending},
+            ).values_list("make", "model")
+        )
+
+        # Group the new cars by make, to ask NHTSA once per make
+        makes: dict = {}
+        for car, result in pending.items():
+            if car in existing:
+                result["status"] = "exists"
+            else:
+                makes.setdefault(nhtsa.normalize(car[0]), []).append(car)
+
+        new_cars = []
+        for make, cars in makes.items():
+            try:
+                # One cache lookup per make, a query with a database cache
+                with query_budget.per_item():
+                    known = nhtsa.model_names(make)
+            except nhtsa.NhtsaUnavailable:
+                known = None
+            for car in cars:
+                if known is None:
+                    pending[car]["status"] = "unavailable"
+                elif nhtsa.normalize(car[1]) in known:
+                    pending[car]["status"] = "created"
+                    new_cars.append(Car(make=car[0], model=car[1]))
+                else:
+                    pending[car]["status"] = "not_found"
+
+        # Cars added by a concurrent request in the meantime are skipped
+        with transaction.atomic():
+            Car.objects.bulk_create(new_cars, ignore_conflicts=True)
+        if new_cars:
+            dataversion.bump("cars")
+            # IDs of the new cars aren't known with ignore_conflicts
+            leaderboard.on_commit(leaderboard.invalidate)
+
+        return Response(
+            {"status": "success", "data": results},
+            status=(
+                status.HTTP_201_CREATED if new_cars else status.HTTP_200_OK
+            ),
+        )
+
+    @action(
+        detail=False, methods=["get"], url_path=r"pending/(?P<pending_id>\d+)"
+    )
+    def pending(self, request, pending_id: str, *args, **kwargs):
+        """
+        Show the validation status of a car queued by POST /cars/
+        with CAR_VALIDATION_QUEUE, see models.PendingCar
+        """
+        pending = get_object_or_404(PendingCar, id=pending_id)
+        return Response(
+            {"status": "success", "data": PendingCarSerializer(pending).data}
+        )
+
+    @action(detail=True, methods=["get"])
+    def stats(self, request, *args, **kwargs):
+        """
+        Show the number, mean, median, percentiles and histogram of the
+        ratings of a car, see models.Car.rating_stats()
+        """
+        return Response(
+            {"status": "success", "data": self.get_object().rating_stats()}
+        )
+
+    @action(
+        detail=False, methods=["get"], url_path=r"export/(?P<fmt>ndjson|csv)"
+    )
+    def export(self, request, fmt: str, *args, **kwargs):
+        """
+        Stream all the cars as NDJSON or CSV, gzip compressed when
+        the client accepts it, see export.py
+        """
+        return export.export_response(
+            request,
+            # Read after the view has returned, out of replicas.reading()
+            Car.objects.using(router.db_for_read(Car)).order_by("id"),
+            ["id", "make", "model", "avg_rating", "rates_number"],
+            fmt,
+            "cars",
+        )
+
 
 class RateViewSet(
-    mixins.CreateModelMixin, mixins.ListModelMixin, viewsets.GenericViewSet
+    QueryBudgetMixin,
+    ReplicaMixin,
+    mixins.CreateModelMixin,
+    FastListMixin,
+    viewsets.GenericViewSet,
 ):
     """
     API endpoint that shows Ratings for given Cars in the database
     Allows listing: GET /rate/ - not needed per specification, but nice to have
-    To delete simply remove 'mixins.ListModelMixin' from the class definition
+                    Paginated like GET /cars/, see pagination.py
+    To delete simply remove 'FastListMixin' from the class definition
     Allows posting: POST /rate/{id:int}/
+    Allows bulk posting: POST /rate/bulk/ [{car_id:int, rating:int}, ...]
+    Allows listing queued ratings: GET /rate/pending/
+    Allows exporting: GET /rate/export/{ndjson|csv}/
 
     Attributes:
         queryset:          Looks through all the Rating objects in the DB
@@ -104,34 +407,144 @@ class RateViewSet(
 
     queryset = Rating.objects.all()
     serializer_class = RatingSerializer
+    # Maximum number of queries per action, see query_budget.py
+    query_budgets = {
+        # Page, replica check
+        "list": 2,
+        # Car lookup, counters update & reload, insert, leaderboard load
+        "create": 5,
+        # One counters update per car, see models.Rating.bulk_add()
+        "bulk": None,
+        "export": None,
+        "pending": 0,
+    }
+    replica_actions = ("list", "export")
+    pagination_class = KeysetPagination
+
+    @dataversion.conditional("ratings")
+    @response_cache.cached("ratings")
+    def list(self, request, *args, **kwargs):
+        """
+        Answer unchanged listings with 304 Not Modified, see dataversion.py
+        """
+        return super(RateViewSet, self).list(request, *args, **kwargs)
+
+    def get_serializer_class(self):
+        """
+        Use the lightweight serializer for the items of POST /rate/bulk/
+        """
+        if self.action == "bulk":
+            return RatingSerializerBulk
+        return super(RateViewSet, self).get_serializer_class()
 
     def create(self, request, *args, **kwargs):
         """
         Override the POST method to allow us to calculate
-        the average rating of a given car on the fly
+        the average rating of a given car on the fly.
+        With RATING_WRITE_BEHIND the rating is queued instead,
+        and 202 Accepted is returned.
         """
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            # Send update request to parent Car object
-            parent_car = Car.objects.get(id=request.data["car_id"])
-            parent_car.rate(request.data["rating"])
-            # Save the rating info
-            serializer.save()
-            return Response(
-                {"status": "success", "data": serializer.data},
-                status=status.HTTP_201_CREATED,
-            )
+            return save_rating(serializer)
         else:
             return Response(
                 {"status": "error", "data": serializer.errors},
                 status=status.HTTP_404_NOT_FOUND,
             )
 
+    @action(detail=False, methods=["post"])
+    def bulk(self, request, *args, **kwargs):
+        """
+        Add a list of ratings at once, e.g. collected offline.
+        Either all ratings are added, or none when any of them is invalid.
+        Existence of the cars is checked with a single query, see
+        models.Rating.bulk_add() for how the ratings are saved.
+        """
+        if (
+            not isinstance(request.data, list)
+            or len(request.data) > settings.BULK_MAX_ITEMS
+        ):
+            return Response(
+                {
+                    "status": "error",
+                    "data": "Expected a list of at most {} ratings".format(
+                        settings.BULK_MAX_ITEMS
+                    ),
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        if serializer.is_valid():
+            ratings = [
+                (item["car_id"], item["rating"])
+                for item in serializer.validated_data
+            ]
+            existing = set(
+                Car.objects.filter(
+                    id__in={car_id for car_id, _ in ratings}
+                ).values_list("id", flat=True)
+            )
+            errors = [
+                (
+                    {}
+                    if car_id in existing
+                    else {
+                        "car_id": [
+                            'Invalid pk "{}" - object does not exist.'.format(
+                                car_id
+                            )
+                        ]
+                    }
+                )
+                for car_id, _ in ratings
+            ]
+            if not any(errors):
+                Rating.bulk_add(ratings)
+                return Response(
+                    {"status": "success", "data": serializer.data},
+                    status=status.HTTP_201_CREATED,
+                )
+        else:
+            errors = serializer.errors
+        return Response(
+            {"status": "error", "data": errors},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+
+    @action(
+        detail=False, methods=["get"], url_path=r"export/(?P<fmt>ndjson|csv)"
+    )
+    def export(self, request, fmt: str, *args, **kwargs):
+        """
+        Stream all the ratings as NDJSON or CSV, see CarViewSet.export()
+        """
+        return export.export_response(
+            request,
+            Rating.objects.using(router.db_for_read(Rating)).order_by("id"),
+            ["id", "car_id", "rating"],
+            fmt,
+            "ratings",
+        )
 
-class PopularViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+    @action(detail=False, methods=["get"])
+    def pending(self, request, *args, **kwargs):
+        """
+        Show the number of ratings queued by RATING_WRITE_BEHIND
+        and the age of the oldest one, in seconds
+        """
+        return Response(
+            {"status": "success", "data": rating_buffer.get_buffer().pending()}
+        )
+
+
+class PopularViewSet(
+    QueryBudgetMixin, ReplicaMixin, FastListMixin, viewsets.GenericViewSet
+):
     """
     API endpoint that shows the most popular cars
-    Allows listing: GET /popular
+    Allows listing: GET /popular/?cursor=..&page_size=.. (keyset pagination)
 
     Attributes:
         queryset:          Looks through all the Car objects in the DB
@@ -139,5 +552,42 @@ class PopularViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
         serializer_class:  Provides a default serializer for the class
     """
 
-    queryset = Car.objects.all().order_by("-rates_number")
+    # Cars without a rates_number (never rated) can't be paginated by it
+    queryset = Car.objects.filter(rates_number__isnull=False).order_by(
+        "-rates_number", "-id"
+    )
     serializer_class = PopularSerializer
+    # Maximum number of queries per action, see query_budget.py
+    query_budgets = {
+        # Leaderboard load, deeper page, replica check
+        "list": 3,
+    }
+    replica_actions = ("list",)
+    pagination_class = PopularPagination
+
+    @dataversion.conditional("cars")
+    @response_cache.cached("cars")
+    def list(self, request, *args, **kwargs):
+        """
+        Serve the pages within the leaderboard from the cache,
+        see leaderboard.py. Deeper pages are read from the database.
+        """
+        board = leaderboard.top()
+        page = self.paginator.paginate_rows(
+            board["rows"], board["complete"], request
+        )
+        if page is None:
+            return super(PopularViewSet, self).list(request, *args, **kwargs)
+        return self.paginator.get_paginated_response(page)
+
+
+@api_view(["GET"])
+def nhtsa_status(request):
+    """
+    API endpoint that shows the state of the NHTSA circuit breaker,
+    upstream latency and cache counters of the worker answering it
+    Allows listing: GET /status/nhtsa/
+    """
+    return Response(
+        {"breaker": nhtsa.breaker.info(), "cache": nhtsa.cache_info()}
+    )
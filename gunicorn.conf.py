@@ -0,0 +1,23 @@
+"""
+gunicorn settings, read from the working directory on start
+"""
+
+import os
+import shutil
+import tempfile
+
+# Workers write their metrics to this directory, /metrics adds them up,
+# see carapi/metrics.py. A new directory per server by default.
+os.environ.setdefault(
+    "METRICS_DIR",
+    os.path.join(tempfile.gettempdir(), "carapi-metrics-%d" % os.getpid()),
+)
+
+
+def on_starting(server) -> None:
+    # Metrics of an earlier server are not added to the new ones
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+
+
+def on_exit(server) -> None:
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 import os
 import dj_database_url
 from pathlib import Path
+from urllib.parse import urlsplit
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -46,8 +47,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "carapi.metrics.MetricsMiddleware",
+    "carapi.middleware.ReplicaPinMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "carapi.middleware.AsyncWhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -93,6 +96,193 @@ db_from_env = dj_database_url.config(
 )
 DATABASES["default"].update(db_from_env)
 
+# SQLite tuned for concurrent writes: WAL journaling, pragmas and
+# writes serialized in-process, see carapi.db.sqlite
+SQLITE_TUNED = int(os.environ.get("SQLITE_TUNED", default=0))
+if SQLITE_TUNED and DATABASES["default"]["ENGINE"].endswith("sqlite3"):
+    DATABASES["default"]["ENGINE"] = "carapi.db.sqlite"
+
+# Read replicas, space separated database URLs. Read-only viewset actions
+# are served from them, see carapi.replicas
+DATABASE_REPLICAS = []
+for number, url in enumerate(
+    os.environ.get("DATABASE_REPLICA_URLS", default="").split(), start=1
+):
+    alias = "replica{}".format(number)
+    DATABASES[alias] = dj_database_url.parse(
+        url, conn_max_age=500, ssl_require=True
+    )
+    # Tests read the test database of the primary
+    DATABASES[alias]["TEST"] = {"MIRROR": "default"}
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ["carapi.replicas.ReplicaRouter"]
+
+# Maximum number of PostgreSQL connections per process, shared by its
+# threads, 0 for a connection per thread, see carapi.db.pool
+DATABASE_POOL = int(os.environ.get("DATABASE_POOL", default=0))
+if DATABASE_POOL:
+    for database in DATABASES.values():
+        if database["ENGINE"].startswith("django.db.backends.postgresql"):
+            database["ENGINE"] = "carapi.db.postgresql"
+            # Given back to the pool at the end of every request
+            database["CONN_MAX_AGE"] = 0
+            database.setdefault("OPTIONS", {})["pool"] = {
+                "max_size": DATABASE_POOL,
+                # Seconds to wait for a connection
+                "timeout": float(
+                    os.environ.get("DATABASE_POOL_TIMEOUT", default=10)
+                ),
+                # Seconds after which connections are replaced
+                "max_lifetime": float(
+                    os.environ.get("DATABASE_POOL_MAX_LIFETIME", default=1800)
+                ),
+                "max_idle": float(
+                    os.environ.get("DATABASE_POOL_MAX_IDLE", default=300)
+                ),
+                # Check connections with "SELECT 1" before using them
+                "pre_ping": bool(
+                    int(os.environ.get("DATABASE_POOL_PRE_PING", default=1))
+                ),
+            }
+# Seconds a client reads from the primary after writing (with a cookie)
+REPLICA_PIN_SECONDS = int(os.environ.get("REPLICA_PIN_SECONDS", default=5))
+REPLICA_PIN_COOKIE = "carapi_primary"
+# Seconds between two health checks of a replica
+REPLICA_CHECK_INTERVAL = int(
+    os.environ.get("REPLICA_CHECK_INTERVAL", default=10)
+)
+
+
+# Caches are configured with URLs: db://table, file:///path,
+# memcached://host:port[,host:port] (requires pymemcache),
+# locmem:// (single process only) or dummy://
+CACHE_BACKENDS = {
+    "db": "django.core.cache.backends.db.DatabaseCache",
+    "memcached": "django.core.cache.backends.memcached.PyMemcacheCache",
+    "file": "django.core.cache.backends.filebased.FileBasedCache",
+    "locmem": "django.core.cache.backends.locmem.LocMemCache",
+    "dummy": "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+def cache_from_url(url: str) -> dict:
+    url = urlsplit(url)
+    if url.scheme == "file":
+        location = url.path
+    elif url.scheme == "memcached":
+        location = url.netloc.split(",")
+    else:
+        location = url.netloc
+    return {"BACKEND": CACHE_BACKENDS[url.scheme], "LOCATION": location}
+
+
+CACHES = {
+    # Shared by all the workers: data versions, checked by every listing
+    # and the /popular/ leaderboard. Files are shared by the workers of a
+    # host, use memcached:// for several hosts.
+    "default": cache_from_url(
+        os.environ.get(
+            "CACHE_URL", default="file://" + str(BASE_DIR / "cache")
+        )
+    ),
+    # Rendered responses of the listings, see carapi.response_cache.
+    # Entries are checked against the shared data versions, so a cache
+    # per worker (the default) never serves outdated data either.
+    "responses": cache_from_url(
+        os.environ.get("RESPONSE_CACHE_URL", default="locmem://responses")
+    ),
+}
+# Seconds a rendered listing is cached for, 0 disables the cache
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", default=0))
+
+# Number of cars kept in the /popular/ leaderboard, and seconds after
+# which it's rebuilt from the database
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", default=100))
+LEADERBOARD_TTL = int(os.environ.get("LEADERBOARD_TTL", default=300))
+
+# NHTSA Vehicle API
+# "remote" asks the NHTSA API, "local" uses the imported catalog snapshot
+NHTSA_MODE = os.environ.get("NHTSA_MODE", default="remote")
+NHTSA_API_URL = os.environ.get(
+    "NHTSA_API_URL", default="https://vpic.nhtsa.dot.gov/api/vehicles/"
+)
+# Seconds a request may take, slower requests count as failures
+NHTSA_LATENCY_BUDGET = float(
+    os.environ.get("NHTSA_LATENCY_BUDGET", default=2)
+)
+# Consecutive failures after which NHTSA isn't contacted for a while,
+# and the number of seconds after which it's tried again
+NHTSA_BREAKER_THRESHOLD = int(
+    os.environ.get("NHTSA_BREAKER_THRESHOLD", default=5)
+)
+NHTSA_BREAKER_RESET = float(os.environ.get("NHTSA_BREAKER_RESET", default=30))
+# Keep-alive connections kept open to the API by every worker
+NHTSA_POOL_SIZE = int(os.environ.get("NHTSA_POOL_SIZE", default=10))
+# Model names are cached per make, see carapi/nhtsa.py
+# Time in seconds for which known / unknown makes are cached
+NHTSA_CACHE_TTL = int(os.environ.get("NHTSA_CACHE_TTL", default=86400))
+NHTSA_CACHE_NEGATIVE_TTL = int(
+    os.environ.get("NHTSA_CACHE_NEGATIVE_TTL", default=3600)
+)
+# Maximum number of makes kept in memory by every worker
+NHTSA_CACHE_SIZE = int(os.environ.get("NHTSA_CACHE_SIZE", default=1024))
+
+
+# Number of counter rows the ratings of every car are spread over,
+# 0 updates the Car row directly. See carapi.models.RatingShard
+RATING_SHARDS = int(os.environ.get("RATING_SHARDS", default=0))
+
+# Queue POST /rate/ ratings in a local file and write them in batches,
+# every RATING_FLUSH_INTERVAL seconds (0: flush_rating_buffer command only)
+RATING_WRITE_BEHIND = int(os.environ.get("RATING_WRITE_BEHIND", default=0))
+RATING_BUFFER_PATH = os.environ.get(
+    "RATING_BUFFER_PATH", default=BASE_DIR / "rating_buffer.sqlite3"
+)
+RATING_FLUSH_INTERVAL = float(
+    os.environ.get("RATING_FLUSH_INTERVAL", default=2)
+)
+RATING_FLUSH_BATCH = int(os.environ.get("RATING_FLUSH_BATCH", default=500))
+
+# Queue the cars of POST /cars/ and answer 202 Accepted, instead of
+# validating them right away, see the process_pending_cars command
+CAR_VALIDATION_QUEUE = int(os.environ.get("CAR_VALIDATION_QUEUE", default=0))
+PENDING_CARS_BATCH = int(os.environ.get("PENDING_CARS_BATCH", default=500))
+
+# Maximum number of items accepted by the bulk endpoints
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", default=1000))
+
+# Record request metrics, served at /metrics. Every process writes its
+# metrics to METRICS_DIR (every METRICS_FLUSH_INTERVAL seconds), where
+# they are added up. Set by gunicorn.conf.py, empty: this process only
+METRICS = int(os.environ.get("METRICS", default=1))
+METRICS_DIR = os.environ.get("METRICS_DIR", default="")
+METRICS_FLUSH_INTERVAL = float(
+    os.environ.get("METRICS_FLUSH_INTERVAL", default=5)
+)
+
+# Check the queries of the viewset actions against their budgets,
+# see carapi.query_budget: "off", "log" or "raise" (set by the tests)
+QUERY_BUDGET = os.environ.get("QUERY_BUDGET", default="off")
+
+# Default and maximum number of items per page of the list endpoints,
+# see carapi.pagination
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", default=100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", default=1000))
+# Read the rows of the list endpoints with values() and skip the
+# serializers, see views.FastListMixin. Responses stay the same.
+FAST_LIST = int(os.environ.get("FAST_LIST", default=0))
+
+# Rows fetched from the database at a time by the export endpoints
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", default=2000))
+
+
+# Same output as the default JSON renderer, encoded with orjson
+REST_FRAMEWORK = {
+    "DEFAULT_RENDERER_CLASSES": [
+        "carapi.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ]
+}
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -130,6 +320,9 @@ STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 # White Noise staticfiles config
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 
+# Runs the tests with QUERY_BUDGET = "raise"
+TEST_RUNNER = "carapi.tests.runner.TestRunner"
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 